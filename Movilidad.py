@@ -3,17 +3,39 @@
 import pandas as pd
 import openpyxl
 from openpyxl.styles import PatternFill
+from openpyxl.styles.colors import COLOR_INDEX
 import tkinter as tk
-from tkinter import filedialog, messagebox, Toplevel, Listbox, Scrollbar, Button, Label, Frame, Entry, StringVar
+from tkinter import filedialog, messagebox, Toplevel, Listbox, Scrollbar, Button, Label, Frame, Entry, StringVar, ttk
 import sys
 import os
 import unicodedata
 import re
 from thefuzz import process
+from thefuzz import utils as fuzz_utils
+from rapidfuzz import process as rf_process, fuzz as rf_fuzz
+import numpy as np
 import math
 import traceback
-from typing import List, Dict, Tuple, Optional, Any
+from typing import List, Dict, Tuple, Optional, Any, NamedTuple, Iterator, Set
+from dataclasses import dataclass, field, asdict
+import argparse
+import csv
+import glob
+import json
+from datetime import datetime
+from concurrent.futures import ProcessPoolExecutor, as_completed
 import random # Importado para aleatoriedad
+import time
+import hashlib
+import pickle
+import functools
+import contextlib
+import queue
+import threading
+import io
+import posixpath
+import zipfile
+import xml.etree.ElementTree as ET
 
 
 # ==============================================================================
@@ -85,6 +107,85 @@ SKIPROWS_CSAP1 = 1
 SKIPROWS_CSAP2 = 2
 CONDUCTOR_GROUP_SIZE = 50 # Tamaño del grupo para cédulas (conductor y auxiliar)
 AUXILIAR_GROUP_SIZE = 50 # Puede ser diferente si se desea
+SUCURSAL_BLOCKING_NGRAM_SIZE = 3           # Tamaño de n-grama para el índice de candidatos de sucursal
+SUCURSAL_BLOCKING_MIN_SHARED_RATIO = 0.3   # Fracción mínima de n-gramas compartidos para ser candidato
+FUZZY_CDIST_WORKERS = -1                   # Hilos de rapidfuzz.cdist (-1 = todos); en los procesos del pool por lotes se usa 1
+FUZZY_CDIST_CHUNK_ROWS = 256               # Consultas por bloque de cdist: la matriz viva ocupa bloque × opciones × 8 bytes
+COMPACT_MAX_UNIQUE_RATIO = 0.5             # Columnas de texto con (distintos / filas) <= este valor se manejan como categóricas
+COMPACT_SOURCE_COLUMNS = [SRC_COL_CLIENTE, SRC_COL_RESIDUO, SRC_COL_PLACA]
+COMPACT_KEY_COLUMNS = ['lookup_key_client_part1', 'lookup_key_client_part2', 'lookup_key_residuo']
+
+# --- Hojas a extraer en la lectura única del libro (hoja -> filas a omitir) ---
+WORKBOOK_SHEETS_TO_READ = {
+    SOURCE_SHEET_NAME: 0, LOOKUP_SUCURSAL_SHEET_NAME: 0,
+    LOOKUP_CSAP1_SHEET_NAME: SKIPROWS_CSAP1, LOOKUP_CSAP2_SHEET_NAME: SKIPROWS_CSAP2
+}
+# Columnas cuyo valor calculado se necesita; si contienen fórmulas se relee la hoja con valores
+WORKBOOK_SHEET_VALUE_COLUMNS = {
+    SOURCE_SHEET_NAME: [SRC_COL_CLIENTE, SRC_COL_FECHA, SRC_COL_PLACA, SRC_COL_PESO, SRC_COL_RESIDUO],
+    LOOKUP_SUCURSAL_SHEET_NAME: [LKP_SUC_CLIENTE, LKP_SUC_SUCURSAL, LKP_SUC_DEUDOR],
+    LOOKUP_CSAP1_SHEET_NAME: [LKP_CSAP1_ITEM, LKP_CSAP1_CODIGO],
+    LOOKUP_CSAP2_SHEET_NAME: [LKP_CSAP2_NOMBRE, LKP_CSAP2_CODIGO, LKP_CSAP2_CORRIENTE]
+}
+
+# --- Caché en disco de lookups preparados ---
+USE_LOOKUP_CACHE = True
+LOOKUP_CACHE_PREFIX = '.movilidad_lookups_' # Junto al libro de entrada: un archivo por tipo de lookup y huella de sus hojas
+LOOKUP_CACHE_MAX_FILES = 10 # Archivos de caché conservados por directorio (se borran los más antiguos)
+LOOKUP_CACHE_WRITE = True # False en los procesos del pool por lotes: solo leen la caché, no la escriben
+LOOKUP_CACHE_VERSION = 3 # Incrementar si cambia la forma de preparar los lookups
+
+# --- Columna auxiliar (no se escribe como valor) con el relleno de la celda SAP ---
+OUTPUT_SAP_FILL_COL = '__sap_fill__'
+
+# --- Limpieza de filas antiguas ---
+CLEANUP_EXISTING_CELLS_ONLY = True  # False: recorrido completo filas × columnas (comportamiento anterior)
+
+# --- Formato del archivo final ---
+OUTPUT_FORMAT_FULL = 'libro'   # Libro completo re-guardado con openpyxl (permite modo incremental y reanudar)
+OUTPUT_FORMAT_SHEET = 'hoja'   # Solo la hoja de cargue, con encabezado y rellenos (xlsxwriter en streaming)
+OUTPUT_FORMAT_CSV = 'csv'      # Solo la hoja de cargue en CSV (';', UTF-8 con BOM)
+OUTPUT_FORMAT = OUTPUT_FORMAT_FULL
+OUTPUT_FORMAT_EXTENSIONS = {OUTPUT_FORMAT_FULL: '.xlsx', OUTPUT_FORMAT_SHEET: '.xlsx', OUTPUT_FORMAT_CSV: '.csv'}
+
+# --- Popup de selección manual SAP ---
+POPUP_SEARCH_DEBOUNCE_MS = 150      # Espera tras la última tecla antes de filtrar
+POPUP_PAGE_SIZE = 300               # Coincidencias por página del Listbox (se navega con Anteriores/Siguientes)
+POPUP_SUGGESTION_COUNT = 5          # Sugerencias difusas mostradas arriba para el residuo actual
+POPUP_SUGGESTION_MIN_SCORE = 60
+POPUP_SUGGESTION_PREFIX = "★ "
+
+# --- Ventana de progreso (Fase 1 y guardados en un hilo de trabajo) ---
+PROGRESS_POLL_MS = 100        # Cada cuánto la UI vacía la cola de avances del hilo de trabajo
+PROGRESS_BLOCK_ROWS = 1000    # Con ventana de progreso, las filas se procesan y reportan en bloques de este tamaño
+
+# --- Decisiones manuales SAP persistentes (compartidas entre ejecuciones) ---
+USE_SAP_DECISION_STORE = True
+SAP_DECISION_STORE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'decisiones_sap.json')
+SAP_DECISION_SKIP = "SKIP"
+
+# --- Modo por lotes (CLI sin GUI) ---
+BATCH_OUTPUT_SUFFIX = '_procesado.xlsx'
+BATCH_PENDING_SAP_REPORT_SUFFIX = '_pendientes_sap.csv'
+
+# --- Modo incremental (solo filas nuevas/cambiadas de WEB2.0) ---
+USE_INCREMENTAL_MODE = True   # Solo GUI: al reabrir un libro ya procesado (con su manifiesto) se ofrece procesar solo las filas nuevas/cambiadas
+INCREMENTAL_MANIFEST_SUFFIX = '_manifiesto_movilidad.json' # Se guarda junto al libro de salida
+INCREMENTAL_MANIFEST_VERSION = 2
+SOURCE_FINGERPRINT_COLUMNS = [SRC_COL_CLIENTE, SRC_COL_FECHA, SRC_COL_PLACA, SRC_COL_PESO, SRC_COL_RESIDUO]
+
+# --- Lectura por bloques de WEB2.0 ---
+USE_STREAMING_SOURCE = False  # True: WEB2.0 se lee con un iterador de solo lectura y se procesa bloque a bloque (memoria acotada solo con salida 'hoja'/'csv')
+SOURCE_CHUNK_ROWS = 5000
+
+# --- Punto de control de 'Guardar y Salir' (reanudar la selección manual SAP) ---
+SAP_CHECKPOINT_SUFFIX = '_checkpoint_sap.json' # Se guarda junto al libro de progreso
+SAP_CHECKPOINT_VERSION = 1
+
+# --- Instrumentación y registro ---
+VERBOSE_ROW_LOGGING = False   # True: una línea por fila con la coincidencia de sucursal aplicada (depuración)
+WRITE_RUN_REPORT = True
+RUN_REPORT_SUFFIX = '_reporte_ejecucion.json' # Se guarda junto al libro de salida
 
 # --- Valores Fijos ---
 FIXED_STRING_SIN_DESCRIPCION = "Sin descripción"
@@ -109,9 +210,49 @@ HIGHLIGHT_NONE = PatternFill(fill_type=None)
 # ==============================================================================
 selected_sap_code_from_popup: Optional[str] = None
 
+# ==============================================================================
+# --- Instrumentación (tiempos por fase y contadores de coincidencia) ---
+# ==============================================================================
+class RunStats:
+    """Acumula la duración de cada fase y contadores de niveles de coincidencia de una ejecución."""
+    def __init__(self, input_path: Optional[str] = None):
+        self.input_path = input_path
+        self.started_at = datetime.now()
+        self.phase_seconds: Dict[str, float] = {}
+        self.counters: Dict[str, int] = {}
+
+    @contextlib.contextmanager
+    def phase(self, name: str):
+        t_start = time.perf_counter()
+        try: yield
+        finally: self.phase_seconds[name] = self.phase_seconds.get(name, 0.0) + time.perf_counter() - t_start
+
+    def count(self, name: str, amount: int = 1):
+        self.counters[name] = self.counters.get(name, 0) + int(amount)
+
+    def to_report(self) -> Dict[str, Any]:
+        return {'input': self.input_path, 'started_at': self.started_at.isoformat(timespec='seconds'),
+                'phases_seconds': {name: round(secs, 4) for name, secs in self.phase_seconds.items()},
+                'total_seconds': round(sum(self.phase_seconds.values()), 4), 'counters': dict(self.counters)}
+
+    def print_summary(self):
+        print("\n--- Tiempos por fase ---")
+        for name, secs in self.phase_seconds.items(): print(f"  {name:<16} {secs:8.2f}s")
+        print(f"  {'total':<16} {sum(self.phase_seconds.values()):8.2f}s")
+        if self.counters: print("--- Contadores ---")
+        for name, value in self.counters.items(): print(f"  {name:<28} {value}")
+
+    def write_report(self, output_path: str) -> Optional[str]:
+        """Guarda el reporte JSON junto a output_path; devuelve la ruta o None si está desactivado/falla."""
+        if not WRITE_RUN_REPORT: return None
+        report_path = os.path.splitext(output_path)[0] + RUN_REPORT_SUFFIX
+        try:
+            with open(report_path, 'w', encoding='utf-8') as f: json.dump(self.to_report(), f, ensure_ascii=False, indent=2)
+            print(f"Reporte de ejecución guardado en '{report_path}'."); return report_path
+        except Exception as e: print(f"Advertencia: No se pudo guardar el reporte de ejecución: {e}"); return None
+
 # ==============================================================================
 # --- Funciones de Limpieza de Texto ---
-# (Sin cambios)
 # ==============================================================================
 def remove_accents(input_str: Any) -> str:
     if pd.isna(input_str): return ""
@@ -128,13 +269,14 @@ def clean_text_for_comparison(text: Any) -> str:
     cleaned = remove_accents(str(text)); cleaned = cleaned.strip()
     return cleaned
 
+CLIENT_NAME_SUFFIXES = ['SAS', 'S A S', 'SA', 'S A', 'LTDA', 'LIMITADA', 'ESP', 'E S P']
+CLIENT_SUFFIX_PATTERN = re.compile(r'\s+\b(?:' + '|'.join(re.escape(s.replace('.', r'\.')) for s in CLIENT_NAME_SUFFIXES) + r')\b$', flags=re.IGNORECASE)
+
 def clean_client_name_part(client_name_part: str) -> str:
     if not client_name_part: return ""
     text = client_name_part.strip(); text = text.replace('.', '')
     text = remove_accents(text)
-    suffixes = ['SAS', 'S A S', 'SA', 'S A', 'LTDA', 'LIMITADA', 'ESP', 'E S P']
-    pattern = r'\s+\b(?:' + '|'.join(re.escape(s.replace('.', r'\.')) for s in suffixes) + r')\b$'
-    text = re.sub(pattern, '', text, flags=re.IGNORECASE).strip()
+    text = CLIENT_SUFFIX_PATTERN.sub('', text).strip()
     return text
 
 def clean_sap_material_name(row: pd.Series, name_col: str, current_col: str) -> str:
@@ -155,29 +297,324 @@ def safe_str_conversion(value: Any) -> str:
     if isinstance(value, (int, float)) and not math.isnan(value): return str(value)
     return str(value).strip()
 
+# ==============================================================================
+# --- Normalización Vectorizada y Memoizada ---
+# Equivalentes por columna de las funciones de limpieza anteriores: cada valor
+# distinto se normaliza una sola vez con operaciones .str de pandas y el
+# resultado se difunde a todas las filas que lo repiten.
+# ==============================================================================
+@functools.lru_cache(maxsize=1)
+def _combining_chars_table() -> Dict[int, None]:
+    """Tabla de str.translate que elimina todos los caracteres combinantes (tildes, diéresis...)."""
+    return {cp: None for cp in range(sys.maxunicode + 1) if unicodedata.combining(chr(cp))}
+
+def _strip_accents_upper(texts: pd.Series) -> pd.Series:
+    """Versión vectorizada de remove_accents para una Serie de textos (sin nulos)."""
+    return texts.str.normalize('NFD').str.translate(_combining_chars_table()).str.upper()
+
+def _map_unique(values: pd.Series, normalize_uniques) -> pd.Series:
+    """
+    Aplica normalize_uniques solo a los valores distintos y difunde el resultado a las filas
+    como Serie categórica (una clave normalizada por categoría, códigos enteros por fila).
+    Los valores se distinguen también por tipo (3 vs 3.0, None vs NaN) porque su str() difiere;
+    si values ya es categórica se normalizan directamente sus categorías (más NaN para los nulos).
+    """
+    if values.empty: return pd.Series(pd.Categorical([]), index=values.index)
+    if isinstance(values.dtype, pd.CategoricalDtype):
+        uniques = values.cat.categories.tolist() + [np.nan]
+        codes = values.cat.codes.to_numpy(); codes = np.where(codes < 0, len(uniques) - 1, codes)
+    else:
+        value_codes, _ = pd.factorize(values, use_na_sentinel=False)
+        type_codes, _ = pd.factorize(values.map(type))
+        combined_codes = value_codes.astype(np.int64) * (int(type_codes.max()) + 1) + type_codes
+        _, first_positions, codes = np.unique(combined_codes, return_index=True, return_inverse=True)
+        uniques = values.iloc[first_positions].tolist()
+    normalized = np.asarray(normalize_uniques(uniques), dtype=object)
+    # Varios valores originales pueden dar la misma clave: se re-factoriza para que las categorías sean únicas
+    key_codes, keys = pd.factorize(normalized)
+    return pd.Series(pd.Categorical.from_codes(key_codes[codes.ravel()], categories=keys), index=values.index)
+
+def map_per_category(values: pd.Series, func) -> List[Any]:
+    """func(valor) evaluada una sola vez por categoría y difundida a las filas; sin categorías, fila a fila."""
+    if not isinstance(values.dtype, pd.CategoricalDtype): return [func(v) for v in values]
+    per_category = [func(v) for v in values.cat.categories] + [func(np.nan)]
+    codes = values.cat.codes.to_numpy()
+    return [per_category[code] for code in codes]
+
+def compact_low_cardinality_columns(df: pd.DataFrame, columns: List[str], stats: Optional['RunStats'] = None):
+    """
+    Convierte in situ a categóricas las columnas de texto con pocos valores distintos
+    (COMPACT_MAX_UNIQUE_RATIO) y registra en stats la memoria como objeto vs. categórica
+    y las evaluaciones por fila que se evitan al trabajar por categoría. Las columnas que
+    ya son categóricas (claves lookup_key_*) solo se contabilizan.
+    """
+    for col in columns:
+        if col not in df.columns or df.empty: continue
+        values = df[col]
+        if isinstance(values.dtype, pd.CategoricalDtype): bytes_object = values.astype(object).memory_usage(index=False, deep=True)
+        else:
+            # Solo texto: con números mezclados, 3 y 3.0 caerían en la misma categoría
+            if pd.api.types.infer_dtype(values, skipna=True) != 'string' or values.nunique() > COMPACT_MAX_UNIQUE_RATIO * len(values): continue
+            bytes_object = values.memory_usage(index=False, deep=True); df[col] = values = values.astype('category')
+        if stats is not None:
+            stats.count('compact_bytes_object', int(bytes_object)); stats.count('compact_bytes_categorical', int(values.memory_usage(index=False, deep=True)))
+            stats.count('compact_row_evaluations_avoided', len(values) - len(values.cat.categories))
+
+def _as_text_series(uniques) -> pd.Series:
+    return pd.Series([str(v) for v in uniques], dtype=object)
+
+def normalize_text_series(values: pd.Series) -> pd.Series:
+    """Equivalente a values.apply(clean_text_for_comparison)."""
+    def normalize(uniques):
+        missing = pd.isna(pd.Series(uniques, dtype=object)).to_numpy()
+        return _strip_accents_upper(_as_text_series(uniques)).str.strip().where(~missing, "")
+    return _map_unique(values, normalize)
+
+def _clean_client_name_part_uniques(parts: pd.Series) -> pd.Series:
+    """Equivalente vectorizado de clean_client_name_part sobre una Serie de textos."""
+    cleaned = _strip_accents_upper(parts.str.strip().str.replace('.', '', regex=False))
+    cleaned = cleaned.str.replace(CLIENT_SUFFIX_PATTERN, '', regex=True).str.strip()
+    return cleaned.where(parts != "", "")
+
+def normalize_client_part1_series(values: pd.Series) -> pd.Series:
+    """Equivalente a values.apply(lambda x: clean_client_name_part(str(x).split('-', maxsplit=1)[0]))."""
+    return _map_unique(values, lambda uniques: _clean_client_name_part_uniques(_as_text_series(uniques).str.split('-', n=1).str[0]))
+
+def normalize_client_part2_series(values: pd.Series) -> pd.Series:
+    """Equivalente a clean_text_for_comparison(parte después del primer guion), o '' si no hay guion."""
+    def normalize(uniques):
+        parts = _as_text_series(uniques).str.split('-', n=1)
+        has_part2 = (parts.str.len() > 1).to_numpy()
+        return _strip_accents_upper(parts.str[1].fillna("").str.strip()).str.strip().where(has_part2, "")
+    return _map_unique(values, normalize)
+
+def normalize_sap_material_frame(df: pd.DataFrame, name_col: str, current_col: str) -> pd.Series:
+    """Equivalente a df.apply(lambda row: clean_sap_material_name(row, name_col, current_col), axis=1)."""
+    if df.empty: return pd.Series([], index=df.index, dtype=object)
+    nombres = pd.Series(["" if pd.isna(v) else str(v) for v in df[name_col]], index=df.index, dtype=object).str.strip()
+    corrientes = pd.Series(["" if pd.isna(v) else str(v) for v in df[current_col]], index=df.index, dtype=object).str.strip()
+    cleaned = nombres.copy()
+    # Un patrón por cada 'Corriente' distinta, aplicado a todas sus filas a la vez
+    for corriente, positions in corrientes.groupby(corrientes, sort=False).groups.items():
+        if not corriente: continue
+        pattern = re.compile(r'\s*' + re.escape(corriente) + r'\W*$', flags=re.IGNORECASE)
+        cleaned.loc[positions] = nombres.loc[positions].str.replace(pattern, '', regex=True).str.strip()
+    return _map_unique(cleaned, lambda uniques: _strip_accents_upper(_as_text_series(uniques)))
+
+# ==============================================================================
+# --- Índice de Sucursales (hash exacto + bloqueo por n-gramas) ---
+# ==============================================================================
+class SucursalMatchIndex:
+    """
+    Índice sobre los nombres limpios de sucursal:
+      - by_clean: hash nombre limpio -> (código deudor, sucursal original), primera aparición.
+      - exact: índice hash de la forma procesada para resolver sin puntaje difuso.
+      - Índice invertido de n-gramas de caracteres para reducir cada búsqueda difusa a
+        un conjunto pequeño de candidatos en lugar de toda la hoja de sucursales.
+    """
+    def __init__(self, sucursal_deudor_data: List[Tuple[str, str, str]], sucursal_names_clean: List[str]):
+        self.names: List[str] = sucursal_names_clean
+        self.by_clean: Dict[str, Tuple[str, str]] = {}
+        for suc_clean, debtor_code, suc_original in sucursal_deudor_data:
+            self.by_clean.setdefault(suc_clean, (debtor_code, suc_original))
+        self.exact = ExactKeyIndex(self.names)
+        self._postings: Dict[str, List[int]] = {}
+        self._ngram_counts: List[int] = []
+        for position, name in enumerate(self.names):
+            ngrams = self._ngrams(_fuzzy_process_choice(name))
+            self._ngram_counts.append(len(ngrams))
+            for gram in ngrams: self._postings.setdefault(gram, []).append(position)
+
+    @staticmethod
+    def _ngrams(text: str) -> set:
+        n = SUCURSAL_BLOCKING_NGRAM_SIZE
+        return {text[i:i + n] for i in range(len(text) - n + 1)}
+
+    def candidates(self, query: str) -> List[str]:
+        """Nombres que comparten suficientes n-gramas con la consulta, en el orden original."""
+        query_ngrams = self._ngrams(_fuzzy_process_query(query))
+        if not query_ngrams: return self.names # Consulta demasiado corta para bloquear
+        shared: Dict[int, int] = {}
+        for gram in query_ngrams:
+            for position in self._postings.get(gram, ()): shared[position] = shared.get(position, 0) + 1
+        min_ratio = SUCURSAL_BLOCKING_MIN_SHARED_RATIO
+        selected = [pos for pos, count in shared.items() if count >= min_ratio * min(len(query_ngrams), self._ngram_counts[pos])]
+        return [self.names[pos] for pos in sorted(selected)]
+
+    def resolve(self, suc_clean: str) -> Optional[Tuple[str, str]]:
+        return self.by_clean.get(suc_clean)
+
+# ==============================================================================
+# --- Lectura Única del Libro ---
+# ==============================================================================
+def _sheet_has_formulas(df: pd.DataFrame, value_columns: List[str]) -> bool:
+    """Indica si alguna de las columnas requeridas trae fórmulas en lugar de valores."""
+    cols = [col for col in df.columns if str(col).strip() in value_columns]
+    for col in cols:
+        if df[col].map(lambda v: isinstance(v, str) and v.startswith('=')).any(): return True
+    return False
+
+_XLSX_NS = {'main': 'http://schemas.openxmlformats.org/spreadsheetml/2006/main',
+            'r': 'http://schemas.openxmlformats.org/officeDocument/2006/relationships',
+            'rel': 'http://schemas.openxmlformats.org/package/2006/relationships'}
+EMPTY_WORKSHEET_XML = f'<worksheet xmlns="{_XLSX_NS["main"]}"><sheetData/></worksheet>'.encode('utf-8')
+
+def _package_without_sheet_rows(excel_path: str, sheet_names: Tuple[str, ...]) -> io.BytesIO:
+    """
+    Copia en memoria del paquete .xlsx con las hojas indicadas vacías: openpyxl abre el resto
+    en modo edición sin parsear ni conservar las celdas de esas hojas.
+    """
+    with zipfile.ZipFile(excel_path) as package:
+        workbook_xml = ET.fromstring(package.read('xl/workbook.xml'))
+        rel_ids = {sheet.get('name'): sheet.get(f"{{{_XLSX_NS['r']}}}id") for sheet in workbook_xml.iter(f"{{{_XLSX_NS['main']}}}sheet")}
+        rels_xml = ET.fromstring(package.read('xl/_rels/workbook.xml.rels'))
+        targets = {rel.get('Id'): rel.get('Target') for rel in rels_xml.iter(f"{{{_XLSX_NS['rel']}}}Relationship")}
+        blank_parts = set()
+        for name in sheet_names:
+            target = targets.get(rel_ids.get(name))
+            if target: blank_parts.add(target.lstrip('/') if target.startswith('/') else posixpath.normpath(posixpath.join('xl', target)))
+        buffer = io.BytesIO()
+        with zipfile.ZipFile(buffer, 'w', zipfile.ZIP_STORED) as copy: # Sin comprimir: solo lo lee openpyxl a continuación
+            for info in package.infolist():
+                copy.writestr(info.filename, EMPTY_WORKSHEET_XML if info.filename in blank_parts else package.read(info.filename))
+    buffer.seek(0)
+    return buffer
+
+def load_workbook_sheets(excel_path: str, skip_sheets: Tuple[str, ...] = (),
+                         blank_sheets: Tuple[str, ...] = ()) -> Tuple[openpyxl.workbook.workbook.Workbook, Dict[str, Optional[pd.DataFrame]]]:
+    """
+    Abre el libro UNA sola vez con openpyxl y extrae todas las hojas de
+    WORKBOOK_SHEETS_TO_READ (salvo skip_sheets) como DataFrames (mismo parseo que pd.read_excel).
+    El mismo objeto Workbook se reutiliza después para escribir la hoja destino.
+    Las hojas de blank_sheets se abren vacías (sus celdas no se cargan): el libro
+    resultante ya no puede re-guardarse completo.
+
+    Returns:
+        (workbook, {nombre_hoja: DataFrame o None si la hoja no existe})
+    """
+    start_time = time.perf_counter()
+    workbook = openpyxl.load_workbook(_package_without_sheet_rows(excel_path, blank_sheets) if blank_sheets else excel_path)
+    print(f"Libro '{os.path.basename(excel_path)}' abierto en {time.perf_counter() - start_time:.2f}s ({len(workbook.sheetnames)} hojas"
+          + (f", sin las filas de {', '.join(blank_sheets)})." if blank_sheets else ")."))
+    sheets: Dict[str, Optional[pd.DataFrame]] = {}
+    excel_file = pd.ExcelFile(workbook, engine='openpyxl')
+    for sheet_name, skiprows in WORKBOOK_SHEETS_TO_READ.items():
+        if sheet_name in skip_sheets or sheet_name in blank_sheets: continue
+        sheet_start = time.perf_counter()
+        if sheet_name not in workbook.sheetnames: print(f"  - Hoja '{sheet_name}': no encontrada."); sheets[sheet_name] = None; continue
+        df_sheet = pd.read_excel(excel_file, sheet_name=sheet_name, skiprows=skiprows)
+        if _sheet_has_formulas(df_sheet, WORKBOOK_SHEET_VALUE_COLUMNS.get(sheet_name, [])):
+            # openpyxl (modo edición) no expone valores calculados: releer solo esta hoja con valores
+            print(f"  - Hoja '{sheet_name}': contiene fórmulas en columnas requeridas, releyendo valores calculados...")
+            df_sheet = pd.read_excel(excel_path, sheet_name=sheet_name, skiprows=skiprows)
+        sheets[sheet_name] = df_sheet
+        print(f"  - Hoja '{sheet_name}': {len(df_sheet)} filas extraídas en {time.perf_counter() - sheet_start:.2f}s.")
+    print(f"Lectura total del libro: {time.perf_counter() - start_time:.2f}s.")
+    return workbook, sheets
+
+def _excel_cell_value(cell) -> Any:
+    """Misma conversión de celda que el lector openpyxl de pandas (vacío -> '', error -> NaN, enteros exactos -> int)."""
+    if cell.value is None: return ""
+    if cell.data_type == 'e': return np.nan
+    if cell.data_type == 'n':
+        as_int = int(cell.value)
+        return as_int if as_int == cell.value else float(cell.value)
+    return cell.value
+
+# Textos que pd.read_excel convierte en NaN con sus na_values por defecto
+EXCEL_NA_STRINGS = frozenset({"", "#N/A", "#N/A N/A", "#NA", "-1.#IND", "-1.#QNAN", "-NaN", "-nan", "1.#IND", "1.#QNAN",
+                              "<NA>", "N/A", "NA", "NULL", "NaN", "None", "n/a", "nan", "null"})
+
+def _frame_columns(header: List[Any], width: int) -> List[Any]:
+    """Nombres de columna como los de pd.read_excel: vacíos -> 'Unnamed: N', repetidos -> 'X.1', 'X.2'..."""
+    columns: List[Any] = []; used = set()
+    for pos in range(width):
+        name = header[pos] if pos < len(header) and header[pos] != "" else f"Unnamed: {pos}"; candidate = name; repeat = 0
+        while candidate in used: repeat += 1; candidate = f"{name}.{repeat}"
+        used.add(candidate); columns.append(candidate)
+    return columns
+
+def _infer_excel_column(values: pd.Series) -> pd.Series:
+    """Misma inferencia por columna que pd.read_excel: si todo lo no nulo es numérico (o texto numérico) -> número; si no, infer_objects."""
+    values = values.mask(values.map(lambda v: isinstance(v, str) and v in EXCEL_NA_STRINGS), np.nan)
+    numeric = pd.to_numeric(values, errors='coerce')
+    if numeric.notna().sum() == values.notna().sum() and not values.map(lambda v: isinstance(v, datetime)).any(): return numeric
+    return values.infer_objects()
+
+def _rows_to_frame(header: List[Any], rows: List[List[Any]]) -> pd.DataFrame:
+    """Arma un DataFrame con las mismas columnas, nulos y tipos que pd.read_excel daría para esas filas."""
+    width = max([len(header)] + [len(row) for row in rows])
+    df = pd.DataFrame([row + [""] * (width - len(row)) for row in rows], columns=_frame_columns(header, width), dtype=object)
+    return pd.DataFrame({col: _infer_excel_column(df[col]) for col in df.columns}, index=df.index)
+
+def read_source_header(excel_path: str) -> Tuple[List[str], int]:
+    """
+    Encabezados de WEB2.0 y filas de datos estimadas (según la dimensión declarada en la hoja),
+    con un libro de solo lectura.
+
+    Raises:
+        KeyError: si el libro no tiene la hoja fuente.
+    """
+    source_workbook = openpyxl.load_workbook(excel_path, read_only=True, data_only=True)
+    try:
+        worksheet = source_workbook[SOURCE_SHEET_NAME]
+        header = next(worksheet.iter_rows(max_row=1, values_only=True), ())
+        return [str(value) for value in header if value is not None], max(0, (worksheet.max_row or 1) - 1)
+    finally: source_workbook.close()
+
+def iter_source_chunks(excel_path: str, chunk_rows: int = SOURCE_CHUNK_ROWS) -> Iterator[pd.DataFrame]:
+    """
+    Recorre WEB2.0 fila a fila con un libro de solo lectura (valores calculados) y entrega
+    DataFrames de hasta chunk_rows filas; nunca se materializa la hoja completa.
+    Cada bloque tiene los tipos que pd.read_excel daría a esas filas (p. ej. una columna de
+    texto numérico se lee como número solo en los bloques donde todo su texto es numérico).
+
+    Raises:
+        KeyError: si el libro no tiene la hoja fuente.
+    """
+    source_workbook = openpyxl.load_workbook(excel_path, read_only=True, data_only=True)
+    try:
+        worksheet = source_workbook[SOURCE_SHEET_NAME]; worksheet.reset_dimensions()
+        rows = worksheet.iter_rows(); header: Optional[List[Any]] = None; buffer: List[List[Any]] = []; blank_rows = 0
+        for row in rows:
+            values = [_excel_cell_value(cell) for cell in row]
+            while values and values[-1] == "": values.pop()
+            if header is None:
+                header = values; continue
+            # Las filas en blanco solo cuentan si hay datos después (pd.read_excel descarta las finales)
+            if not values: blank_rows += 1; continue
+            buffer.extend([[]] * blank_rows); blank_rows = 0; buffer.append(values)
+            if len(buffer) >= chunk_rows:
+                chunk = _rows_to_frame(header, buffer); buffer = []
+                if len(chunk): yield chunk
+        if header is not None and buffer:
+            chunk = _rows_to_frame(header, buffer)
+            if len(chunk): yield chunk
+    finally: source_workbook.close()
+
 # ==============================================================================
 # --- Funciones de Lectura y Preparación de Lookups ---
-# (Sin cambios)
 # ==============================================================================
-def load_sucursal_lookup(excel_path: str) -> Tuple[Dict[str, str], List[Tuple[str, str, str]], List[str], Dict[str, Tuple[str, str]]]:
+def load_sucursal_lookup(df_suc: Optional[pd.DataFrame]) -> Tuple[Dict[str, str], List[Tuple[str, str, str]], List[str], Dict[str, Tuple[str, str]], SucursalMatchIndex]:
     sucursal_map_by_client = {}
     sucursal_deudor_data = []
     sucursal_names_clean = []
     deudor_map_self_match = {}
+    if df_suc is None: print(f"Error: No se encontró hoja '{LOOKUP_SUCURSAL_SHEET_NAME}'."); return {}, [], [], {}, SucursalMatchIndex([], [])
     try:
-        df_suc = pd.read_excel(excel_path, sheet_name=LOOKUP_SUCURSAL_SHEET_NAME)
+        df_suc = df_suc.copy()
         print(f"Datos leídos de '{LOOKUP_SUCURSAL_SHEET_NAME}' ({len(df_suc)} filas).")
         df_suc.columns = df_suc.columns.str.strip()
         required_cols = [LKP_SUC_CLIENTE, LKP_SUC_SUCURSAL, LKP_SUC_DEUDOR]
         missing_cols = [col for col in required_cols if col not in df_suc.columns]
-        if missing_cols: print(f"Advertencia: Faltan columnas en '{LOOKUP_SUCURSAL_SHEET_NAME}': {missing_cols}."); return {}, [], [], {}
+        if missing_cols: print(f"Advertencia: Faltan columnas en '{LOOKUP_SUCURSAL_SHEET_NAME}': {missing_cols}."); return {}, [], [], {}, SucursalMatchIndex([], [])
 
-        df_suc['cli_key_clean_part1'] = df_suc[LKP_SUC_CLIENTE].apply(lambda x: clean_client_name_part(str(x).split('-', maxsplit=1)[0]))
-        df_suc['suc_key_clean'] = df_suc[LKP_SUC_SUCURSAL].apply(clean_text_for_comparison)
+        df_suc['cli_key_clean_part1'] = normalize_client_part1_series(df_suc[LKP_SUC_CLIENTE])
+        df_suc['suc_key_clean'] = normalize_text_series(df_suc[LKP_SUC_SUCURSAL])
         df_suc['deudor_code_safe'] = df_suc[LKP_SUC_DEUDOR].apply(safe_str_conversion)
         df_suc['sucursal_original_safe'] = df_suc[LKP_SUC_SUCURSAL].apply(lambda x: str(x).strip())
         df_suc_valid = df_suc[(df_suc['deudor_code_safe'] != '') & (df_suc[LKP_SUC_SUCURSAL].notna()) & (df_suc['sucursal_original_safe'] != '')].copy()
-        if df_suc_valid.empty: print("Advertencia: No se encontraron filas válidas en sucursales."); return {}, [], [], {}
+        if df_suc_valid.empty: print("Advertencia: No se encontraron filas válidas en sucursales."); return {}, [], [], {}, SucursalMatchIndex([], [])
 
         df_suc_valid['is_self_match'] = df_suc_valid.apply(lambda row: str(row[LKP_SUC_CLIENTE]).strip().upper() == str(row[LKP_SUC_SUCURSAL]).strip().upper(), axis=1)
         self_matching_rows = df_suc_valid[df_suc_valid['is_self_match']].copy()
@@ -196,21 +633,22 @@ def load_sucursal_lookup(excel_path: str) -> Tuple[Dict[str, str], List[Tuple[st
         sucursal_names_clean = fuzzy_match_rows['suc_key_clean'].unique().tolist()
         print(f" -> Lista para Fuzzy Match (Sucursal P2) creada con {len(sucursal_deudor_data)} entradas.")
         print(f" -> Nombres de Sucursal únicos para Fuzzy Match: {len(sucursal_names_clean)}.")
-    except FileNotFoundError: print(f"Error: No se encontró Excel en '{excel_path}'.")
-    except ValueError as ve: print(f"Error: No se encontró hoja '{LOOKUP_SUCURSAL_SHEET_NAME}'. {ve}")
     except Exception as e: print(f"Error procesando '{LOOKUP_SUCURSAL_SHEET_NAME}': {e}"); traceback.print_exc()
-    return sucursal_map_by_client, sucursal_deudor_data, sucursal_names_clean, deudor_map_self_match
+    sucursal_index = SucursalMatchIndex(sucursal_deudor_data, sucursal_names_clean)
+    print(f" -> Índice de sucursales creado: {len(sucursal_index.by_clean)} claves hash para {len(sucursal_index.names)} nombres.")
+    return sucursal_map_by_client, sucursal_deudor_data, sucursal_names_clean, deudor_map_self_match, sucursal_index
 
-def load_sap_lookups(excel_path: str) -> Tuple[Dict[str, str], List[str], Dict[str, str], List[str]]:
+def load_sap_lookups(df_csap1: Optional[pd.DataFrame], df_csap2: Optional[pd.DataFrame]) -> Tuple[Dict[str, str], List[str], Dict[str, str], List[str]]:
     codigosap_map1: Dict[str, str] = {}; csap1_keys: List[str] = []
     codigosap_map2: Dict[str, str] = {}; csap2_keys: List[str] = []
     try:
-        df_csap1 = pd.read_excel(excel_path, sheet_name=LOOKUP_CSAP1_SHEET_NAME, skiprows=SKIPROWS_CSAP1)
+        if df_csap1 is None: raise ValueError(LOOKUP_CSAP1_SHEET_NAME)
+        df_csap1 = df_csap1.copy()
         print(f"Datos leídos de '{LOOKUP_CSAP1_SHEET_NAME}' ({len(df_csap1)} filas).")
         df_csap1.columns = df_csap1.columns.str.strip()
         if LKP_CSAP1_ITEM in df_csap1.columns and LKP_CSAP1_CODIGO in df_csap1.columns:
             print(f"Preparando mapa SAP primario ('{LKP_CSAP1_ITEM}' -> '{LKP_CSAP1_CODIGO}')...")
-            df_csap1['map_key'] = df_csap1[LKP_CSAP1_ITEM].apply(clean_text_for_comparison)
+            df_csap1['map_key'] = normalize_text_series(df_csap1[LKP_CSAP1_ITEM])
             df_csap1['sap_code_safe'] = df_csap1[LKP_CSAP1_CODIGO].apply(safe_str_conversion)
             temp_map1 = df_csap1[(df_csap1['map_key'] != '') & (df_csap1['sap_code_safe'] != '') & (df_csap1['sap_code_safe'].str.lower() != 'nan')].dropna(subset=['map_key', 'sap_code_safe'])
             codigosap_map1 = temp_map1.drop_duplicates(subset=['map_key'], keep='first').set_index('map_key')['sap_code_safe'].to_dict()
@@ -220,14 +658,15 @@ def load_sap_lookups(excel_path: str) -> Tuple[Dict[str, str], List[str], Dict[s
     except ValueError: print(f"Advertencia: No se encontró hoja '{LOOKUP_CSAP1_SHEET_NAME}'.")
     except Exception as e: print(f"Error procesando {LOOKUP_CSAP1_SHEET_NAME}: {e}")
     try:
-        df_csap2 = pd.read_excel(excel_path, sheet_name=LOOKUP_CSAP2_SHEET_NAME, skiprows=SKIPROWS_CSAP2)
+        if df_csap2 is None: raise ValueError(LOOKUP_CSAP2_SHEET_NAME)
+        df_csap2 = df_csap2.copy()
         print(f"Datos leídos de '{LOOKUP_CSAP2_SHEET_NAME}' ({len(df_csap2)} filas).")
         df_csap2.columns = df_csap2.columns.str.strip()
         required_cols = [LKP_CSAP2_NOMBRE, LKP_CSAP2_CODIGO, LKP_CSAP2_CORRIENTE]
         if all(col in df_csap2.columns for col in required_cols):
             print(f"Preparando mapa SAP secundario ('{LKP_CSAP2_NOMBRE}' limpio -> '{LKP_CSAP2_CODIGO}')...")
             df_csap2['sap_code_safe'] = df_csap2[LKP_CSAP2_CODIGO].apply(safe_str_conversion)
-            df_csap2['map_key'] = df_csap2.apply(lambda row: clean_sap_material_name(row, LKP_CSAP2_NOMBRE, LKP_CSAP2_CORRIENTE), axis=1)
+            df_csap2['map_key'] = normalize_sap_material_frame(df_csap2, LKP_CSAP2_NOMBRE, LKP_CSAP2_CORRIENTE)
             temp_map2 = df_csap2[(df_csap2['map_key'] != '') & (df_csap2['sap_code_safe'] != '') & (df_csap2['sap_code_safe'].str.lower() != 'nan')].dropna(subset=['map_key', 'sap_code_safe'])
             codigosap_map2 = temp_map2.drop_duplicates(subset=['map_key'], keep='first').set_index('map_key')['sap_code_safe'].to_dict()
             csap2_keys = temp_map2['map_key'].unique().tolist()
@@ -237,18 +676,311 @@ def load_sap_lookups(excel_path: str) -> Tuple[Dict[str, str], List[str], Dict[s
     except Exception as e: print(f"Error procesando {LOOKUP_CSAP2_SHEET_NAME}: {e}")
     return codigosap_map1, csap1_keys, codigosap_map2, csap2_keys
 
+# ==============================================================================
+# --- Caché Persistente de Lookups ---
+# ==============================================================================
+def fingerprint_sheet(df: Optional[pd.DataFrame]) -> str:
+    """Huella SHA-256 del contenido de una hoja (encabezados + valores)."""
+    if df is None: return "missing"
+    digest = hashlib.sha256()
+    digest.update(repr([str(col) for col in df.columns]).encode('utf-8'))
+    digest.update(pd.util.hash_pandas_object(df, index=False).values.tobytes())
+    return digest.hexdigest()
+
+def _lookup_settings_fingerprint() -> str:
+    """Parámetros de código que también afectan los lookups preparados."""
+    return repr((LOOKUP_CACHE_VERSION, SUCURSAL_BLOCKING_NGRAM_SIZE, SUCURSAL_BLOCKING_MIN_SHARED_RATIO))
+
+def lookup_cache_path_for(excel_path: str, cache_key: str, fingerprint: tuple) -> str:
+    """Archivo de caché para un tipo de lookup y la huella de sus hojas: libros con hojas distintas no se pisan."""
+    digest = hashlib.sha256(repr(fingerprint).encode('utf-8')).hexdigest()[:16]
+    return os.path.join(os.path.dirname(os.path.abspath(excel_path)), f"{LOOKUP_CACHE_PREFIX}{cache_key}_{digest}.pkl")
+
+def _read_lookup_cache(cache_path: str) -> Optional[Dict[str, Any]]:
+    if not os.path.exists(cache_path): return None
+    try:
+        with open(cache_path, 'rb') as f: entry = pickle.load(f)
+        return entry if isinstance(entry, dict) else None
+    except Exception as e: print(f"Advertencia(cache): No se pudo leer '{cache_path}': {e}. Se reconstruirá."); return None
+
+def _write_lookup_cache(cache_path: str, entry: Dict[str, Any]):
+    tmp_path = f"{cache_path}.{os.getpid()}.tmp" # Único por proceso; os.replace deja el archivo completo o el anterior
+    try:
+        with open(tmp_path, 'wb') as f: pickle.dump(entry, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, cache_path)
+    except Exception as e:
+        print(f"Advertencia(cache): No se pudo escribir '{cache_path}': {e}")
+        if os.path.exists(tmp_path): os.remove(tmp_path)
+        return
+    cache_files = sorted(glob.glob(os.path.join(os.path.dirname(cache_path), f"{LOOKUP_CACHE_PREFIX}*.pkl")), key=os.path.getmtime)
+    for old_path in cache_files[:-LOOKUP_CACHE_MAX_FILES]:
+        try: os.remove(old_path)
+        except OSError: pass
+
+def load_lookups_cached(excel_path: str, workbook_sheets: Dict[str, Optional[pd.DataFrame]]) -> Tuple[tuple, tuple]:
+    """
+    Devuelve los resultados de load_sucursal_lookup y load_sap_lookups, reutilizando
+    la versión preparada en disco cuando existe una para la misma huella de hojas de lookup.
+
+    Returns:
+        (resultado_sucursales, resultado_sap) con la misma forma que las funciones originales.
+    """
+    df_suc = workbook_sheets.get(LOOKUP_SUCURSAL_SHEET_NAME)
+    df_csap1 = workbook_sheets.get(LOOKUP_CSAP1_SHEET_NAME); df_csap2 = workbook_sheets.get(LOOKUP_CSAP2_SHEET_NAME)
+    if not USE_LOOKUP_CACHE:
+        return load_sucursal_lookup(df_suc), load_sap_lookups(df_csap1, df_csap2)
+
+    settings = _lookup_settings_fingerprint()
+    fingerprints = {
+        'sucursal': (settings, fingerprint_sheet(df_suc)),
+        'sap': (settings, fingerprint_sheet(df_csap1), fingerprint_sheet(df_csap2)),
+    }
+    builders = {
+        'sucursal': lambda: load_sucursal_lookup(df_suc),
+        'sap': lambda: load_sap_lookups(df_csap1, df_csap2),
+    }
+    results: Dict[str, tuple] = {}
+    for cache_key, fingerprint in fingerprints.items():
+        cache_path = lookup_cache_path_for(excel_path, cache_key, fingerprint)
+        entry = _read_lookup_cache(cache_path)
+        if entry and entry.get('fingerprint') == fingerprint:
+            results[cache_key] = entry['data']; print(f"Caché de lookups: '{cache_key}' reutilizado (sin cambios en la hoja).")
+        else:
+            print(f"Caché de lookups: '{cache_key}' no existe para estas hojas, reconstruyendo...")
+            results[cache_key] = builders[cache_key]()
+            if LOOKUP_CACHE_WRITE: _write_lookup_cache(cache_path, {'fingerprint': fingerprint, 'data': results[cache_key]})
+    return results['sucursal'], results['sap']
+
+# ==============================================================================
+# --- Almacén Persistente de Decisiones SAP Manuales ---
+# ==============================================================================
+class SapDecisionStore:
+    """
+    Decisiones del operador (residuo -> código SAP u omitir) guardadas en JSON con
+    fecha, para no volver a preguntar lo mismo en ejecuciones posteriores.
+    La clave es el residuo normalizado con clean_text_for_comparison.
+    """
+    def __init__(self, path: Optional[str]):
+        self.path = path
+        self.decisions: Dict[str, Dict[str, Any]] = {}
+        if path and os.path.exists(path):
+            try:
+                with open(path, 'r', encoding='utf-8') as f: self.decisions = json.load(f).get('decisions', {})
+                print(f"Decisiones SAP guardadas cargadas: {len(self.decisions)} ('{path}').")
+            except Exception as e: print(f"Advertencia(decisiones SAP): No se pudo leer '{path}': {e}. Se inicia vacío.")
+
+    @staticmethod
+    def key_for(residuo: Any) -> str:
+        return clean_text_for_comparison(residuo)
+
+    def get(self, residuo: Any) -> Optional[str]:
+        """Código SAP elegido, SAP_DECISION_SKIP si se omitió, o None si no hay decisión."""
+        entry = self.decisions.get(self.key_for(residuo))
+        return entry.get('sap_code') if entry else None
+
+    def selected_codes(self) -> Dict[str, str]:
+        return {key: e['sap_code'] for key, e in self.decisions.items() if e.get('sap_code') and e['sap_code'] != SAP_DECISION_SKIP}
+
+    def skipped_keys(self) -> set:
+        return {key for key, e in self.decisions.items() if e.get('sap_code') == SAP_DECISION_SKIP}
+
+    def record(self, residuo_name: str, sap_code: str):
+        key = self.key_for(residuo_name)
+        if not key: return
+        self.decisions[key] = {'residuo': residuo_name, 'sap_code': sap_code, 'timestamp': datetime.now().isoformat(timespec='seconds')}
+        self.save()
+
+    def save(self):
+        if not self.path: return
+        tmp_path = f"{self.path}.{os.getpid()}.tmp"
+        try:
+            with open(tmp_path, 'w', encoding='utf-8') as f: json.dump({'version': 1, 'decisions': self.decisions}, f, ensure_ascii=False, indent=1)
+            os.replace(tmp_path, self.path)
+        except Exception as e: print(f"Advertencia(decisiones SAP): No se pudo guardar '{self.path}': {e}")
+
+def load_sap_decision_store() -> SapDecisionStore:
+    return SapDecisionStore(SAP_DECISION_STORE_PATH if USE_SAP_DECISION_STORE else None)
+
+# ==============================================================================
+# --- Motor de Coincidencia Difusa por Lotes (SAP) ---
+# ==============================================================================
+SAP_TIER_DECISION = 'decision'; SAP_TIER_MAP1 = 'map1'; SAP_TIER_MAP2 = 'map2'
+MATCH_METHOD_EXACT = 'exact'; MATCH_METHOD_FUZZY = 'fuzzy'
+
+def _fuzzy_process_choice(text: str) -> str:
+    """Equivalente al procesador que thefuzz aplica a cada opción (full_process + ASCII)."""
+    return fuzz_utils.full_process(text, force_ascii=True)
+
+def _fuzzy_process_query(text: str) -> str:
+    """Equivalente al doble procesamiento que thefuzz.extractOne aplica a la consulta."""
+    return fuzz_utils.full_process(fuzz_utils.full_process(text), force_ascii=True)
+
+class ExactKeyIndex:
+    """
+    Índice hash de las opciones según la forma en que las compara el scorer difuso:
+    texto procesado -> primera opción. Equivale exactamente a un puntaje difuso de 100
+    (WRatio solo da 100 con textos procesados idénticos, y extractOne devuelve el primero).
+    No hay nivel de tokens ordenados: otra opción puede puntuar más (una variante de un
+    carácter) o empatar antes en la lista, así que no equivale al resultado difuso.
+    """
+    def __init__(self, choice_keys: List[str]):
+        self.processed: Dict[str, str] = {}
+        for key in choice_keys:
+            processed = _fuzzy_process_choice(key)
+            if processed: self.processed.setdefault(processed, key)
+
+    def lookup(self, query_key: str) -> Optional[Tuple[str, int, str]]:
+        """(opción, 100, MATCH_METHOD_EXACT) si la consulta coincide por hash exacto; si no, None."""
+        processed = _fuzzy_process_query(query_key)
+        if processed and processed in self.processed: return self.processed[processed], 100, MATCH_METHOD_EXACT
+        return None
+
+def tiered_best_matches(query_keys: List[str], choice_keys: List[str], score_cutoff: float) -> Dict[str, Tuple[str, int, str]]:
+    """
+    Resolución por niveles: el hash exacto resuelve sin puntaje difuso; el resto pasa por
+    la matriz difusa de batch_best_matches, por lo que el resultado es idéntico al de la
+    ruta solo difusa.
+
+    Returns:
+        Diccionario consulta -> (opción, puntaje, método MATCH_METHOD_*).
+    """
+    if not query_keys or not choice_keys: return {}
+    exact_index = ExactKeyIndex(choice_keys)
+    matches: Dict[str, Tuple[str, int, str]] = {}; pending: List[str] = []
+    for query in query_keys:
+        hit = exact_index.lookup(query)
+        if hit and hit[1] >= score_cutoff: matches[query] = hit
+        else: pending.append(query)
+    for query, (choice, score) in batch_best_matches(pending, choice_keys, score_cutoff).items():
+        matches[query] = (choice, score, MATCH_METHOD_FUZZY)
+    return matches
+
+def batch_best_matches(query_keys: List[str], choice_keys: List[str], score_cutoff: float) -> Dict[str, Tuple[str, int]]:
+    """
+    Calcula con rapidfuzz.cdist, por bloques de FUZZY_CDIST_CHUNK_ROWS consultas, la mejor
+    opción para cada consulta; de cada bloque solo se conservan el índice y el puntaje máximos.
+    Reproduce el resultado de process.extractOne (scorer WRatio, primer máximo en caso de
+    empate, puntaje redondeado a entero).
+
+    Returns:
+        Diccionario consulta -> (opción, puntaje) solo para consultas con puntaje >= score_cutoff.
+    """
+    if not query_keys or not choice_keys: return {}
+    processed_queries = [_fuzzy_process_query(q) for q in query_keys]
+    processed_choices = [_fuzzy_process_choice(c) for c in choice_keys]
+    best_idx = np.empty(len(query_keys), dtype=np.intp); best_scores = np.empty(len(query_keys), dtype=np.float64)
+    for start in range(0, len(query_keys), FUZZY_CDIST_CHUNK_ROWS):
+        stop = min(start + FUZZY_CDIST_CHUNK_ROWS, len(query_keys))
+        score_matrix = rf_process.cdist(processed_queries[start:stop], processed_choices, scorer=rf_fuzz.WRatio,
+                                        dtype=np.float64, score_cutoff=score_cutoff, workers=FUZZY_CDIST_WORKERS)
+        best_idx[start:stop] = score_matrix.argmax(axis=1)
+        best_scores[start:stop] = score_matrix[np.arange(stop - start), best_idx[start:stop]]
+    matches: Dict[str, Tuple[str, int]] = {}
+    for query, choice_idx, score in zip(query_keys, best_idx, best_scores):
+        if score >= score_cutoff: matches[query] = (choice_keys[choice_idx], int(round(score)))
+    return matches
+
+def batch_match_sap_codes(residuo_keys: pd.Series,
+                          sap_map1: Dict[str, str], sap_keys1: List[str],
+                          sap_map2: Dict[str, str], sap_keys2: List[str],
+                          stored_codes: Optional[Dict[str, str]] = None) -> pd.DataFrame:
+    """
+    Resuelve el código SAP de todos los residuos de una vez: deduplica las claves,
+    aplica primero las decisiones manuales guardadas (stored_codes), compara el resto
+    contra la lista primaria y, solo las que no encontraron código, contra la secundaria.
+    El resultado se difunde a las filas originales.
+
+    Returns:
+        DataFrame con el mismo índice que residuo_keys y columnas 'sap_code', 'sap_score'
+        'sap_from_decision' (True si el código viene de una decisión manual guardada) y
+        'sap_tier' (SAP_TIER_DECISION, SAP_TIER_MAP1, SAP_TIER_MAP2 o "" sin código) y
+        'sap_method' (MATCH_METHOD_* con que se encontró el código en la lista, o "").
+    """
+    stored_codes = stored_codes or {}
+    key_codes, key_uniques = pd.factorize(residuo_keys, use_na_sentinel=False)
+    all_keys = [k for k in key_uniques if isinstance(k, str)]
+    from_decision = {k for k in all_keys if k in stored_codes}
+    resolved: Dict[str, Tuple[str, int]] = {k: (stored_codes[k], 100) for k in from_decision}
+    tiers: Dict[str, str] = {k: SAP_TIER_DECISION for k in from_decision}; methods: Dict[str, str] = {}
+    unique_keys = [k for k in all_keys if k not in from_decision]
+    for key, (matched_key, score, method) in tiered_best_matches(unique_keys, sap_keys1, FUZZY_SAP_SIMILARITY_THRESHOLD).items():
+        resolved[key] = (sap_map1.get(matched_key, ""), score); tiers[key] = SAP_TIER_MAP1; methods[key] = method
+    pending_keys = [k for k in unique_keys if not resolved.get(k, ("", 0))[0]]
+    for key, (matched_key, score, method) in tiered_best_matches(pending_keys, sap_keys2, FUZZY_SAP_SIMILARITY_THRESHOLD).items():
+        resolved[key] = (sap_map2.get(matched_key, ""), score); tiers[key] = SAP_TIER_MAP2; methods[key] = method
+    found_methods = [methods[k] for k in unique_keys if resolved.get(k, ("", 0))[0]]
+    print(f"Niveles SAP (residuos únicos): exacto {found_methods.count(MATCH_METHOD_EXACT)}, difuso {found_methods.count(MATCH_METHOD_FUZZY)}.")
+    if from_decision: print(f"Decisiones SAP guardadas aplicadas a {len(from_decision)} residuos únicos (sin búsqueda difusa).")
+    print(f"Coincidencia SAP por lotes: {len(unique_keys)} residuos únicos ({len(residuo_keys)} filas), {sum(1 for k in unique_keys if resolved.get(k, ('', 0))[0])} con código.")
+    # Una fila de resultado por clave distinta, difundida a las filas con sus códigos
+    per_key = pd.DataFrame([(code, score, k in from_decision, tiers.get(k, "") if code else "", methods.get(k, "") if code else "")
+                            for k in key_uniques for code, score in [resolved.get(k, ("", 0))]],
+                           columns=['sap_code', 'sap_score', 'sap_from_decision', 'sap_tier', 'sap_method'])
+    result = per_key.iloc[key_codes].reset_index(drop=True); result.index = residuo_keys.index
+    return result
+
 # ==============================================================================
 # --- Funciones Auxiliares del Proceso ---
 # ==============================================================================
-def prepare_sap_choices_for_popup(map1: Dict[str, str], map2: Dict[str, str]) -> List[str]:
+def _to_display_safe(text: str) -> str:
+    """Texto re-codificado con la codificación del sistema para que Tk pueda mostrarlo."""
+    try: return text.encode(sys.getfilesystemencoding(), 'replace').decode(sys.getfilesystemencoding(), 'replace')
+    except Exception: return text
+
+class SapPopupOptions:
+    """
+    Opciones del popup SAP preparadas una sola vez: texto seguro para Tk, texto de
+    búsqueda normalizado (minúsculas, sin tildes), índice de trigramas para filtrar por
+    subcadena sin recorrer toda la lista y nombres procesados para sugerencias difusas.
+    Se comporta como la lista ordenada de opciones (len, iteración, índice).
+    """
+    NGRAM_SIZE = 3
+
+    def __init__(self, choices: Dict[str, str]):
+        self.choices: Dict[str, str] = dict(choices)
+        self.options: List[str] = sorted(choices.keys())
+        self.display: List[str] = [_to_display_safe(text) for text in self.options]
+        self.search_texts: List[str] = normalize_text_series(pd.Series(self.options, dtype=object)).str.lower().tolist() if self.options else []
+        self._fuzzy_names: List[str] = [_fuzzy_process_choice(re.sub(r'\s*\([^)]*\)$', '', text)) for text in self.options]
+        self._postings: Dict[str, List[int]] = {}
+        for position, text in enumerate(self.search_texts):
+            for gram in {text[i:i + self.NGRAM_SIZE] for i in range(len(text) - self.NGRAM_SIZE + 1)}:
+                self._postings.setdefault(gram, []).append(position)
+
+    def __len__(self) -> int: return len(self.options)
+    def __iter__(self): return iter(self.options)
+    def __getitem__(self, position): return self.options[position]
+
+    def filter(self, search_term: str) -> List[int]:
+        """Posiciones (en orden alfabético) cuyas opciones contienen search_term, sin distinguir tildes/mayúsculas."""
+        term = clean_text_for_comparison(search_term).lower() if search_term else ""
+        if not term: return list(range(len(self.options)))
+        grams = [term[i:i + self.NGRAM_SIZE] for i in range(len(term) - self.NGRAM_SIZE + 1)]
+        if grams:
+            postings = sorted((self._postings.get(gram, []) for gram in set(grams)), key=len)
+            candidates = set(postings[0]).intersection(*postings[1:])
+            return [pos for pos in sorted(candidates) if term in self.search_texts[pos]]
+        return [pos for pos, text in enumerate(self.search_texts) if term in text]
+
+    def suggestions(self, residuo_name: str, limit: int) -> List[int]:
+        """Posiciones de las opciones más parecidas al residuo (WRatio), de mayor a menor puntaje."""
+        if not self.options or not residuo_name: return []
+        query = _fuzzy_process_query(clean_text_for_comparison(residuo_name))
+        ranked = rf_process.extract(query, self._fuzzy_names, scorer=rf_fuzz.WRatio, processor=None,
+                                    limit=limit, score_cutoff=POPUP_SUGGESTION_MIN_SCORE)
+        return [position for _, _, position in ranked]
+
+def prepare_sap_choices_for_popup(map1: Dict[str, str], map2: Dict[str, str]) -> SapPopupOptions:
     choices: Dict[str, str] = {}
     for item, code in map1.items():
         if item and code: display_text = f"{item} ({code})"; choices[display_text] = code
     for name, code in map2.items():
-         if name and code: display_text = f"{name} ({code})";
-         if display_text not in choices: choices[display_text] = code
-    print(f"Lista de opciones SAP para popup generada con {len(choices)} entradas únicas.")
-    return sorted(choices.keys())
+        if name and code:
+            display_text = f"{name} ({code})"
+            if display_text not in choices: choices[display_text] = code
+    options = SapPopupOptions(choices)
+    print(f"Lista de opciones SAP para popup generada con {len(options)} entradas únicas.")
+    return options
 
 def find_target_column_indices_with_duplicates(worksheet: openpyxl.worksheet.worksheet.Worksheet,
                                                cols_to_find: List[str]) -> Dict[str, List[int]]:
@@ -286,34 +1018,326 @@ def find_target_column_indices_with_duplicates(worksheet: openpyxl.worksheet.wor
     return target_col_indices
 
 
+def _cell_has_fill(cell) -> bool:
+    fill = getattr(cell, 'fill', None)
+    if fill is None: return False
+    pattern = getattr(fill, 'patternType', None)
+    if pattern is not None and pattern != 'none': return True
+    fill_type = getattr(fill, 'fill_type', None)
+    return fill_type is not None and fill_type != 'none'
+
+
+def _iter_cells_below(worksheet: openpyxl.worksheet.worksheet.Worksheet, first_row: int,
+                      col_indices: List[int], existing_only: bool) -> Tuple[Iterator[Any], int]:
+    """
+    Celdas de las columnas col_indices desde first_row hasta max_row, ordenadas por fila y columna,
+    junto con cuántas se van a revisar. Con existing_only usa el almacén de celdas existentes de
+    openpyxl si está disponible; si no (o si cambia su forma), recorre el rango con iter_rows.
+    """
+    col_set = set(col_indices); min_col, max_col = min(col_set), max(col_set)
+    store = getattr(worksheet, '_cells', None) if existing_only else None
+    if isinstance(store, dict):
+        coords = sorted(coord for coord in store if coord[0] >= first_row and coord[1] in col_set)
+        return (store[coord] for coord in coords), len(coords)
+    rows = worksheet.iter_rows(min_row=first_row, max_row=worksheet.max_row, min_col=min_col, max_col=max_col)
+    return (cell for row in rows for cell in row if cell.column in col_set), (worksheet.max_row - first_row + 1) * len(col_set)
+
 def cleanup_rows_below_data(worksheet: openpyxl.worksheet.worksheet.Worksheet,
                             last_written_row: int,
                             processed_col_indices: List[int]):
+    """
+    Borra valor y relleno de las columnas procesadas por debajo de last_written_row.
+    Con CLEANUP_EXISTING_CELLS_ONLY solo recorre las celdas que ya existen en la hoja
+    (las inexistentes ya se ven vacías), en lugar de crear y revisar filas × columnas.
+    """
     try:
         max_row_in_sheet = worksheet.max_row
         if not processed_col_indices: print("Advertencia(cleanup): No hay columnas para limpiar."); return
         if last_written_row < max_row_in_sheet:
             print(f"Limpiando datos/formato desde fila {last_written_row + 1} hasta {max_row_in_sheet}...")
-            rows_cleared = 0
-            for row_idx in range(last_written_row + 1, max_row_in_sheet + 1):
-                row_had_data = False
-                for col_idx in processed_col_indices:
-                    cell = worksheet.cell(row=row_idx, column=col_idx)
-                    has_fill = (hasattr(cell, 'fill') and cell.fill is not None and hasattr(cell.fill, 'patternType') and cell.fill.patternType is not None and cell.fill.patternType != 'none')
-                    if not has_fill and hasattr(cell, 'fill') and cell.fill is not None: has_fill = (hasattr(cell.fill, 'fill_type') and cell.fill.fill_type is not None and cell.fill.fill_type != 'none')
-                    if cell.value is not None or has_fill:
-                        if not row_had_data: rows_cleared += 1; row_had_data = True
-                        cell.value = None; cell.fill = HIGHLIGHT_NONE
-            print(f"Limpieza de {rows_cleared} filas antiguas completada.")
+            t_start = time.perf_counter(); full_scan_cells = (max_row_in_sheet - last_written_row) * len(set(processed_col_indices))
+            cells_iter, cells_visited = _iter_cells_below(worksheet, last_written_row + 1, processed_col_indices, CLEANUP_EXISTING_CELLS_ONLY)
+            rows_with_data = set()
+            for cell in cells_iter:
+                if cell.value is not None or _cell_has_fill(cell):
+                    rows_with_data.add(cell.row); cell.value = None; cell.fill = HIGHLIGHT_NONE
+            elapsed = time.perf_counter() - t_start
+            print(f"Limpieza de {len(rows_with_data)} filas antiguas completada en {elapsed:.2f}s "
+                  f"({cells_visited} celdas revisadas; recorrido completo: {full_scan_cells}, evitadas: {full_scan_cells - cells_visited}).")
         else: print("No se requiere limpieza de filas antiguas.")
     except Exception as e: print(f"Advertencia(cleanup): Error durante limpieza: {e}"); traceback.print_exc()
 
+# ==============================================================================
+# --- Cálculo por Columnas y Escritura en Bloque (Hoja Destino) ---
+# ==============================================================================
+def _format_fecha_value(value: Any) -> Any:
+    if isinstance(value, pd.Timestamp):
+        try: return value.strftime('%Y-%m-%d')
+        except ValueError: return ""
+    return value
+
+SUC_TIER_EXACT_PART2 = 'exact_part2'; SUC_TIER_FUZZY_PART2 = 'fuzzy_part2'
+SUC_TIER_CLIENT_EQ_SUCURSAL = 'client_eq_sucursal'
+SUC_TIER_FALLBACK = 'fallback'; SUC_TIER_NONE = 'none'
+
+class SucursalMatch(NamedTuple):
+    sucursal: str
+    deudor: str
+    tier: str
+    score: int = 0
+
+def resolve_sucursal_deudor(client_key_part1: str, client_key_part2: str,
+                            suc_match_index: SucursalMatchIndex,
+                            deudor_map_priority: Dict[str, Tuple[str, str]],
+                            sucursal_map_fallback: Dict[str, str],
+                            resolve_deudor: bool, resolve_sucursal: bool) -> SucursalMatch:
+    """
+    Cascada de búsqueda Sucursal / Código Deudor (PRIORIDAD INVERTIDA):
+    1) Parte 2 del cliente contra los nombres de sucursal: hash exacto y, si no hubo, fuzzy;
+    2) Cliente == Sucursal, 3) Fallback por cliente.
+    Depende solo de las dos claves del cliente, por lo que puede memorizarse por par de claves.
+
+    Returns:
+        SucursalMatch; sucursal y deudor vacíos si no hubo coincidencia.
+    """
+    # Prioridad 1: Fuzzy Parte 2
+    if resolve_deudor and client_key_part2 and suc_match_index.names:
+        exact_hit = suc_match_index.exact.lookup(client_key_part2)
+        if exact_hit and exact_hit[1] >= FUZZY_SUCURSAL_SIMILARITY_THRESHOLD:
+            matched_suc_clean_name, score, _ = exact_hit; tier = SUC_TIER_EXACT_PART2
+        else:
+            suc_candidates = suc_match_index.candidates(client_key_part2)
+            match_info_part2 = process.extractOne(client_key_part2, suc_candidates, score_cutoff=FUZZY_SUCURSAL_SIMILARITY_THRESHOLD) if suc_candidates else None
+            matched_suc_clean_name, score = match_info_part2 if match_info_part2 else (None, 0)
+            tier = SUC_TIER_FUZZY_PART2
+        resolved_suc = suc_match_index.resolve(matched_suc_clean_name) if matched_suc_clean_name else None
+        if resolved_suc:
+            debtor_code, suc_original = resolved_suc
+            return SucursalMatch(suc_original, debtor_code, tier, score)
+    # Prioridad 2: Cliente == Sucursal
+    if resolve_deudor and client_key_part1 in deudor_map_priority:
+        codigo_deudor, sucursal_original = deudor_map_priority[client_key_part1]
+        return SucursalMatch(sucursal_original, codigo_deudor, SUC_TIER_CLIENT_EQ_SUCURSAL)
+    # Prioridad 3: Fallback
+    if resolve_sucursal and sucursal_map_fallback:
+        fallback_suc = sucursal_map_fallback.get(client_key_part1, "")
+        return SucursalMatch(fallback_suc, "", SUC_TIER_FALLBACK if fallback_suc else SUC_TIER_NONE)
+    return SucursalMatch("", "", SUC_TIER_NONE)
+
+def _log_sucursal_match(target_row: int, client_key_part2: str, match: SucursalMatch):
+    method_labels = {SUC_TIER_EXACT_PART2: "Exacto", SUC_TIER_FUZZY_PART2: "Fuzzy"}
+    if match.tier in method_labels: print(f"  Fila {target_row}: Match {method_labels[match.tier]} (Parte 2: '{client_key_part2}') -> Suc: '{match.sucursal}', Deudor: '{match.deudor}' ({match.score}%)")
+    elif match.tier == SUC_TIER_CLIENT_EQ_SUCURSAL: print(f"  Fila {target_row}: Match Prioritario (Cliente==Sucursal) -> Suc: '{match.sucursal}', Deudor: '{match.deudor}'")
+
+def _report_memo(stats: RunStats, name: str, label: str, hits: int, misses: int):
+    stats.count(f'{name}_memo_hits', hits); stats.count(f'{name}_memo_misses', misses)
+    total = hits + misses
+    print(f"Memo {label}: {misses} claves distintas resueltas, {hits} filas reutilizaron el resultado ({100 * hits / total if total else 0:.0f}% aciertos).")
+
+def _assign_cedulas(row_positions: np.ndarray, cedulas: List[str], group_size: int) -> List[Optional[str]]:
+    """Cédula por fila según su posición en la hoja destino: grupos de group_size filas rotando sobre la lista mezclada."""
+    if not cedulas: return [None] * len(row_positions)
+    group_positions = (np.asarray(row_positions) // group_size) % len(cedulas)
+    return [cedulas[pos] for pos in group_positions]
+
+def resolve_sucursal_matches(df_source: pd.DataFrame, suc_match_index: SucursalMatchIndex,
+                             deudor_map_priority: Dict[str, Tuple[str, str]], sucursal_map_fallback: Dict[str, str],
+                             resolve_deudor: bool, resolve_sucursal: bool, stats: Optional[RunStats] = None) -> List[SucursalMatch]:
+    """Cascada de sucursal/deudor por fila, resuelta una vez por par de claves (parte 1, parte 2) distinto."""
+    stats = stats or RunStats()
+    # Se combinan los códigos de categoría de ambas claves en un único código de par
+    with stats.phase('sucursal_match'):
+        codes1, keys1 = pd.factorize(df_source['lookup_key_client_part1'], use_na_sentinel=False)
+        codes2, keys2 = pd.factorize(df_source['lookup_key_client_part2'], use_na_sentinel=False)
+        unique_pairs, pair_of_row = np.unique(codes1.astype(np.int64) * max(len(keys2), 1) + codes2, return_inverse=True)
+        pair_results = [resolve_sucursal_deudor(keys1[pair // len(keys2)], keys2[pair % len(keys2)], suc_match_index, deudor_map_priority,
+                                                sucursal_map_fallback, resolve_deudor, resolve_sucursal) for pair in unique_pairs]
+        sucursal_results = [pair_results[i] for i in pair_of_row.ravel()]
+    _report_memo(stats, 'sucursal', "sucursal/deudor", len(df_source) - len(unique_pairs), len(unique_pairs))
+    return sucursal_results
+
+def build_output_frame(df_source: pd.DataFrame, df_sap_matches: pd.DataFrame,
+                       target_col_indices_map: Dict[str, List[int]],
+                       suc_match_index: SucursalMatchIndex,
+                       deudor_map_priority: Dict[str, Tuple[str, str]],
+                       sucursal_map_fallback: Dict[str, str],
+                       has_sap_lookups: bool,
+                       driver_cedulas: List[str], auxiliar_cedulas: List[str],
+                       skipped_residuo_keys: Optional[set] = None,
+                       stats: Optional[RunStats] = None,
+                       target_rows: Optional[np.ndarray] = None,
+                       sucursal_results: Optional[List[SucursalMatch]] = None) -> Tuple[pd.DataFrame, List[Tuple[int, str]], List[Tuple[int, str]]]:
+    """
+    Calcula columna a columna todos los valores a escribir en la hoja destino.
+    target_rows: fila Excel destino de cada fila fuente (por defecto, consecutivas desde TARGET_START_ROW_NUM).
+    sucursal_results: cascada sucursal/deudor ya resuelta por fila (por defecto se resuelve aquí).
+
+    Returns:
+        (df_output indexado por fila Excel destino, con una columna por nombre de
+         columna destino más OUTPUT_SAP_FILL_COL; lista de (fila, residuo) para selección manual SAP;
+         lista de (fila, residuo) sin SAP por una decisión guardada de omitir)
+    """
+    stats = stats or RunStats()
+    n_rows = len(df_source)
+    target_rows = TARGET_START_ROW_NUM + np.arange(n_rows) if target_rows is None else np.asarray(target_rows, dtype=np.int64)
+    has_col = lambda name: bool(target_col_indices_map.get(name))
+    output: Dict[str, List[Any]] = {}
+
+    # --- a) Mapeo Directo ---
+    output[TGT_COL_CLIENTE] = map_per_category(df_source[SRC_COL_CLIENTE], lambda v: str(v).strip())
+    output[TGT_COL_FECHA] = [_format_fecha_value(v) for v in df_source[SRC_COL_FECHA]]
+    output[TGT_COL_PLACA] = df_source[SRC_COL_PLACA].tolist()
+    output[TGT_COL_PESO] = [safe_str_conversion(v) for v in df_source[SRC_COL_PESO]]
+
+    # --- b) Sucursal / Código Deudor ---
+    resolve_deudor = has_col(TGT_COL_DEUDOR_SUC); resolve_sucursal = has_col(TGT_COL_SUCURSAL)
+    if sucursal_results is None:
+        sucursal_results = resolve_sucursal_matches(df_source, suc_match_index, deudor_map_priority, sucursal_map_fallback, resolve_deudor, resolve_sucursal, stats)
+    if VERBOSE_ROW_LOGGING:
+        for row, part2, match in zip(target_rows, df_source['lookup_key_client_part2'], sucursal_results): _log_sucursal_match(int(row), part2, match)
+    output[TGT_COL_SUCURSAL] = [match.sucursal for match in sucursal_results]
+    output[TGT_COL_DEUDOR_SUC] = [match.deudor for match in sucursal_results]
+    for tier in (SUC_TIER_EXACT_PART2, SUC_TIER_FUZZY_PART2, SUC_TIER_CLIENT_EQ_SUCURSAL, SUC_TIER_FALLBACK, SUC_TIER_NONE):
+        stats.count(f'sucursal_{tier}', sum(1 for match in sucursal_results if match.tier == tier))
+
+    # --- c) Código SAP (resultado de batch_match_sap_codes) ---
+    # Decisiones manuales guardadas: código -> azul (como en la Fase 2); omitido -> vacío y sin popup
+    skipped_residuo_keys = skipped_residuo_keys or set()
+    sap_items_for_manual_selection: List[Tuple[int, str]] = []; sap_items_skipped_by_decision: List[Tuple[int, str]] = []
+    sap_values: List[Optional[str]] = [None] * n_rows; sap_fills: List[PatternFill] = [HIGHLIGHT_NONE] * n_rows
+    if has_sap_lookups and has_col(TGT_COL_SAP):
+        sap_columns = zip(df_sap_matches['sap_code'], df_sap_matches['sap_score'], df_sap_matches['sap_from_decision'], df_source['lookup_key_residuo'], df_source[SRC_COL_RESIDUO])
+        for pos, (code, score, from_decision, residuo_key, residuo) in enumerate(sap_columns):
+            if code and str(code).lower() != 'nan':
+                sap_values[pos] = code
+                if from_decision: sap_fills[pos] = HIGHLIGHT_BLUE
+                else: sap_fills[pos] = HIGHLIGHT_YELLOW if FUZZY_SAP_SIMILARITY_THRESHOLD <= score < 100 else HIGHLIGHT_NONE
+            elif residuo_key in skipped_residuo_keys: sap_items_skipped_by_decision.append((int(target_rows[pos]), str(residuo).strip()))
+            else: sap_items_for_manual_selection.append((int(target_rows[pos]), str(residuo).strip()))
+        tier_counts = df_sap_matches['sap_tier'].value_counts()
+        for tier in (SAP_TIER_MAP1, SAP_TIER_MAP2, SAP_TIER_DECISION): stats.count(f'sap_{tier}', tier_counts.get(tier, 0))
+        method_counts = df_sap_matches['sap_method'].value_counts()
+        for method in (MATCH_METHOD_EXACT, MATCH_METHOD_FUZZY): stats.count(f'sap_{method}', method_counts.get(method, 0))
+        stats.count('sap_stored_skip', len(sap_items_skipped_by_decision)); stats.count('sap_pending_manual', len(sap_items_for_manual_selection))
+    output[TGT_COL_SAP] = sap_values; output[OUTPUT_SAP_FILL_COL] = sap_fills
+
+    # --- d/e) Cédulas Conductor y Auxiliar ---
+    output[TGT_COL_CEDULA_CONDUCTOR] = _assign_cedulas(target_rows - TARGET_START_ROW_NUM, driver_cedulas, CONDUCTOR_GROUP_SIZE)
+    output[TGT_COL_CEDULA_AUXILIAR] = _assign_cedulas(target_rows - TARGET_START_ROW_NUM, auxiliar_cedulas, AUXILIAR_GROUP_SIZE)
+
+    # --- f/g) Valores Fijos y Columnas '1' ---
+    output[TGT_COL_NOMBRE_ENTREGA] = [FIXED_STRING_SIN_DESCRIPCION] * n_rows
+    output[TGT_COL_CARGO_ENTREGA] = [FIXED_STRING_SIN_DESCRIPCION] * n_rows
+    output[TGT_COL_UNO] = [FIXED_NUMBER_UNO] * n_rows
+
+    return pd.DataFrame(output, index=pd.Index(target_rows, name='target_row'), dtype=object), sap_items_for_manual_selection, sap_items_skipped_by_decision
+
+def write_output_frame(worksheet: openpyxl.worksheet.worksheet.Worksheet, df_output: pd.DataFrame,
+                       target_col_indices_map: Dict[str, List[int]]) -> int:
+    """
+    Escribe df_output en la hoja destino columna por columna. Cada columna se escribe
+    en la primera posición encontrada para su encabezado, salvo TGT_COL_UNO que se
+    escribe en todas sus posiciones duplicadas. La columna SAP lleva además su relleno.
+
+    Returns:
+        Número de celdas escritas.
+    """
+    target_rows = [int(r) for r in df_output.index]
+    cells_written = 0
+    for tgt_col in df_output.columns:
+        if tgt_col == OUTPUT_SAP_FILL_COL: continue
+        col_indices = target_col_indices_map.get(tgt_col) or []
+        if tgt_col != TGT_COL_UNO: col_indices = col_indices[:1]
+        values = df_output[tgt_col].tolist()
+        for col_idx in col_indices:
+            if tgt_col == TGT_COL_SAP:
+                for row_num, value, fill in zip(target_rows, values, df_output[OUTPUT_SAP_FILL_COL].tolist()):
+                    cell = worksheet.cell(row=row_num, column=col_idx); cell.value = value; cell.fill = fill
+            else:
+                for row_num, value in zip(target_rows, values): worksheet.cell(row=row_num, column=col_idx, value=value)
+            cells_written += len(values)
+    return cells_written
+
+# ==============================================================================
+# --- Exportación Rápida de la Hoja de Cargue (xlsx en streaming / CSV) ---
+# ==============================================================================
+def _color_hex(color) -> Optional[str]:
+    """Color de openpyxl ('rgb' o 'indexed') como '#RRGGBB' para xlsxwriter; None si es de tema o automático."""
+    if color is None: return None
+    if color.type == 'rgb' and isinstance(color.rgb, str): return f"#{color.rgb[-6:]}"
+    if color.type == 'indexed' and isinstance(color.indexed, int) and color.indexed < len(COLOR_INDEX): return f"#{COLOR_INDEX[color.indexed][-6:]}"
+    return None
+
+def _export_column_count(worksheet: openpyxl.worksheet.worksheet.Worksheet) -> int:
+    """Última columna con encabezado; las columnas vacías a la derecha de la plantilla no se exportan."""
+    header_cols = [cell.column for cell in worksheet[1] if cell.value is not None]
+    return max(header_cols) if header_cols else worksheet.max_column
+
+def export_upload_sheet_xlsx(worksheet: openpyxl.worksheet.worksheet.Worksheet, last_written_row: int, output_path: str) -> int:
+    """
+    Escribe solo la hoja de cargue (encabezado + filas hasta last_written_row) en un libro
+    nuevo con xlsxwriter en modo constant_memory, conservando rellenos, color/negrita de
+    fuente, formato numérico y anchos de columna.
+
+    Returns:
+        Número de filas exportadas (sin contar el encabezado).
+
+    Raises:
+        ProcessingError: si 'xlsxwriter' no está instalado.
+    """
+    try: import xlsxwriter
+    except ImportError: raise ProcessingError("Error Dependencia", "Instala 'xlsxwriter': pip install xlsxwriter")
+    n_cols = _export_column_count(worksheet)
+    out_wb = xlsxwriter.Workbook(output_path, {'constant_memory': True}); out_ws = out_wb.add_worksheet(worksheet.title)
+    for col_idx in range(1, n_cols + 1):
+        width = worksheet.column_dimensions[openpyxl.utils.get_column_letter(col_idx)].width
+        if width: out_ws.set_column(col_idx - 1, col_idx - 1, width)
+    formats: Dict[tuple, Any] = {} # Un formato xlsxwriter por combinación de estilo (pocas en la plantilla)
+    def cell_format(cell):
+        fill = _color_hex(cell.fill.fgColor) if _cell_has_fill(cell) else None
+        font_color = _color_hex(cell.font.color) if cell.font else None; bold = bool(cell.font and cell.font.b)
+        num_format = cell.number_format if cell.number_format != 'General' else ('yyyy-mm-dd' if isinstance(cell.value, datetime) else None)
+        key = (fill, font_color, bold, num_format)
+        if key == (None, None, False, None): return None
+        if key not in formats:
+            props = {'bold': bold}
+            if fill: props.update(pattern=1, bg_color=fill)
+            if font_color: props['font_color'] = font_color
+            if num_format: props['num_format'] = num_format
+            formats[key] = out_wb.add_format(props)
+        return formats[key]
+    # constant_memory exige escribir fila a fila en orden, que es como iter_rows recorre la hoja
+    for row in worksheet.iter_rows(min_row=1, max_row=last_written_row, max_col=n_cols):
+        for cell in row:
+            fmt = cell_format(cell)
+            if cell.value is None:
+                if fmt is not None: out_ws.write_blank(cell.row - 1, cell.column - 1, None, fmt)
+            else: out_ws.write(cell.row - 1, cell.column - 1, cell.value, fmt)
+    out_wb.close()
+    return max(0, last_written_row - TARGET_START_ROW_NUM + 1)
+
+def export_upload_sheet_csv(worksheet: openpyxl.worksheet.worksheet.Worksheet, last_written_row: int, output_path: str) -> int:
+    """
+    Escribe solo los valores de la hoja de cargue (encabezado + filas hasta last_written_row)
+    en CSV ';' UTF-8 con BOM, igual que el reporte de pendientes SAP. Las fechas van como AAAA-MM-DD.
+
+    Returns:
+        Número de filas exportadas (sin contar el encabezado).
+    """
+    n_cols = _export_column_count(worksheet)
+    with open(output_path, 'w', newline='', encoding='utf-8-sig') as f:
+        writer = csv.writer(f, delimiter=';')
+        for row in worksheet.iter_rows(min_row=1, max_row=last_written_row, max_col=n_cols, values_only=True):
+            writer.writerow(['' if value is None else value.strftime('%Y-%m-%d') if isinstance(value, datetime) else value for value in row])
+    return max(0, last_written_row - TARGET_START_ROW_NUM + 1)
+
 # ==============================================================================
 # --- Interfaz Gráfica (Popup Selección Manual SAP) ---
-# (Sin cambios)
 # ==============================================================================
-def show_manual_sap_selection_popup(parent_window: tk.Tk, residuo_name: str, sap_option_list: List[str]) -> Optional[str]:
-    global selected_sap_code_from_popup; selected_sap_code_from_popup = "SKIP"
+sap_popup_choice_is_decision = False # True solo si el operador pulsó 'Seleccionar' u 'Omitir este Residuo' (se guarda como decisión)
+
+def show_manual_sap_selection_popup(parent_window: tk.Tk, residuo_name: str, sap_option_list: SapPopupOptions) -> Optional[str]:
+    global selected_sap_code_from_popup, sap_popup_choice_is_decision; selected_sap_code_from_popup = "SKIP"; sap_popup_choice_is_decision = False
     try:
         popup = Toplevel(parent_window); popup.title("Selección Manual de Código SAP")
         wait_var = tk.IntVar(popup, value=0)
@@ -330,25 +1354,46 @@ def show_manual_sap_selection_popup(parent_window: tk.Tk, residuo_name: str, sap
         list_frame = Frame(popup); list_frame.pack(pady=5, padx=10, fill=tk.BOTH, expand=True)
         scrollbar = Scrollbar(list_frame, orient=tk.VERTICAL); scrollbar.pack(side=tk.RIGHT, fill=tk.Y)
         listbox = Listbox(list_frame, yscrollcommand=scrollbar.set, exportselection=False, selectmode=tk.SINGLE, activestyle='dotbox'); listbox.pack(side=tk.LEFT, fill=tk.BOTH, expand=True); scrollbar.config(command=listbox.yview)
+        page_frame = Frame(popup); page_frame.pack(padx=10, fill=tk.X)
+        status_label = Label(page_frame, text="", anchor=tk.W, fg="grey"); status_label.pack(side=tk.LEFT, fill=tk.X, expand=True)
+        next_page_button = Button(page_frame, text="Siguientes ▶", width=12); next_page_button.pack(side=tk.RIGHT)
+        prev_page_button = Button(page_frame, text="◀ Anteriores", width=12); prev_page_button.pack(side=tk.RIGHT, padx=(0, 5))
+        suggested_positions = sap_option_list.suggestions(residuo_name, POPUP_SUGGESTION_COUNT)
+        # Todas las coincidencias son alcanzables: se muestran por páginas de POPUP_PAGE_SIZE
+        pending_filter = {'after_id': None}; page = {'matches': [], 'start': 0, 'search_term': ""}
+        def render_page():
+            matches, start = page['matches'], page['start']; end = min(start + POPUP_PAGE_SIZE, len(matches))
+            rendered = [sap_option_list.display[pos] for pos in matches[start:end]]
+            if not page['search_term'] and start == 0: rendered = [POPUP_SUGGESTION_PREFIX + sap_option_list.display[pos] for pos in suggested_positions] + rendered
+            listbox.delete(0, tk.END)
+            if rendered: listbox.insert(tk.END, *rendered) # Una sola llamada a Tk para todo el bloque
+            status_label.config(text=f"{len(matches)} coincidencias" + (f" (mostrando {start + 1}-{end})" if len(matches) > POPUP_PAGE_SIZE else ""))
+            prev_page_button.config(state=tk.NORMAL if start > 0 else tk.DISABLED); next_page_button.config(state=tk.NORMAL if end < len(matches) else tk.DISABLED)
+        def change_page(step: int):
+            page['start'] = max(0, min(page['start'] + step * POPUP_PAGE_SIZE, (max(len(page['matches']) - 1, 0) // POPUP_PAGE_SIZE) * POPUP_PAGE_SIZE)); render_page()
+        prev_page_button.config(command=lambda: change_page(-1)); next_page_button.config(command=lambda: change_page(1))
         def update_listbox_filter(search_term: str = ""):
-            listbox.delete(0, tk.END); search_term_lower = search_term.lower(); items_added_count = 0
-            for option_text in sap_option_list:
-                if search_term_lower in option_text.lower():
-                    try: safe_option = option_text.encode(sys.getfilesystemencoding(), 'replace').decode(sys.getfilesystemencoding(), 'replace'); listbox.insert(tk.END, safe_option); items_added_count += 1
-                    except Exception as e: print(f"Advertencia(update_listbox): No se pudo añadir '{option_text}': {e}")
-        def on_search_text_changed(*args): update_listbox_filter(search_var.get())
+            pending_filter['after_id'] = None
+            page.update(matches=sap_option_list.filter(search_term), start=0, search_term=search_term); render_page()
+        def on_search_text_changed(*args):
+            if pending_filter['after_id']: popup.after_cancel(pending_filter['after_id'])
+            pending_filter['after_id'] = popup.after(POPUP_SEARCH_DEBOUNCE_MS, lambda: update_listbox_filter(search_var.get()))
         search_var.trace_add("write", on_search_text_changed); update_listbox_filter()
+        def close_popup():
+            """Cancela el filtrado pendiente (si no, se ejecutaría sobre widgets destruidos) y cierra."""
+            if pending_filter['after_id']: popup.after_cancel(pending_filter['after_id']); pending_filter['after_id'] = None
+            wait_var.set(1); popup.destroy()
         def handle_selection():
-            global selected_sap_code_from_popup; selected_indices = listbox.curselection()
+            global selected_sap_code_from_popup, sap_popup_choice_is_decision; selected_indices = listbox.curselection()
             if selected_indices:
                 selected_text = listbox.get(selected_indices[0]); match = re.search(r'\(([^)]+)\)$', selected_text)
-                if match: selected_sap_code_from_popup = match.group(1).strip()
+                if match: selected_sap_code_from_popup = match.group(1).strip(); sap_popup_choice_is_decision = True
                 else: print(f"Advertencia: No se pudo extraer código SAP de '{selected_text}'."); selected_sap_code_from_popup = "SKIP"
-                wait_var.set(1); popup.destroy()
+                close_popup()
             else: messagebox.showwarning("Sin Selección", "Seleccione un código o use 'Omitir'.", parent=popup)
-        def handle_skip(): global selected_sap_code_from_popup; selected_sap_code_from_popup = "SKIP"; wait_var.set(1); popup.destroy()
-        def handle_save_exit(): global selected_sap_code_from_popup; selected_sap_code_from_popup = "SAVE_EXIT"; wait_var.set(1); popup.destroy()
-        def handle_window_close(): global selected_sap_code_from_popup; print("Advertencia: Popup SAP cerrado con 'X'."); selected_sap_code_from_popup = "SKIP"; wait_var.set(1); popup.destroy()
+        def handle_skip(): global selected_sap_code_from_popup, sap_popup_choice_is_decision; selected_sap_code_from_popup = "SKIP"; sap_popup_choice_is_decision = True; close_popup()
+        def handle_save_exit(): global selected_sap_code_from_popup; selected_sap_code_from_popup = "SAVE_EXIT"; close_popup()
+        def handle_window_close(): global selected_sap_code_from_popup; print("Advertencia: Popup SAP cerrado con 'X'."); selected_sap_code_from_popup = "SKIP"; close_popup()
         popup.protocol("WM_DELETE_WINDOW", handle_window_close)
         button_frame = Frame(popup); button_frame.pack(pady=(10, 15))
         select_button = Button(button_frame, text="Seleccionar", command=handle_selection, width=15); select_button.pack(side=tk.LEFT, padx=5)
@@ -360,10 +1405,490 @@ def show_manual_sap_selection_popup(parent_window: tk.Tk, residuo_name: str, sap
     except Exception as e_popup: print(f"ERROR FATAL creando/mostrando popup SAP: {e_popup}"); traceback.print_exc(); selected_sap_code_from_popup = None
     return selected_sap_code_from_popup
 
+# ==============================================================================
+# --- Interfaz Gráfica (Ventana de Progreso + Hilo de Trabajo) ---
+# ==============================================================================
+def _format_eta(seconds: float) -> str:
+    minutes, secs = divmod(int(round(seconds)), 60)
+    return f"{minutes // 60}:{minutes % 60:02d}:{secs:02d}" if minutes >= 60 else f"{minutes}:{secs:02d}"
+
+def run_with_progress(parent_window: tk.Tk, title: str, work, progress: 'ProgressReporter', cancellable: bool = True) -> Any:
+    """
+    Ejecuta work() en un hilo de trabajo mientras el hilo principal muestra una ventana con
+    etapa, barra de progreso (filas, filas/s y ETA) y botón Cancelar. work() no debe tocar Tk:
+    solo publica avances en progress.queue, que la ventana vacía cada PROGRESS_POLL_MS.
+    Los popups (selección SAP, mensajes) siguen abriéndose en el hilo principal al volver.
+
+    Returns:
+        El valor devuelto por work().
+
+    Raises:
+        La excepción lanzada por work() (ProcessingCancelled si se canceló), relanzada en el hilo principal.
+    """
+    outcome: Dict[str, Any] = {}
+    def worker():
+        try: outcome['result'] = work()
+        except BaseException as e: outcome['error'] = e
+        finally: progress.queue.put(('done',))
+    window = Toplevel(parent_window); window.title(title); window.resizable(False, False)
+    done_var = tk.IntVar(window, value=0)
+    stage_label = Label(window, text=f"{title}...", anchor=tk.W, width=50); stage_label.pack(padx=15, pady=(15, 5), fill=tk.X)
+    progress_bar = ttk.Progressbar(window, orient=tk.HORIZONTAL, length=400, mode='indeterminate', maximum=100); progress_bar.pack(padx=15, pady=5)
+    rate_label = Label(window, text="", anchor=tk.W, fg="grey"); rate_label.pack(padx=15, fill=tk.X)
+    state = {'rows_total': 0, 'stage_start': time.perf_counter()}
+    def handle_cancel():
+        if not cancellable: return
+        progress.cancel_event.set(); stage_label.config(text="Cancelando (al terminar el bloque actual)..."); cancel_button.config(state=tk.DISABLED)
+    cancel_button = Button(window, text="Cancelar", command=handle_cancel, width=15, state=tk.NORMAL if cancellable else tk.DISABLED); cancel_button.pack(pady=(10, 15))
+    window.protocol("WM_DELETE_WINDOW", handle_cancel)
+    def poll_queue():
+        try:
+            while True:
+                message = progress.queue.get_nowait()
+                if message[0] == 'done': done_var.set(1); return
+                if message[0] == 'stage':
+                    _, name, rows_total = message; state.update(rows_total=rows_total, stage_start=time.perf_counter())
+                    if not progress.cancel_event.is_set(): stage_label.config(text=name)
+                    rate_label.config(text=f"0/{rows_total} filas" if rows_total else "")
+                    if rows_total: progress_bar.stop(); progress_bar.config(mode='determinate', value=0)
+                    else: progress_bar.config(mode='indeterminate'); progress_bar.start(15)
+                elif message[0] == 'rows' and state['rows_total']:
+                    rows_done = min(message[1], state['rows_total']); elapsed = time.perf_counter() - state['stage_start']
+                    rate = rows_done / elapsed if elapsed > 0 else 0.0
+                    eta = _format_eta((state['rows_total'] - rows_done) / rate) if rate > 0 else "--:--"
+                    progress_bar.config(value=100.0 * rows_done / state['rows_total'])
+                    rate_label.config(text=f"{rows_done}/{state['rows_total']} filas · {rate:,.0f} filas/s · ETA {eta}")
+        except queue.Empty: pass
+        window.after(PROGRESS_POLL_MS, poll_queue)
+    progress_bar.start(15)
+    threading.Thread(target=worker, name="movilidad-worker", daemon=True).start()
+    window.after(PROGRESS_POLL_MS, poll_queue)
+    window.wait_variable(done_var) # El bucle de eventos de Tk sigue atendiendo la ventana mientras espera
+    window.destroy()
+    if 'error' in outcome: raise outcome['error']
+    return outcome.get('result')
+
+# ==============================================================================
+# --- Modo Incremental (Manifiesto de Filas Procesadas) ---
+# ==============================================================================
+def manifest_path_for(workbook_path: str) -> str:
+    return os.path.splitext(workbook_path)[0] + INCREMENTAL_MANIFEST_SUFFIX
+
+def fingerprint_source_rows(df_source: pd.DataFrame) -> List[str]:
+    """Huella por fila de WEB2.0 sobre las columnas que determinan la salida (Cliente, Fecha, Placa, Peso, Residuo)."""
+    if df_source.empty: return []
+    # safe_str_conversion: 1 y 1.0 dan la misma huella aunque el tipo inferido de la columna cambie entre lecturas
+    hashes = pd.util.hash_pandas_object(df_source[SOURCE_FINGERPRINT_COLUMNS].map(safe_str_conversion), index=False)
+    return [f"{h:016x}" for h in hashes.to_numpy()]
+
+def target_sheet_signature(worksheet: openpyxl.worksheet.worksheet.Worksheet, target_col_indices_map: Dict[str, List[int]], n_rows: int) -> str:
+    """Huella de la columna CLIENTE ya escrita: detecta si la hoja destino no corresponde al manifiesto."""
+    col_idx = (target_col_indices_map.get(TGT_COL_CLIENTE) or [None])[0]
+    if col_idx is None or n_rows <= 0: return ""
+    values = worksheet.iter_rows(min_row=TARGET_START_ROW_NUM, max_row=TARGET_START_ROW_NUM + n_rows - 1, min_col=col_idx, max_col=col_idx, values_only=True)
+    return hashlib.sha256(repr([row[0] for row in values]).encode('utf-8')).hexdigest()
+
+@dataclass
+class IncrementalManifest:
+    """Huella de la fila fuente escrita en cada fila destino (desde TARGET_START_ROW_NUM) y orden de cédulas usado."""
+    row_fingerprints: List[str]
+    driver_cedulas: List[str]
+    auxiliar_cedulas: List[str]
+    target_signature: str = ""
+    unresolved_rows: Set[int] = field(default_factory=set) # Filas destino (Excel) sin SAP resuelto: pendientes u omitidas
+
+    def saved_fingerprints(self) -> List[str]:
+        """Huellas a guardar: las filas sin SAP resuelto quedan vacías y se vuelven a procesar en la siguiente ejecución."""
+        if not self.unresolved_rows: return list(self.row_fingerprints)
+        return ["" if TARGET_START_ROW_NUM + pos in self.unresolved_rows else fp for pos, fp in enumerate(self.row_fingerprints)]
+
+    @classmethod
+    def load(cls, path: str) -> Optional['IncrementalManifest']:
+        if not os.path.exists(path): return None
+        try:
+            with open(path, 'r', encoding='utf-8') as f: data = json.load(f)
+            if data.get('version') != INCREMENTAL_MANIFEST_VERSION: print(f"Manifiesto incremental con versión distinta; se ignora."); return None
+            return cls(data['row_fingerprints'], data['driver_cedulas'], data['auxiliar_cedulas'], data.get('target_signature', ""))
+        except Exception as e: print(f"Advertencia: No se pudo leer el manifiesto incremental '{path}': {e}"); return None
+
+    def save(self, workbook_path: str):
+        path = manifest_path_for(workbook_path)
+        data = {'version': INCREMENTAL_MANIFEST_VERSION, 'saved_at': datetime.now().isoformat(timespec='seconds'),
+                'row_fingerprints': self.saved_fingerprints(), 'driver_cedulas': self.driver_cedulas,
+                'auxiliar_cedulas': self.auxiliar_cedulas, 'target_signature': self.target_signature}
+        try:
+            with open(path, 'w', encoding='utf-8') as f: json.dump(data, f, ensure_ascii=False)
+            print(f"Manifiesto incremental guardado en '{path}' ({len(self.row_fingerprints)} filas, {len(self.unresolved_rows)} sin SAP se reprocesarán).")
+        except Exception as e: print(f"Advertencia: No se pudo guardar el manifiesto incremental: {e}")
+
+def plan_incremental_rows(fingerprints: List[str], manifest: IncrementalManifest) -> Optional[Tuple[List[int], List[int]]]:
+    """
+    Empareja las filas actuales con las ya escritas por su huella. Las filas cambiadas
+    ocupan las filas destino que quedaron libres y las nuevas se agregan al final.
+
+    Returns:
+        (posiciones fuente a procesar, posición destino de cada una), o None si hay más
+        filas destino liberadas que filas por procesar (quedarían huecos: se reprocesa todo).
+    """
+    available: Dict[str, List[int]] = {}
+    for target_pos, fp in enumerate(manifest.row_fingerprints): available.setdefault(fp, []).append(target_pos)
+    for slots in available.values(): slots.reverse() # pop() entrega la primera fila destino libre
+    pending_positions: List[int] = []
+    for source_pos, fp in enumerate(fingerprints):
+        slots = available.get(fp)
+        if slots: slots.pop()
+        else: pending_positions.append(source_pos)
+    freed_slots = sorted(pos for slots in available.values() for pos in slots)
+    if len(freed_slots) > len(pending_positions): return None
+    n_existing = len(manifest.row_fingerprints)
+    target_positions = freed_slots + list(range(n_existing, n_existing + len(pending_positions) - len(freed_slots)))
+    return pending_positions, target_positions
+
+def _stored_or_shuffled_cedulas(configured: List[str], stored: Optional[List[str]], label: str, group_size: int) -> List[str]:
+    """Reutiliza el orden guardado si corresponde a la lista configurada; si no, mezcla una copia."""
+    if stored is not None and sorted(stored) == sorted(configured):
+        print(f"Orden de {len(stored)} cédulas de {label} reutilizado del manifiesto (grupos de {group_size})."); return list(stored)
+    cedulas = configured[:] # Copiar
+    if not cedulas: print(f"Advertencia: Lista de cédulas de {label} vacía.")
+    else: random.shuffle(cedulas); print(f"Lista de {len(cedulas)} cédulas de {label} mezclada (grupos de {group_size}).")
+    return cedulas
+
 # ==============================================================================
 # --- Función Principal de Ejecución ---
 # ==============================================================================
 
+class ProcessingError(Exception):
+    """Error crítico del proceso automático; 'title' se usa como título del mensaje en la GUI."""
+    def __init__(self, title: str, message: str):
+        super().__init__(message); self.title = title
+
+class ProcessingCancelled(ProcessingError):
+    """El usuario pulsó 'Cancelar' en la ventana de progreso."""
+    def __init__(self):
+        super().__init__("Cancelado", "Proceso cancelado por el usuario.")
+
+class ProgressReporter:
+    """
+    Puente entre el hilo de trabajo y la UI: publica avances en una cola que solo lee el
+    hilo principal de Tk, y comprueba en cada avance si se pidió cancelar.
+    Con publish=False (modo por lotes) solo queda la comprobación de cancelación.
+    """
+    def __init__(self, publish: bool = True):
+        self.queue: 'queue.Queue[tuple]' = queue.Queue(); self.cancel_event = threading.Event(); self.publish = publish
+
+    def check_cancelled(self):
+        if self.cancel_event.is_set(): raise ProcessingCancelled()
+
+    def stage(self, name: str, rows_total: int = 0):
+        """Nueva etapa; rows_total > 0 hace la barra determinada (filas) y reinicia filas/s y ETA."""
+        self.check_cancelled()
+        if self.publish: self.queue.put(('stage', name, rows_total))
+
+    def rows(self, rows_done: int):
+        self.check_cancelled()
+        if self.publish: self.queue.put(('rows', rows_done))
+
+@dataclass
+class AutomaticPhaseResult:
+    """Estado resultante de la Fase 1 (lectura, coincidencias y escritura automática)."""
+    workbook: openpyxl.workbook.workbook.Workbook
+    sap_decisions: SapDecisionStore
+    target_ws: openpyxl.worksheet.worksheet.Worksheet
+    target_col_indices_map: Dict[str, List[int]]
+    df_output: pd.DataFrame
+    sap_items_for_manual_selection: List[Tuple[int, str]]
+    sap_options_for_popup: SapPopupOptions
+    driver_cedulas: List[str]
+    auxiliar_cedulas: List[str]
+    processed_rows_count: int
+    last_written_excel_row: int
+    stats: RunStats
+    manifest: IncrementalManifest
+    sap_selection_cache: Dict[str, str] = field(default_factory=dict) # Respuestas previas (al reanudar)
+    resumed_from: Optional[str] = None # Punto de control desde el que se reanudó, si aplica
+    sap_items_skipped_by_decision: List[Tuple[int, str]] = field(default_factory=list) # Sin SAP por decisión guardada de omitir
+    source_sheet_loaded: bool = True # False: WEB2.0 se abrió vacía y el libro no puede re-guardarse completo
+
+    @property
+    def tgt_idx_sap(self) -> Optional[int]:
+        return self.target_col_indices_map.get(TGT_COL_SAP, [None])[0]
+
+    @property
+    def all_processed_col_indices(self) -> List[int]:
+        return sorted({idx for indices in self.target_col_indices_map.values() for idx in indices})
+
+def run_automatic_phase(input_excel_file: str, incremental: bool = USE_INCREMENTAL_MODE,
+                        streaming: bool = USE_STREAMING_SOURCE, progress: Optional[ProgressReporter] = None,
+                        output_format: Optional[str] = None) -> AutomaticPhaseResult:
+    """
+    Pasos 2 y 3 del proceso, sin ninguna interacción con la GUI: lectura del libro,
+    preparación de lookups y claves, coincidencias y escritura en la hoja destino.
+    Con incremental y un manifiesto junto al libro (ya procesado), solo se procesan las filas nuevas, cambiadas o sin SAP resuelto.
+    Con streaming, WEB2.0 se lee y procesa en bloques de SOURCE_CHUNK_ROWS filas desde un libro de
+    solo lectura; si además output_format (ya conocido, p. ej. en modo por lotes) es de solo hoja,
+    las celdas de WEB2.0 tampoco se cargan en el libro de edición (memoria acotada).
+    Con progress (ventana de progreso), las coincidencias se resuelven una vez y las filas se
+    calculan y escriben en bloques de PROGRESS_BLOCK_ROWS, reportando el avance por bloque;
+    puede ejecutarse en un hilo de trabajo.
+
+    Raises:
+        ProcessingError: si falta la hoja/columnas fuente o la hoja/columnas destino.
+        ProcessingCancelled: si se pidió cancelar desde la ventana de progreso.
+    """
+    # --- 2. Lectura y Preparación ---
+    print(f"\n[Paso 2/5] Leyendo datos y preparando búsquedas...")
+    stats = RunStats(input_excel_file); block_rows = PROGRESS_BLOCK_ROWS if progress else None
+    progress = progress or ProgressReporter(publish=False); progress.stage("Leyendo libro...")
+    # Sin re-guardar el libro completo, WEB2.0 no necesita estar en el libro de edición
+    source_sheet_loaded = not (streaming and output_format in (OUTPUT_FORMAT_SHEET, OUTPUT_FORMAT_CSV))
+    try:
+        with stats.phase('read'):
+            workbook, workbook_sheets = load_workbook_sheets(input_excel_file, skip_sheets=(SOURCE_SHEET_NAME,) if streaming else (),
+                                                             blank_sheets=() if source_sheet_loaded else (SOURCE_SHEET_NAME,))
+        df_source = workbook_sheets.get(SOURCE_SHEET_NAME)
+        if SOURCE_SHEET_NAME not in workbook.sheetnames: raise ValueError(f"Hoja '{SOURCE_SHEET_NAME}' no encontrada.")
+        if streaming:
+            with stats.phase('read'): source_columns, estimated_source_rows = read_source_header(input_excel_file) # Solo encabezados
+        else: source_columns = df_source.columns
+    except Exception as e: print(f"Error Crítico: No se pudo leer '{SOURCE_SHEET_NAME}'. {e}"); raise ProcessingError("Error Lectura", f"No se pudo leer '{SOURCE_SHEET_NAME}'.\n\n{e}")
+
+    progress.stage("Preparando búsquedas...")
+    with stats.phase('lookups'):
+        sucursal_lookups, sap_lookups = load_lookups_cached(input_excel_file, workbook_sheets)
+        sucursal_map_fallback, suc_deudor_fuzzy_data, suc_names_fuzzy, deudor_map_priority, suc_match_index = sucursal_lookups
+        sap_map1, sap_keys1, sap_map2, sap_keys2 = sap_lookups
+        sap_options_for_popup = prepare_sap_choices_for_popup(sap_map1, sap_map2)
+
+    source_cols_required = list(COLUMN_MAPPING_DIRECT.keys()) + [SRC_COL_RESIDUO]
+    missing_src_cols = [col for col in source_cols_required if col not in source_columns]
+    if missing_src_cols: print(f"Error Crítico: Faltan columnas fuente: {missing_src_cols}"); raise ProcessingError("Error Columnas Fuente", f"Faltan en '{SOURCE_SHEET_NAME}':\n{', '.join(missing_src_cols)}")
+    print("Verificación de columnas fuente: OK.")
+
+    # Se reutiliza el libro ya abierto en el Paso 2 (sin volver a parsear el archivo)
+    if TARGET_SHEET_NAME not in workbook.sheetnames: print(f"Error Crítico: No se encontró hoja destino '{TARGET_SHEET_NAME}'."); raise ProcessingError("Error Hoja Destino", f"No se encontró '{TARGET_SHEET_NAME}'.")
+    target_ws = workbook[TARGET_SHEET_NAME]
+    print(f"Hoja destino '{TARGET_SHEET_NAME}' accesible.")
+
+    # <<< MODIFICADO: Usar la nueva función para obtener índices (maneja duplicados) >>>
+    target_cols_to_find = list(COLUMN_MAPPING_DIRECT.values()) + EXTRA_TARGET_COLS_TO_PROCESS
+    # Eliminar duplicados de la lista de búsqueda para evitar mensajes repetidos
+    target_col_indices_map = find_target_column_indices_with_duplicates(target_ws, list(set(target_cols_to_find)))
+
+    # Verificar columnas esenciales mapeadas
+    missing_essential_tgt = [tgt for src, tgt in COLUMN_MAPPING_DIRECT.items() if not target_col_indices_map.get(tgt)]
+    if missing_essential_tgt: print(f"Error Crítico: Faltan columnas destino mapeadas: {missing_essential_tgt}"); raise ProcessingError("Error Columnas Destino", f"Faltan en '{TARGET_SHEET_NAME}':\n{', '.join(missing_essential_tgt)}")
+
+    # --- Modo incremental: filas ya escritas en una ejecución anterior ---
+    manifest = IncrementalManifest.load(manifest_path_for(input_excel_file)) if incremental else None
+    if manifest and manifest.target_signature != target_sheet_signature(target_ws, target_col_indices_map, len(manifest.row_fingerprints)):
+        print("Manifiesto incremental no corresponde a la hoja destino actual; se procesa todo."); manifest = None
+    source_fingerprints: Optional[List[str]] = None; plan = None
+    if manifest:
+        if streaming: # Primera pasada solo para las huellas (memoria acotada)
+            with stats.phase('read'): source_fingerprints = [fp for chunk in iter_source_chunks(input_excel_file, SOURCE_CHUNK_ROWS) for fp in fingerprint_source_rows(chunk)]
+        else: source_fingerprints = fingerprint_source_rows(df_source)
+        plan = plan_incremental_rows(source_fingerprints, manifest)
+        if plan is None: print("Hay filas eliminadas en WEB2.0 respecto a la ejecución anterior; se procesa todo.")
+    # Fila destino de cada posición fuente a procesar (None: todas, consecutivas)
+    target_by_source_pos: Optional[Dict[int, int]] = None
+    if plan:
+        source_positions, target_positions = plan
+        print(f"Modo incremental: {len(source_fingerprints) - len(source_positions)} filas sin cambios se conservan; {len(source_positions)} filas nuevas/cambiadas a procesar.")
+        target_by_source_pos = {src: TARGET_START_ROW_NUM + tgt for src, tgt in zip(source_positions, target_positions)}
+        row_fingerprints = list(manifest.row_fingerprints) + [""] * max(0, max(target_positions, default=-1) + 1 - len(manifest.row_fingerprints))
+        for source_pos, target_pos in zip(source_positions, target_positions): row_fingerprints[target_pos] = source_fingerprints[source_pos]
+        stats.count('incremental_rows_kept', len(source_fingerprints) - len(source_positions))
+
+    # --- Preparar listas de cédulas aleatorias (orden estable entre ejecuciones incrementales) ---
+    driver_cedulas = _stored_or_shuffled_cedulas(LISTA_CEDULAS_CONDUCTOR, manifest.driver_cedulas if plan else None, "CONDUCTOR", CONDUCTOR_GROUP_SIZE)
+    auxiliar_cedulas = _stored_or_shuffled_cedulas(LISTA_CEDULAS_AUXILIAR, manifest.auxiliar_cedulas if plan else None, "AUXILIAR", AUXILIAR_GROUP_SIZE)
+    sap_decisions = load_sap_decision_store()
+
+    has_sap_lookups = bool(sap_keys1 or sap_keys2)
+    def match_rows(df_rows: pd.DataFrame) -> Tuple[pd.DataFrame, List[SucursalMatch]]:
+        """Claves y coincidencias SAP y sucursal/deudor de las filas fuente, una vez por clave distinta."""
+        with stats.phase('key_prep'):
+            # Texto repetitivo como categorías: la normalización y la coincidencia trabajan por categoría, no por fila
+            compact_low_cardinality_columns(df_rows, COMPACT_SOURCE_COLUMNS, stats)
+            df_rows['lookup_key_client_part1'] = normalize_client_part1_series(df_rows[SRC_COL_CLIENTE])
+            df_rows['lookup_key_residuo'] = normalize_text_series(df_rows[SRC_COL_RESIDUO])
+            df_rows['lookup_key_client_part2'] = normalize_client_part2_series(df_rows[SRC_COL_CLIENTE])
+            compact_low_cardinality_columns(df_rows, COMPACT_KEY_COLUMNS, stats)
+        with stats.phase('sap_match'):
+            df_sap_matches = batch_match_sap_codes(df_rows['lookup_key_residuo'], sap_map1, sap_keys1, sap_map2, sap_keys2,
+                                                   stored_codes=sap_decisions.selected_codes())
+        if has_sap_lookups and target_col_indices_map.get(TGT_COL_SAP):
+            n_residuo_keys = df_rows['lookup_key_residuo'].nunique(); _report_memo(stats, 'sap', "SAP", len(df_rows) - n_residuo_keys, n_residuo_keys)
+        sucursal_results = resolve_sucursal_matches(df_rows, suc_match_index, deudor_map_priority, sucursal_map_fallback,
+                                                    bool(target_col_indices_map.get(TGT_COL_DEUDOR_SUC)), bool(target_col_indices_map.get(TGT_COL_SUCURSAL)), stats)
+        return df_sap_matches, sucursal_results
+
+    def write_rows(df_rows: pd.DataFrame, df_sap_matches: pd.DataFrame, sucursal_results: List[SucursalMatch],
+                   target_rows: np.ndarray) -> Tuple[pd.DataFrame, List[Tuple[int, str]], List[Tuple[int, str]], int]:
+        """Cálculo por columnas y escritura en bloque de filas fuente ya emparejadas."""
+        df_rows_output, rows_sap_items, rows_sap_skipped = build_output_frame(
+            df_rows, df_sap_matches, target_col_indices_map,
+            suc_match_index, deudor_map_priority, sucursal_map_fallback,
+            has_sap_lookups=has_sap_lookups,
+            driver_cedulas=driver_cedulas, auxiliar_cedulas=auxiliar_cedulas,
+            skipped_residuo_keys=sap_decisions.skipped_keys(), stats=stats, target_rows=target_rows, sucursal_results=sucursal_results)
+        with stats.phase('cell_write'): rows_cells_written = write_output_frame(target_ws, df_rows_output, target_col_indices_map)
+        return df_rows_output, rows_sap_items, rows_sap_skipped, rows_cells_written
+
+    # --- 3. Procesamiento Principal ---
+    print(f"\n[Paso 3/5] Procesando filas y escribiendo en '{TARGET_SHEET_NAME}'...")
+    if not streaming:
+        if target_by_source_pos is not None:
+            df_source = df_source.iloc[list(target_by_source_pos)].reset_index(drop=True)
+            target_rows = np.fromiter(target_by_source_pos.values(), dtype=np.int64, count=len(target_by_source_pos))
+        else:
+            target_rows = TARGET_START_ROW_NUM + np.arange(len(df_source)); row_fingerprints = source_fingerprints or fingerprint_source_rows(df_source)
+        # Coincidencias una sola vez sobre todas las filas; los bloques solo calculan, escriben y reportan avance
+        progress.stage("Buscando coincidencias SAP y sucursal...")
+        df_sap_matches, sucursal_results = match_rows(df_source)
+        progress.stage("Escribiendo filas...", len(df_source))
+        block_rows = block_rows or max(len(df_source), 1) # Sin ventana de progreso: un solo bloque
+        block_outputs = []; sap_items_for_manual_selection = []; sap_items_skipped_by_decision = []; cells_written = 0
+        for block_start in range(0, len(df_source), block_rows):
+            block_slice = slice(block_start, block_start + block_rows)
+            block_output, block_sap_items, block_sap_skipped, block_cells = write_rows(
+                df_source.iloc[block_slice].reset_index(drop=True), df_sap_matches.iloc[block_slice].reset_index(drop=True),
+                sucursal_results[block_slice], target_rows[block_slice])
+            block_outputs.append(block_output); sap_items_for_manual_selection += block_sap_items; sap_items_skipped_by_decision += block_sap_skipped; cells_written += block_cells
+            progress.rows(block_start + len(block_output))
+        df_output = pd.concat(block_outputs) if len(block_outputs) > 1 else (block_outputs[0] if block_outputs else pd.DataFrame())
+        processed_rows_count = len(df_output)
+    else:
+        # Cada bloque se limpia, resuelve y escribe antes de leer el siguiente
+        df_output = pd.DataFrame() # En modo por bloques no se conserva la salida completa en memoria
+        sap_items_for_manual_selection = []; sap_items_skipped_by_decision = []; cells_written = 0; processed_rows_count = 0; chunk_start = 0
+        if target_by_source_pos is None: row_fingerprints = []
+        source_chunks = iter_source_chunks(input_excel_file, SOURCE_CHUNK_ROWS)
+        # Sin plan incremental el total de filas es una estimación (filas usadas de la hoja fuente)
+        progress.stage("Procesando filas por bloques...", len(target_by_source_pos) if target_by_source_pos is not None else estimated_source_rows)
+        while True:
+            with stats.phase('read'): df_chunk = next(source_chunks, None)
+            if df_chunk is None: break
+            chunk_positions = np.arange(chunk_start, chunk_start + len(df_chunk)); chunk_start += len(df_chunk)
+            if target_by_source_pos is None:
+                row_fingerprints.extend(fingerprint_source_rows(df_chunk)); target_rows = TARGET_START_ROW_NUM + chunk_positions
+            else:
+                keep = [pos in target_by_source_pos for pos in chunk_positions]
+                df_chunk = df_chunk[keep].reset_index(drop=True)
+                target_rows = np.array([target_by_source_pos[pos] for pos in chunk_positions[keep]], dtype=np.int64)
+                if not len(df_chunk): continue
+            chunk_output, chunk_sap_items, chunk_sap_skipped, chunk_cells = write_rows(df_chunk, *match_rows(df_chunk), target_rows)
+            sap_items_for_manual_selection += chunk_sap_items; sap_items_skipped_by_decision += chunk_sap_skipped; cells_written += chunk_cells; processed_rows_count += len(chunk_output)
+            progress.rows(processed_rows_count if target_by_source_pos is not None else chunk_start)
+            print(f"Bloque procesado: filas fuente hasta {chunk_start} ({processed_rows_count} filas escritas).")
+        stats.count('streaming_chunks', -(-chunk_start // SOURCE_CHUNK_ROWS))
+    last_written_excel_row = TARGET_START_ROW_NUM - 1 + len(row_fingerprints)
+    manifest = IncrementalManifest(row_fingerprints, driver_cedulas, auxiliar_cedulas,
+                                   target_sheet_signature(target_ws, target_col_indices_map, len(row_fingerprints)),
+                                   {row for row, _ in sap_items_for_manual_selection + sap_items_skipped_by_decision})
+
+    print(f"FASE 1 (Procesamiento Automático) completada. {processed_rows_count} filas procesadas ({cells_written} celdas escritas).")
+    if sap_items_skipped_by_decision: print(f" -> {len(sap_items_skipped_by_decision)} filas sin SAP por decisión guardada de omitir (no se preguntarán).")
+    if sap_items_for_manual_selection: print(f" -> {len(sap_items_for_manual_selection)} residuos requieren selección manual de SAP.")
+    return AutomaticPhaseResult(workbook, sap_decisions, target_ws, target_col_indices_map, df_output, sap_items_for_manual_selection,
+                                sap_options_for_popup, driver_cedulas, auxiliar_cedulas, processed_rows_count, last_written_excel_row, stats, manifest,
+                                sap_items_skipped_by_decision=sap_items_skipped_by_decision, source_sheet_loaded=source_sheet_loaded)
+
+# ==============================================================================
+# --- Punto de Control y Reanudación de la Fase 2 ---
+# ==============================================================================
+def checkpoint_path_for(workbook_path: str) -> str:
+    return os.path.splitext(workbook_path)[0] + SAP_CHECKPOINT_SUFFIX
+
+@dataclass
+class SapCheckpoint:
+    """Estado de la selección manual SAP al pulsar 'Guardar y Salir', para reanudar sin repetir la Fase 1."""
+    pending_items: List[Tuple[int, str]]
+    sap_selection_cache: Dict[str, str]
+    sap_options: Dict[str, str]               # Texto mostrado en el popup -> código SAP
+    target_col_indices_map: Dict[str, List[int]]
+    last_written_excel_row: int
+    driver_cedulas: List[str]
+    auxiliar_cedulas: List[str]
+    row_fingerprints: List[str]               # Manifiesto incremental de las filas ya escritas
+    target_signature: str
+    unresolved_rows: List[int]                # Filas destino aún sin SAP resuelto
+
+    @classmethod
+    def from_phase(cls, phase1: 'AutomaticPhaseResult', pending_items: List[Tuple[int, str]], sap_selection_cache: Dict[str, str]) -> 'SapCheckpoint':
+        return cls(list(pending_items), dict(sap_selection_cache), phase1.sap_options_for_popup.choices, phase1.target_col_indices_map,
+                   phase1.last_written_excel_row, phase1.driver_cedulas, phase1.auxiliar_cedulas,
+                   phase1.manifest.row_fingerprints, phase1.manifest.target_signature, sorted(phase1.manifest.unresolved_rows))
+
+    def save(self, workbook_path: str):
+        path = checkpoint_path_for(workbook_path)
+        data = {'version': SAP_CHECKPOINT_VERSION, 'saved_at': datetime.now().isoformat(timespec='seconds'), **asdict(self)}
+        with open(path, 'w', encoding='utf-8') as f: json.dump(data, f, ensure_ascii=False)
+        print(f" -> Punto de control guardado en '{path}' ({len(self.pending_items)} ítems SAP pendientes).")
+
+    @classmethod
+    def load(cls, workbook_path: str) -> Optional['SapCheckpoint']:
+        path = checkpoint_path_for(workbook_path)
+        if not os.path.exists(path): return None
+        try:
+            with open(path, 'r', encoding='utf-8') as f: data = json.load(f)
+            if data.pop('version', None) != SAP_CHECKPOINT_VERSION: print("Punto de control con versión distinta; se ignora."); return None
+            data.pop('saved_at', None)
+            checkpoint = cls(**data)
+            checkpoint.pending_items = [(int(row), str(residuo)) for row, residuo in checkpoint.pending_items]
+            return checkpoint
+        except Exception as e: print(f"Advertencia: No se pudo leer el punto de control '{path}': {e}"); return None
+
+def resume_from_checkpoint(progress_excel_file: str, checkpoint: SapCheckpoint) -> AutomaticPhaseResult:
+    """
+    Reabre el libro de progreso y reconstruye el estado de la Fase 1 desde el punto de
+    control (sin releer lookups ni recalcular coincidencias).
+
+    Raises:
+        ProcessingError: si falta la hoja destino o ya no corresponde al punto de control.
+    """
+    print(f"\n[Paso 2-3/5] Reanudando desde punto de control: {len(checkpoint.pending_items)} ítems SAP pendientes...")
+    stats = RunStats(progress_excel_file)
+    with stats.phase('read'):
+        t_start = time.perf_counter(); workbook = openpyxl.load_workbook(progress_excel_file)
+        print(f"Libro '{os.path.basename(progress_excel_file)}' abierto en {time.perf_counter() - t_start:.2f}s.")
+    if TARGET_SHEET_NAME not in workbook.sheetnames: raise ProcessingError("Error Hoja Destino", f"No se encontró '{TARGET_SHEET_NAME}'.")
+    target_ws = workbook[TARGET_SHEET_NAME]
+    if target_sheet_signature(target_ws, checkpoint.target_col_indices_map, len(checkpoint.row_fingerprints)) != checkpoint.target_signature:
+        raise ProcessingError("Punto de Control Inválido", f"'{TARGET_SHEET_NAME}' cambió desde que se guardó el progreso.\nProcese el libro completo de nuevo.")
+    manifest = IncrementalManifest(checkpoint.row_fingerprints, checkpoint.driver_cedulas, checkpoint.auxiliar_cedulas, checkpoint.target_signature,
+                                   set(checkpoint.unresolved_rows))
+    return AutomaticPhaseResult(workbook, load_sap_decision_store(), target_ws, checkpoint.target_col_indices_map, pd.DataFrame(),
+                                checkpoint.pending_items, SapPopupOptions(checkpoint.sap_options), checkpoint.driver_cedulas,
+                                checkpoint.auxiliar_cedulas, 0, checkpoint.last_written_excel_row, stats, manifest,
+                                sap_selection_cache=dict(checkpoint.sap_selection_cache), resumed_from=checkpoint_path_for(progress_excel_file))
+
+# ==============================================================================
+# --- Guardado Final ---
+# ==============================================================================
+def output_format_for_path(output_path: str, preferred: str = OUTPUT_FORMAT) -> str:
+    """Un archivo .csv siempre se exporta como CSV; un .xlsx usa el formato preferido (libro u hoja)."""
+    if output_path.lower().endswith(OUTPUT_FORMAT_EXTENSIONS[OUTPUT_FORMAT_CSV]): return OUTPUT_FORMAT_CSV
+    return OUTPUT_FORMAT_SHEET if preferred == OUTPUT_FORMAT_CSV else preferred
+
+def save_final_output(phase1: AutomaticPhaseResult, output_path: str, output_format: str = OUTPUT_FORMAT):
+    """
+    Guarda el resultado final. OUTPUT_FORMAT_FULL limpia las filas antiguas y re-guarda el
+    libro completo (con manifiesto incremental); los formatos de solo hoja exportan la hoja
+    de cargue hasta la última fila escrita, sin limpieza ni manifiesto (no sirven de entrada).
+    """
+    stats = phase1.stats
+    if output_format == OUTPUT_FORMAT_FULL:
+        if not phase1.source_sheet_loaded: raise ProcessingError("Error Formato", f"'{SOURCE_SHEET_NAME}' no se cargó en el libro (lectura por bloques); guarde solo la hoja o en CSV.")
+        with stats.phase('cleanup'): cleanup_rows_below_data(phase1.target_ws, phase1.last_written_excel_row, phase1.all_processed_col_indices)
+        with stats.phase('save'): phase1.workbook.save(output_path)
+        phase1.manifest.save(output_path)
+        return
+    export = export_upload_sheet_csv if output_format == OUTPUT_FORMAT_CSV else export_upload_sheet_xlsx
+    with stats.phase('save'):
+        t_start = time.perf_counter(); rows_exported = export(phase1.target_ws, phase1.last_written_excel_row, output_path)
+    print(f"Hoja '{TARGET_SHEET_NAME}' exportada ({output_format}): {rows_exported} filas en {time.perf_counter() - t_start:.2f}s.")
+
 def main():
     """Función principal que orquesta todo el proceso."""
     print("--- Iniciando Proceso de Procesamiento de Plantilla ---")
@@ -380,189 +1905,38 @@ def main():
         if not input_excel_file: print("Operación cancelada."); return
         print(f"Archivo seleccionado: {input_excel_file}")
 
-        # --- 2. Lectura y Preparación ---
-        print(f"\n[Paso 2/5] Leyendo datos y preparando búsquedas...")
-        try:
-            df_source = pd.read_excel(input_excel_file, sheet_name=SOURCE_SHEET_NAME)
-            print(f"Datos leídos de '{SOURCE_SHEET_NAME}' ({len(df_source)} filas).")
-        except Exception as e: print(f"Error Crítico: No se pudo leer '{SOURCE_SHEET_NAME}'. {e}"); messagebox.showerror("Error Lectura", f"No se pudo leer '{SOURCE_SHEET_NAME}'.\n\n{e}"); return
-
-        sucursal_map_fallback, suc_deudor_fuzzy_data, suc_names_fuzzy, deudor_map_priority = load_sucursal_lookup(input_excel_file)
-        sap_map1, sap_keys1, sap_map2, sap_keys2 = load_sap_lookups(input_excel_file)
-        sap_options_for_popup = prepare_sap_choices_for_popup(sap_map1, sap_map2)
-
-        source_cols_required = list(COLUMN_MAPPING_DIRECT.keys()) + [SRC_COL_RESIDUO]
-        missing_src_cols = [col for col in source_cols_required if col not in df_source.columns]
-        if missing_src_cols: print(f"Error Crítico: Faltan columnas fuente: {missing_src_cols}"); messagebox.showerror("Error Columnas Fuente", f"Faltan en '{SOURCE_SHEET_NAME}':\n{', '.join(missing_src_cols)}"); return
-        print("Verificación de columnas fuente: OK.")
-
-        print("Pre-procesando claves de búsqueda...")
-        df_source['lookup_key_client_part1'] = df_source[SRC_COL_CLIENTE].apply(lambda x: clean_client_name_part(str(x).split('-', maxsplit=1)[0]))
-        df_source['lookup_key_residuo'] = df_source[SRC_COL_RESIDUO].apply(clean_text_for_comparison)
-        def get_cleaned_part_after_hyphen(name): parts = str(name).split('-', 1); return clean_text_for_comparison(parts[1].strip()) if len(parts) > 1 else ""
-        df_source['lookup_key_client_part2'] = df_source[SRC_COL_CLIENTE].apply(get_cleaned_part_after_hyphen)
-        print("Pre-procesamiento de claves completado.")
-
-        # --- Preparar listas de cédulas aleatorias ---
-        driver_cedulas = LISTA_CEDULAS_CONDUCTOR[:] # Copiar
-        if not driver_cedulas:
-            print("Advertencia: Lista de cédulas de CONDUCTOR vacía.")
-        else:
-            random.shuffle(driver_cedulas)
-            print(f"Lista de {len(driver_cedulas)} cédulas de CONDUCTOR mezclada (grupos de {CONDUCTOR_GROUP_SIZE}).")
-
-        auxiliar_cedulas = LISTA_CEDULAS_AUXILIAR[:] # Copiar
-        if not auxiliar_cedulas:
-             print("Advertencia: Lista de cédulas de AUXILIAR vacía.")
-        else:
-            random.shuffle(auxiliar_cedulas)
-            print(f"Lista de {len(auxiliar_cedulas)} cédulas de AUXILIAR mezclada (grupos de {AUXILIAR_GROUP_SIZE}).")
-
-
-        # --- 3. Procesamiento Principal ---
-        print(f"\n[Paso 3/5] Procesando filas y escribiendo en '{TARGET_SHEET_NAME}'...")
-        try:
-            workbook = openpyxl.load_workbook(input_excel_file)
-            if TARGET_SHEET_NAME not in workbook.sheetnames: print(f"Error Crítico: No se encontró hoja destino '{TARGET_SHEET_NAME}'."); messagebox.showerror("Error Hoja Destino", f"No se encontró '{TARGET_SHEET_NAME}'."); return
-            target_ws = workbook[TARGET_SHEET_NAME]
-            print(f"Hoja destino '{TARGET_SHEET_NAME}' accesible.")
-        except Exception as e: print(f"Error Crítico: No se pudo cargar/acceder a hoja destino. {e}"); messagebox.showerror("Error Workbook", f"No se pudo cargar/acceder a '{TARGET_SHEET_NAME}'.\n\n{e}"); return
-
-        # <<< MODIFICADO: Usar la nueva función para obtener índices (maneja duplicados) >>>
-        target_cols_to_find = list(COLUMN_MAPPING_DIRECT.values()) + EXTRA_TARGET_COLS_TO_PROCESS
-        # Eliminar duplicados de la lista de búsqueda para evitar mensajes repetidos
-        target_col_indices_map = find_target_column_indices_with_duplicates(target_ws, list(set(target_cols_to_find)))
-
-        # Verificar columnas esenciales mapeadas
-        missing_essential_tgt = [tgt for src, tgt in COLUMN_MAPPING_DIRECT.items() if not target_col_indices_map.get(tgt)]
-        if missing_essential_tgt: print(f"Error Crítico: Faltan columnas destino mapeadas: {missing_essential_tgt}"); messagebox.showerror("Error Columnas Destino", f"Faltan en '{TARGET_SHEET_NAME}':\n{', '.join(missing_essential_tgt)}"); return
-
-        # Obtener índices específicos (tomando el primero si hay duplicados, excepto para '1')
-        tgt_idx_sucursal = target_col_indices_map.get(TGT_COL_SUCURSAL, [None])[0]
-        tgt_idx_deudor_suc = target_col_indices_map.get(TGT_COL_DEUDOR_SUC, [None])[0]
-        tgt_idx_sap = target_col_indices_map.get(TGT_COL_SAP, [None])[0]
-        tgt_idx_cedula_conductor = target_col_indices_map.get(TGT_COL_CEDULA_CONDUCTOR, [None])[0]
-        tgt_idx_cedula_auxiliar = target_col_indices_map.get(TGT_COL_CEDULA_AUXILIAR, [None])[0]
-        tgt_idx_nombre_entrega = target_col_indices_map.get(TGT_COL_NOMBRE_ENTREGA, [None])[0]
-        tgt_idx_cargo_entrega = target_col_indices_map.get(TGT_COL_CARGO_ENTREGA, [None])[0]
-        # Obtener todos los índices para la columna '1'
-        tgt_indices_uno = target_col_indices_map.get(TGT_COL_UNO, [])
-
-
-        sap_items_for_manual_selection: List[Tuple[int, str]] = []
-        processed_rows_count = 0
-        last_written_excel_row = TARGET_START_ROW_NUM - 1
-
-        # --- Bucle Principal ---
-        for idx, source_row in df_source.iterrows():
-            current_target_row = TARGET_START_ROW_NUM + idx
-            last_written_excel_row = current_target_row; processed_rows_count += 1
-
-            client_key_part1 = source_row['lookup_key_client_part1']
-            client_key_part2 = source_row['lookup_key_client_part2']
-            residuo_key = source_row['lookup_key_residuo']
-            original_residuo_name = str(source_row[SRC_COL_RESIDUO]).strip()
-            original_client_name = str(source_row[SRC_COL_CLIENTE]).strip()
-
-            # --- a) Mapeo Directo ---
-            for src_col, tgt_col in COLUMN_MAPPING_DIRECT.items():
-                # Usar el primer índice encontrado para estas columnas
-                tgt_idx = target_col_indices_map.get(tgt_col, [None])[0]
-                if tgt_idx:
-                    value_to_write = original_client_name if src_col == SRC_COL_CLIENTE else source_row[src_col]
-                    if tgt_col == TGT_COL_FECHA and isinstance(value_to_write, pd.Timestamp): 
-                        try: value_to_write = value_to_write.strftime('%Y-%m-%d') 
-                        except ValueError: value_to_write = ""
-                    elif tgt_col == TGT_COL_PESO: value_to_write = safe_str_conversion(value_to_write)
-                    target_ws.cell(row=current_target_row, column=tgt_idx, value=value_to_write)
-
-            # --- b) Búsqueda Sucursal / Código Deudor (PRIORIDAD INVERTIDA) ---
-            final_sucursal_to_write = ""; final_deudor_code_to_write = ""
-            match_found = False
-            # Prioridad 1: Fuzzy Parte 2
-            if not match_found and tgt_idx_deudor_suc and client_key_part2 and suc_names_fuzzy:
-                match_info_part2 = process.extractOne(client_key_part2, suc_names_fuzzy, score_cutoff=FUZZY_SUCURSAL_SIMILARITY_THRESHOLD)
-                if match_info_part2:
-                    matched_suc_clean_name, score = match_info_part2
-                    for suc_clean, debtor_code, suc_original in suc_deudor_fuzzy_data:
-                        if suc_clean == matched_suc_clean_name:
-                             final_deudor_code_to_write = debtor_code; final_sucursal_to_write = suc_original; match_found = True
-                             print(f"  Fila {current_target_row}: Match Fuzzy (Parte 2: '{client_key_part2}') -> Suc: '{sucursal_original}', Deudor: '{debtor_code}' ({score}%)")
-                             break
-            # Prioridad 2: Cliente == Sucursal
-            if not match_found and tgt_idx_deudor_suc and client_key_part1 in deudor_map_priority:
-                 codigo_deudor, sucursal_original = deudor_map_priority[client_key_part1]
-                 final_deudor_code_to_write = codigo_deudor; final_sucursal_to_write = sucursal_original; match_found = True
-                 print(f"  Fila {current_target_row}: Match Prioritario (Cliente==Sucursal) -> Suc: '{sucursal_original}', Deudor: '{codigo_deudor}'")
-            # Prioridad 3: Fallback
-            if not match_found and tgt_idx_sucursal and sucursal_map_fallback:
-                 sucursal_from_fallback = sucursal_map_fallback.get(client_key_part1, "")
-                 if sucursal_from_fallback: final_sucursal_to_write = sucursal_from_fallback
-            # Escribir resultados
-            if tgt_idx_sucursal: target_ws.cell(row=current_target_row, column=tgt_idx_sucursal, value=final_sucursal_to_write)
-            if tgt_idx_deudor_suc: target_ws.cell(row=current_target_row, column=tgt_idx_deudor_suc, value=final_deudor_code_to_write)
-
-            # --- c) Búsqueda Código SAP ---
-            found_sap_code = ""; sap_match_score = 0
-            if tgt_idx_sap and (sap_keys1 or sap_keys2):
-                sap_cell_to_write = target_ws.cell(row=current_target_row, column=tgt_idx_sap)
-                if sap_keys1:
-                    match1 = process.extractOne(residuo_key, sap_keys1, score_cutoff=FUZZY_SAP_SIMILARITY_THRESHOLD) # Corregido
-                    if match1: key1, score1 = match1; found_sap_code = sap_map1.get(key1, ""); sap_match_score = score1
-                if not found_sap_code and sap_keys2:
-                    match2 = process.extractOne(residuo_key, sap_keys2, score_cutoff=FUZZY_SAP_SIMILARITY_THRESHOLD) # Corregido
-                    if match2: key2, score2 = match2; found_sap_code = sap_map2.get(key2, ""); sap_match_score = score2
-                if found_sap_code and str(found_sap_code).lower() != 'nan':
-                    sap_cell_to_write.value = found_sap_code;
-                    sap_cell_to_write.fill = HIGHLIGHT_YELLOW if FUZZY_SAP_SIMILARITY_THRESHOLD <= sap_match_score < 100 else HIGHLIGHT_NONE
-                else:
-                    sap_cell_to_write.value = None; sap_cell_to_write.fill = HIGHLIGHT_NONE;
-                    sap_items_for_manual_selection.append((current_target_row, original_residuo_name))
-            elif tgt_idx_sap: target_ws.cell(row=current_target_row, column=tgt_idx_sap, value=None).fill = HIGHLIGHT_NONE
-
-            # --- d) Asignación Cédula Conductor ---
-            if tgt_idx_cedula_conductor and driver_cedulas:
-                group_index = idx // CONDUCTOR_GROUP_SIZE
-                driver_index = group_index % len(driver_cedulas)
-                assigned_cedula = driver_cedulas[driver_index]
-                target_ws.cell(row=current_target_row, column=tgt_idx_cedula_conductor, value=assigned_cedula)
-            elif tgt_idx_cedula_conductor: target_ws.cell(row=current_target_row, column=tgt_idx_cedula_conductor, value=None)
-
-            # --- e) Asignación Cédula Auxiliar ---
-            if tgt_idx_cedula_auxiliar and auxiliar_cedulas:
-                group_index_aux = idx // AUXILIAR_GROUP_SIZE # Usar tamaño de grupo auxiliar
-                aux_index = group_index_aux % len(auxiliar_cedulas)
-                assigned_cedula_aux = auxiliar_cedulas[aux_index]
-                target_ws.cell(row=current_target_row, column=tgt_idx_cedula_auxiliar, value=assigned_cedula_aux)
-            elif tgt_idx_cedula_auxiliar: target_ws.cell(row=current_target_row, column=tgt_idx_cedula_auxiliar, value=None)
-
-            # --- f) Asignación Valores Fijos ---
-            if tgt_idx_nombre_entrega:
-                target_ws.cell(row=current_target_row, column=tgt_idx_nombre_entrega, value=FIXED_STRING_SIN_DESCRIPCION)
-            if tgt_idx_cargo_entrega:
-                target_ws.cell(row=current_target_row, column=tgt_idx_cargo_entrega, value=FIXED_STRING_SIN_DESCRIPCION)
-
-            # --- g) Asignación Columnas '1' ---
-            # Escribir en todas las columnas encontradas que se llaman '1'
-            if tgt_indices_uno:
-                for col_1_idx in tgt_indices_uno:
-                     target_ws.cell(row=current_target_row, column=col_1_idx, value=FIXED_NUMBER_UNO)
-
-        # --- Fin del bucle for idx, source_row ---
-
-        print(f"FASE 1 (Procesamiento Automático) completada. {processed_rows_count} filas procesadas.")
-        if sap_items_for_manual_selection: print(f" -> {len(sap_items_for_manual_selection)} residuos requieren selección manual de SAP.")
+        # --- 2 y 3. Lectura, Preparación y Procesamiento Automático (o reanudación) ---
+        checkpoint = SapCheckpoint.load(input_excel_file)
+        resume = checkpoint is not None and messagebox.askyesno(
+            "Reanudar", f"Se encontró un progreso guardado con {len(checkpoint.pending_items)} residuos SAP pendientes.\n\n¿Reanudar la selección manual?", parent=root)
+        # Libro ya procesado: No reprocesa todas las filas (p. ej. si la hoja destino se editó a mano)
+        incremental = not resume and USE_INCREMENTAL_MODE and os.path.exists(manifest_path_for(input_excel_file)) and messagebox.askyesno(
+            "Modo Incremental", "Este libro ya fue procesado antes.\n\n¿Procesar solo las filas nuevas o cambiadas de WEB2.0?\n(No: reprocesar todas las filas)", parent=root)
+        progress = ProgressReporter()
+        phase1_work = (lambda: resume_from_checkpoint(input_excel_file, checkpoint)) if resume else (lambda: run_automatic_phase(input_excel_file, incremental, progress=progress))
+        # La reanudación no comprueba la cancelación: la ventana se muestra sin botón Cancelar
+        try: phase1 = run_with_progress(root, "Procesando plantilla", phase1_work, progress, cancellable=not resume)
+        except ProcessingCancelled: print("Operación cancelada por el usuario (no se guardó nada)."); return
+        except ProcessingError as pe: messagebox.showerror(pe.title, str(pe)); return
+        workbook = phase1.workbook; target_ws = phase1.target_ws
+        sap_items_for_manual_selection = phase1.sap_items_for_manual_selection
+        sap_options_for_popup = phase1.sap_options_for_popup
+        tgt_idx_sap = phase1.tgt_idx_sap
+        last_written_excel_row = phase1.last_written_excel_row
+        stats = phase1.stats
 
         # --- 4. FASE 2: Selección Manual Interactiva (SAP) ---
         if sap_items_for_manual_selection and sap_options_for_popup and tgt_idx_sap:
             print(f"\n[Paso 4/5] Iniciando Selección Manual de SAP ({len(sap_items_for_manual_selection)} ítems)...")
-            sap_selection_cache: Dict[str, str] = {}; selected_count, skipped_count, cache_hit_count = 0, 0, 0; abort_process = False
+            sap_selection_cache: Dict[str, str] = dict(phase1.sap_selection_cache); selected_count, skipped_count, cache_hit_count = 0, 0, 0; abort_process = False
+            manual_phase_start = time.perf_counter()
             for item_index, (target_row_num, residuo_name) in enumerate(sap_items_for_manual_selection):
                 print(f"\nProc SAP Manual {item_index + 1}/{len(sap_items_for_manual_selection)} -> F:{target_row_num}, R:'{residuo_name}'")
                 if residuo_name in sap_selection_cache: user_choice = sap_selection_cache[residuo_name]; print(f" -> Caché SAP: '{user_choice if user_choice != 'SKIP' else 'Omitido'}'"); cache_hit_count += 1
                 else:
                     if not tk._default_root or not root.winfo_exists(): print("Adv: Recreando root Tk."); root = tk.Tk(); root.withdraw()
                     user_choice = show_manual_sap_selection_popup(root, residuo_name, sap_options_for_popup)
+                    explicit_decision = sap_popup_choice_is_decision # Cerrar con 'X' o un guardado fallido/cancelado no son decisiones
                     if user_choice is None: print("Error: Popup SAP falló."); abort_process = True; break
                     if user_choice == "SAVE_EXIT":
                         print(" -> 'Guardar y Salir'...");
@@ -573,16 +1947,28 @@ def main():
                         if output_save_path:
                             try:
                                 print(f" -> Guardando: {output_save_path}..."); print(" -> Limpiando...");
-                                # <<< Obtener TODOS los índices de columnas procesadas para limpieza >>>
-                                all_processed_indices = []
-                                for indices in target_col_indices_map.values():
-                                    all_processed_indices.extend(indices)
-                                cleanup_rows_below_data(target_ws, last_written_excel_row, list(set(all_processed_indices))) # Usar set para evitar duplicados
-                                workbook.save(output_save_path); print(" -> Progreso guardado."); user_saved_mid_process = True; abort_process = True; break
+                                def save_progress():
+                                    with stats.phase('cleanup'): cleanup_rows_below_data(target_ws, last_written_excel_row, phase1.all_processed_col_indices)
+                                    with stats.phase('save'): workbook.save(output_save_path)
+                                run_with_progress(root, "Guardando progreso", save_progress, ProgressReporter(), cancellable=False)
                             except Exception as e: print(f" -> ERROR guardando: {e}"); messagebox.showerror("Error Guardar", f"No se pudo guardar.\n\n{e}", parent=root); user_choice = "SKIP"
+                            else:
+                                # El libro ya quedó guardado: un fallo del punto de control solo impide reanudar
+                                phase1.manifest.save(output_save_path) # Advierte por consola si falla; sin manifiesto se reprocesa todo
+                                try: SapCheckpoint.from_phase(phase1, sap_items_for_manual_selection[item_index:], sap_selection_cache).save(output_save_path)
+                                except Exception as e:
+                                    print(f" -> Advertencia: No se pudo guardar el punto de control: {e}")
+                                    with contextlib.suppress(OSError): os.remove(checkpoint_path_for(output_save_path)) # No reanudar desde uno anterior
+                                    messagebox.showwarning("Punto de Control", f"El progreso se guardó, pero no el punto de control para reanudar.\nAl reabrir el libro se procesará de nuevo.\n\n{e}", parent=root)
+                                print(" -> Progreso guardado."); user_saved_mid_process = True; abort_process = True; break
+                    if explicit_decision: phase1.sap_decisions.record(residuo_name, user_choice)
                     if user_choice != "SAVE_EXIT": sap_selection_cache[residuo_name] = user_choice; (selected_count := selected_count + 1) if user_choice != "SKIP" else (skipped_count := skipped_count + 1)
-                if user_choice not in ["SKIP", "SAVE_EXIT"] and tgt_idx_sap: cell = target_ws.cell(row=target_row_num, column=tgt_idx_sap); cell.value = user_choice; cell.fill = HIGHLIGHT_BLUE
-                elif user_choice == "SKIP" and tgt_idx_sap: cell = target_ws.cell(row=target_row_num, column=tgt_idx_sap); cell.value = None; cell.fill = HIGHLIGHT_NONE
+                if user_choice not in ["SKIP", "SAVE_EXIT"] and tgt_idx_sap:
+                    cell = target_ws.cell(row=target_row_num, column=tgt_idx_sap); cell.value = user_choice; cell.fill = HIGHLIGHT_BLUE; stats.count('sap_manual')
+                    phase1.manifest.unresolved_rows.discard(target_row_num) # Ya tiene SAP: cuenta como escrita en el manifiesto
+                elif user_choice == "SKIP" and tgt_idx_sap: cell = target_ws.cell(row=target_row_num, column=tgt_idx_sap); cell.value = None; cell.fill = HIGHLIGHT_NONE; stats.count('sap_manual_skipped')
+            # Tiempo de espera del usuario incluido; las fases de guardado intermedio se registran aparte
+            stats.phase_seconds['manual_sap'] = time.perf_counter() - manual_phase_start - stats.phase_seconds.get('cleanup', 0.0) - stats.phase_seconds.get('save', 0.0)
             if not abort_process: print(f"\nFASE 2 (SAP) Completada. Únicos: {len(sap_selection_cache)} (Sel:{selected_count}, Skip:{skipped_count}, Cache:{cache_hit_count})")
             else: print("\nFASE 2 (SAP) interrumpida.")
         elif sap_items_for_manual_selection: print("\n[Paso 4/5] Omitido: Selección Manual SAP no posible.")
@@ -592,18 +1978,20 @@ def main():
         # --- 5. Limpieza Final y Guardado ---
         if not user_saved_mid_process:
             print(f"\n[Paso 5/5] Limpiando y guardando...")
-            # <<< Obtener TODOS los índices de columnas procesadas para limpieza final >>>
-            all_processed_indices = []
-            for indices in target_col_indices_map.values():
-                all_processed_indices.extend(indices)
-            cleanup_rows_below_data(target_ws, last_written_excel_row, list(set(all_processed_indices))) # Usar set para evitar duplicados
-
-            base = os.path.splitext(os.path.basename(input_excel_file))[0]; sug = f"{base}_procesado.xlsx"; final_save_path = filedialog.asksaveasfilename(parent=root, title="Guardar archivo final", defaultextension=".xlsx", filetypes=[("Excel", "*.xlsx")], initialfile=sug)
+            base = os.path.splitext(os.path.basename(input_excel_file))[0]; ext = OUTPUT_FORMAT_EXTENSIONS[OUTPUT_FORMAT]; sug = f"{base}_procesado{ext}"
+            filetypes = [("Excel", "*.xlsx"), ("CSV", "*.csv")]; filetypes.sort(key=lambda ft: ft[1] != f"*{ext}")
+            final_save_path = filedialog.asksaveasfilename(parent=root, title="Guardar archivo final", defaultextension=ext, filetypes=filetypes, initialfile=sug)
             if not final_save_path: print("\nGuardado final cancelado.")
             else:
-                try: workbook.save(final_save_path); print(f"\n--- ¡PROCESO COMPLETADO! ---"); print(f"Archivo guardado en: '{final_save_path}'"); messagebox.showinfo("Completado", f"Guardado en:\n{final_save_path}", parent=root)
+                try:
+                    run_with_progress(root, "Guardando archivo final", lambda: save_final_output(phase1, final_save_path, output_format_for_path(final_save_path)),
+                                      ProgressReporter(), cancellable=False)
+                    if phase1.resumed_from and os.path.exists(phase1.resumed_from): os.remove(phase1.resumed_from); print(f"Punto de control '{phase1.resumed_from}' completado y eliminado.")
+                    print(f"\n--- ¡PROCESO COMPLETADO! ---"); print(f"Archivo guardado en: '{final_save_path}'")
+                    stats.print_summary(); stats.write_report(final_save_path)
+                    messagebox.showinfo("Completado", f"Guardado en:\n{final_save_path}", parent=root)
                 except Exception as e: print(f"\nError Crítico guardando final: {e}"); messagebox.showerror("Error Guardar Final", f"No se pudo guardar.\n\n{e}", parent=root)
-        else: print(f"\n--- ¡PROCESO INTERRUMPIDO Y GUARDADO! ---"); print(f"Progreso guardado en: '{output_save_path}'"); messagebox.showinfo("Guardado", f"Progreso guardado en:\n{output_save_path}", parent=root)
+        else: print(f"\n--- ¡PROCESO INTERRUMPIDO Y GUARDADO! ---"); print(f"Progreso guardado en: '{output_save_path}'"); stats.print_summary(); stats.write_report(output_save_path); messagebox.showinfo("Guardado", f"Progreso guardado en:\n{output_save_path}", parent=root)
 
     except Exception as main_error:
         print(f"\n--- ERROR INESPERADO ---"); print(f"Error: {main_error}"); traceback.print_exc()
@@ -615,8 +2003,133 @@ def main():
             except Exception: pass
     print("\n--- Script finalizado. ---")
 
+# ==============================================================================
+# --- Modo por Lotes sin GUI (CLI) ---
+# ==============================================================================
+def write_pending_sap_report(report_path: str, sap_items: List[Tuple[int, str]], skipped_items: List[Tuple[int, str]] = ()):
+    """
+    Reporte lateral con las filas que en modo GUI abrirían el popup de selección manual SAP
+    y las que quedan sin SAP por una decisión guardada de omitir (decisiones_sap.json).
+    """
+    with open(report_path, 'w', newline='', encoding='utf-8-sig') as f:
+        writer = csv.writer(f, delimiter=';')
+        writer.writerow(['Fila', 'Residuo', 'Motivo'])
+        rows = [(row, residuo, 'Pendiente') for row, residuo in sap_items] + [(row, residuo, 'Omitido (decisión guardada)') for row, residuo in skipped_items]
+        writer.writerows(sorted(rows))
+
+def process_workbook_headless(input_excel_file: str, output_dir: str,
+                              streaming: bool = USE_STREAMING_SOURCE, output_format: str = OUTPUT_FORMAT) -> Dict[str, Any]:
+    """
+    Procesa un libro completo sin GUI: Fase 1 automática, reporte de pendientes SAP
+    (en lugar del popup) y guardado en output_dir según output_format.
+    Siempre procesa todas las filas: el modo incremental es solo de la GUI (reabrir un libro ya procesado).
+
+    Returns:
+        Resumen del libro procesado (rutas, filas, pendientes SAP, tiempos/contadores y duración).
+    """
+    start_time = time.perf_counter()
+    phase1 = run_automatic_phase(input_excel_file, incremental=False, streaming=streaming, output_format=output_format); stats = phase1.stats
+    base = os.path.splitext(os.path.basename(input_excel_file))[0]
+    report_path = None
+    if phase1.sap_items_for_manual_selection or phase1.sap_items_skipped_by_decision:
+        report_path = os.path.join(output_dir, f"{base}{BATCH_PENDING_SAP_REPORT_SUFFIX}")
+        write_pending_sap_report(report_path, phase1.sap_items_for_manual_selection, phase1.sap_items_skipped_by_decision)
+        print(f"Reporte de pendientes SAP: '{report_path}' ({len(phase1.sap_items_for_manual_selection)} pendientes, {len(phase1.sap_items_skipped_by_decision)} omitidas por decisión guardada).")
+    output_path = os.path.join(output_dir, f"{base}{os.path.splitext(BATCH_OUTPUT_SUFFIX)[0]}{OUTPUT_FORMAT_EXTENSIONS[output_format]}")
+    save_final_output(phase1, output_path, output_format)
+    stats.print_summary(); run_report_path = stats.write_report(output_path)
+    return {'input': input_excel_file, 'output': output_path, 'rows': phase1.processed_rows_count,
+            'pending_sap': len(phase1.sap_items_for_manual_selection), 'pending_report': report_path,
+            'run_report': run_report_path, 'stats': stats.to_report(), 'seconds': round(time.perf_counter() - start_time, 2)}
+
+def _init_pool_worker():
+    """Inicializador de cada proceso del pool por lotes."""
+    global LOOKUP_CACHE_WRITE, FUZZY_CDIST_WORKERS; LOOKUP_CACHE_WRITE = False # Varios procesos escribirían la misma caché a la vez
+    FUZZY_CDIST_WORKERS = 1 # El paralelismo ya lo da el pool de procesos
+
+def _batch_worker(input_excel_file: str, output_dir: str, verbose: bool = False,
+                  streaming: bool = USE_STREAMING_SOURCE, output_format: str = OUTPUT_FORMAT) -> Dict[str, Any]:
+    """Punto de entrada de cada proceso del pool; nunca lanza excepciones al proceso principal."""
+    global VERBOSE_ROW_LOGGING; VERBOSE_ROW_LOGGING = verbose
+    try: return process_workbook_headless(input_excel_file, output_dir, streaming, output_format)
+    except Exception as e: traceback.print_exc(); return {'input': input_excel_file, 'error': str(e)}
+
+def collect_input_workbooks(input_paths: List[str]) -> List[str]:
+    """Expande directorios a sus .xlsx (omitiendo temporales '~$' y salidas previas)."""
+    workbooks: List[str] = []
+    for path in input_paths:
+        candidates = sorted(glob.glob(os.path.join(path, '*.xlsx'))) if os.path.isdir(path) else [path]
+        for candidate in candidates:
+            name = os.path.basename(candidate)
+            if name.startswith('~$') or name.endswith(BATCH_OUTPUT_SUFFIX): continue
+            if candidate not in workbooks: workbooks.append(candidate)
+    return workbooks
+
+def batch_output_dirs(workbooks: List[str], output_dir: str) -> Dict[str, str]:
+    """
+    Directorio de salida de cada libro: output_dir, salvo que varios libros compartan nombre
+    (en directorios distintos); esos replican su ruta relativa para no sobrescribirse.
+    """
+    by_name: Dict[str, List[str]] = {}
+    for path in workbooks: by_name.setdefault(os.path.splitext(os.path.basename(path))[0].lower(), []).append(path)
+    input_dirs = [os.path.dirname(os.path.abspath(path)) for path in workbooks]
+    try: common_dir = os.path.commonpath(input_dirs)
+    except ValueError: common_dir = None # Unidades distintas (Windows)
+    output_dirs: Dict[str, str] = {}
+    for paths in by_name.values():
+        for path in paths:
+            if len(paths) == 1: output_dirs[path] = output_dir; continue
+            input_dir = os.path.dirname(os.path.abspath(path))
+            relative_dir = os.path.relpath(input_dir, common_dir) if common_dir else os.path.splitdrive(input_dir)[1].lstrip('\\/')
+            output_dirs[path] = os.path.normpath(os.path.join(output_dir, relative_dir))
+            print(f"Nombre repetido: '{path}' se guarda en '{output_dirs[path]}'.")
+    return output_dirs
+
+def run_batch(input_paths: List[str], output_dir: str, workers: Optional[int] = None, verbose: bool = False,
+              streaming: bool = USE_STREAMING_SOURCE, output_format: str = OUTPUT_FORMAT) -> int:
+    """
+    Procesa varios libros en paralelo (un proceso por libro).
+
+    Returns:
+        Código de salida: 0 si todos los libros se procesaron, 1 si alguno falló.
+    """
+    workbooks = collect_input_workbooks(input_paths)
+    if not workbooks: print("No se encontraron libros .xlsx para procesar."); return 1
+    output_dirs = batch_output_dirs(workbooks, output_dir)
+    for directory in set(output_dirs.values()): os.makedirs(directory, exist_ok=True)
+    workers = max(1, min(workers or os.cpu_count() or 1, len(workbooks)))
+    print(f"--- Modo por lotes: {len(workbooks)} libro(s), {workers} proceso(s), salida en '{output_dir}' ---")
+    results: List[Dict[str, Any]] = []
+    if workers == 1:
+        results = [_batch_worker(path, output_dirs[path], verbose, streaming, output_format) for path in workbooks]
+    else:
+        with ProcessPoolExecutor(max_workers=workers, initializer=_init_pool_worker) as pool:
+            futures = [pool.submit(_batch_worker, path, output_dirs[path], verbose, streaming, output_format) for path in workbooks]
+            for future in as_completed(futures): results.append(future.result())
+    failures = [r for r in results if 'error' in r]
+    print("\n--- Resumen del lote ---")
+    for r in sorted(results, key=lambda r: r['input']):
+        if 'error' in r: print(f"  ERROR  {r['input']}: {r['error']}")
+        else: print(f"  OK     {r['input']} -> {r['output']} ({r['rows']} filas, {r['pending_sap']} pendientes SAP, {r['seconds']}s)")
+    return 1 if failures else 0
+
+def parse_cli_args(argv: List[str]) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Procesa libros de Movilidad sin GUI. Sin argumentos se abre la interfaz gráfica.")
+    parser.add_argument('entradas', nargs='+', help="Libros .xlsx o directorios que los contienen.")
+    parser.add_argument('-o', '--salida', required=True, help="Directorio donde se guardan los libros procesados y los reportes.")
+    parser.add_argument('-j', '--procesos', type=int, default=None, help="Número de procesos en paralelo (por defecto, núcleos de CPU).")
+    parser.add_argument('--por-bloques', action='store_true', help=f"Lee y procesa WEB2.0 en bloques de {SOURCE_CHUNK_ROWS} filas; con -f hoja o csv, sin cargar WEB2.0 completa en memoria.")
+    parser.add_argument('-f', '--formato', choices=list(OUTPUT_FORMAT_EXTENSIONS), default=OUTPUT_FORMAT,
+                        help="Archivo final: 'libro' (plantilla completa), 'hoja' (solo la hoja de cargue, rápido) o 'csv'.")
+    parser.add_argument('-v', '--detalle', action='store_true', help="Registro detallado: una línea por cada coincidencia de sucursal.")
+    return parser.parse_args(argv)
+
 # ==============================================================================
 # --- Punto de Entrada ---
 # ==============================================================================
 if __name__ == "__main__":
+    if len(sys.argv) > 1:
+        cli_args = parse_cli_args(sys.argv[1:])
+        sys.exit(run_batch(cli_args.entradas, cli_args.salida, cli_args.procesos, verbose=VERBOSE_ROW_LOGGING or cli_args.detalle,
+                           streaming=USE_STREAMING_SOURCE or cli_args.por_bloques, output_format=cli_args.formato))
     main()
\ No newline at end of file
@@ -2,7 +2,18 @@ import tkinter as tk
 from tkinter import ttk, messagebox, filedialog
 from tkcalendar import DateEntry
 import pandas as pd
+import numpy as np
 import os
+import io
+import re
+import copy
+import posixpath
+import tempfile
+import unicodedata
+import zipfile
+import xml.etree.ElementTree as ET
+from urllib.parse import unquote
+from xml.sax.saxutils import escape as xml_escape
 from datetime import datetime
 import locale
 
@@ -11,13 +22,21 @@ SHEET_POSIBLES = "POSIBLES"
 SHEET_ELIMINADOS = "ELIMINADOS"
 SHEET_RESUMEN = "RESUMEN"
 SHEET_MATRIZ = "MATRIZ" 
-HOJAS_A_CONSERVAR_BASE = ["POSIBLES", "ENVIADOS", "METAS", "ASI VAMOS", "APROVECHABLES", SHEET_MATRIZ]
+SHEET_ENVIADOS = "ENVIADOS"
+HOJAS_A_CONSERVAR_BASE = ["POSIBLES", SHEET_ENVIADOS, "METAS", "ASI VAMOS", "APROVECHABLES", SHEET_MATRIZ]
 COLUMNAS_ELIMINADOS = ["Cliente", "Residuo", "Tipología", "Línea", "Comercial", "Fecha CC", "CC", "Subtotal", "Fecha de Eliminación"]
 COLUMNAS_POSIBLES_ESPERADAS = []
 COLUMNAS_MAPEADAS_CSV = ["Cliente", "Nit Cliente", "Peso CC", "Vlr Unit", "Subtotal", "Fecha CC"]
 COLUMNAS_REQUERIDAS_CSV = ['client', 'nit', 'weight', 'price', 'collection_date']
 MATRIZ_NIT_COL = 'NIT'; MATRIZ_COMERCIAL_COL = 'NOMBRE CO'
 FECHA_COLUMNA = "Fecha CC"; CLIENTE_COLUMNA = "Cliente"; COMERCIAL_COLUMNA = "Comercial"; SUBTOTAL_COLUMNA = "Subtotal"; PESO_COLUMNA = 'Peso CC'
+COLUMNAS_CON_COMA = {SUBTOTAL_COLUMNA, PESO_COLUMNA, 'Vlr Unit'}
+# --- Tabla virtual: solo se materializan en el Treeview las filas visibles ---
+TABLA_ALTO_FILA = 22            # px; fijo para poder calcular cuántas filas caben
+TABLA_FILAS_RUEDA = 3           # Filas que avanza cada paso de la rueda del ratón
+# --- Autocompletar de cliente ---
+AUTOCOMPLETAR_ESPERA_MS = 120   # Espera tras la última tecla antes de buscar
+AUTOCOMPLETAR_MAX_SUGERENCIAS = 50
 
 # --- Funciones Auxiliares ---
 # (cargar_datos_excel, generar_resumen, guardar_cambios_excel_completo, procesar_y_cargar_csv SIN CAMBIOS)
@@ -86,72 +105,399 @@ def generar_resumen(df, fecha_columna="Fecha CC"):  # Añadimos parámetro para
     except Exception as e:
         return pd.DataFrame({"Error": [f"Error pivote: {e}"]})
 
+def _hojas_eliminados(filepath, df_nuevos_eliminados):
+    """ELIMINADOS (existentes + nuevos) y su resumen para ENVIADOS, listos para escribir."""
+    hojas = {}
+    try:
+        df_eliminados_existente = pd.read_excel(filepath, sheet_name=SHEET_ELIMINADOS);
+        if FECHA_COLUMNA in df_eliminados_existente.columns: df_eliminados_existente[FECHA_COLUMNA] = pd.to_datetime(df_eliminados_existente[FECHA_COLUMNA], errors='coerce')
+    except ValueError: df_eliminados_existente = pd.DataFrame()
+    except Exception as e: messagebox.showwarning("Advertencia", f"No se pudo leer '{SHEET_ELIMINADOS}': {e}."); df_eliminados_existente = pd.DataFrame()
+    if df_nuevos_eliminados is None: df_nuevos_eliminados = pd.DataFrame()
+    if not df_nuevos_eliminados.empty:
+        if FECHA_COLUMNA in df_nuevos_eliminados.columns: df_nuevos_eliminados[FECHA_COLUMNA] = pd.to_datetime(df_nuevos_eliminados[FECHA_COLUMNA], errors='coerce')
+        df_eliminados_total = pd.concat([df_eliminados_existente, df_nuevos_eliminados], ignore_index=True)
+    else: df_eliminados_total = df_eliminados_existente
+
+    # --- Resumen de eliminados (va en 'ENVIADOS') ---
+    df_eliminados_resumen = None
+    if df_eliminados_total is not None and not df_eliminados_total.empty:
+        df_eliminados_resumen = generar_resumen(df_eliminados_total.copy(), "Fecha de Eliminación")  # Resumen de ELIMINADOS
+        if df_eliminados_resumen is None:
+            messagebox.showwarning("Advertencia", "No se pudo generar resumen de eliminados.")
+            df_eliminados_resumen = pd.DataFrame({"Mensaje": ["No se pudo generar resumen de eliminados"]})
+        if FECHA_COLUMNA in df_eliminados_total.columns: df_eliminados_total[FECHA_COLUMNA] = df_eliminados_total[FECHA_COLUMNA].dt.strftime('%Y/%m/%d')
+        hojas[SHEET_ELIMINADOS] = df_eliminados_total
+    if df_eliminados_resumen is not None and not df_eliminados_resumen.empty and 'Error' not in df_eliminados_resumen.columns and 'Mensaje' not in df_eliminados_resumen.columns:
+        hojas[SHEET_ENVIADOS] = df_eliminados_resumen
+    return hojas
+
+def _escribir_hojas_excel(destino, hojas_a_escribir):
+    """Escribe las hojas con xlsxwriter (índice y formato moneda en RESUMEN/ENVIADOS). destino: ruta o BytesIO."""
+    with pd.ExcelWriter(destino, engine='xlsxwriter') as writer:
+        for nombre_hoja, df_hoja in hojas_a_escribir.items():
+            write_index = (nombre_hoja == SHEET_RESUMEN or nombre_hoja == SHEET_ENVIADOS)
+            df_hoja.to_excel(writer, sheet_name=nombre_hoja, index=write_index)
+        if SHEET_RESUMEN in hojas_a_escribir or SHEET_ENVIADOS in hojas_a_escribir:
+            workbook = writer.book
+            for sheet_name in [SHEET_RESUMEN, SHEET_ENVIADOS]:
+                if sheet_name in hojas_a_escribir:
+                    worksheet = writer.sheets[sheet_name]
+                    money_format = workbook.add_format({'num_format': '$ #,##0'})
+                    start_col = 1
+                    end_col = hojas_a_escribir[sheet_name].shape[1]
+                    worksheet.set_column(start_col, end_col, None, money_format)
+                    print(f"Formato moneda aplicado a '{sheet_name}'.")
+
+def _guardar_libro_completo(filepath, hojas_a_escribir):
+    """Reescritura completa: relee las hojas a conservar (solo valores) y regenera el archivo."""
+    for nombre_hoja in HOJAS_A_CONSERVAR_BASE:
+        if nombre_hoja not in hojas_a_escribir:
+            try:
+                df_hoja_conservar = pd.read_excel(filepath, sheet_name=nombre_hoja)
+                if df_hoja_conservar is not None: hojas_a_escribir[nombre_hoja] = df_hoja_conservar; print(f"Conservando: '{nombre_hoja}'")
+            except ValueError as e:
+                if "Worksheet" in str(e) and "not found" in str(e): print(f"Nota: Hoja '{nombre_hoja}' no encontrada.")
+                else: messagebox.showwarning("Advertencia", f"No se pudo leer '{nombre_hoja}': {e}.")
+            except Exception as e: messagebox.showwarning("Advertencia", f"Error leer '{nombre_hoja}': {e}.")
+    if not hojas_a_escribir: messagebox.showerror("Error Guardado", "No hay datos válidos."); return False
+    _escribir_hojas_excel(filepath, hojas_a_escribir)
+    return True
+
+# --- Guardado incremental: solo se reemplazan las partes XML de las hojas modificadas ---
+# Espacios de nombres OOXML: las búsquedas van por URI, así que valen igual para 'sheet' que para 'x:sheet'
+NS_HOJA = 'http://schemas.openxmlformats.org/spreadsheetml/2006/main'
+NS_REL_DOC = 'http://schemas.openxmlformats.org/officeDocument/2006/relationships'
+NS_REL_PAQUETE = 'http://schemas.openxmlformats.org/package/2006/relationships'
+NS_TIPOS = 'http://schemas.openxmlformats.org/package/2006/content-types'
+TIPO_REL_HOJA = NS_REL_DOC + '/worksheet'; TIPO_CONTENIDO_HOJA = 'application/vnd.openxmlformats-officedocument.spreadsheetml.worksheet+xml'
+
+def _q(ns, etiqueta):
+    return f'{{{ns}}}{etiqueta}'
+
+def _leer_xml(datos):
+    """(raíz, {prefijo: uri} declarados en el documento) de una parte XML. Lanza ET.ParseError si no es XML válido."""
+    raiz = None; declaraciones = {}
+    for evento, dato in ET.iterparse(io.BytesIO(datos), events=('start', 'start-ns')):
+        if evento == 'start-ns': declaraciones.setdefault(*dato)
+        elif raiz is None: raiz = dato
+    return raiz, declaraciones
+
+def _xml_a_bytes(raiz, declaraciones):
+    """
+    Serializa con los prefijos del documento original y vuelve a declarar en la raíz los espacios de nombres
+    que ElementTree omite por no usarse en etiquetas (mc:Ignorable y mc:Choice los citan solo por su prefijo).
+    """
+    propios = {prefijo: uri for prefijo, uri in declaraciones.items() if not re.fullmatch(r'ns\d+', prefijo)}
+    for prefijo, uri in propios.items(): ET.register_namespace(prefijo, uri)
+    texto = ET.tostring(raiz, encoding='unicode')
+    fin = texto.index('>'); fin -= texto[fin - 1] == '/'
+    presentes = set(re.findall(r'\sxmlns(?::([\w.-]+))?="', texto[:fin]))
+    faltantes = ''.join(f' xmlns{":" + prefijo if prefijo else ""}="{xml_escape(uri, {chr(34): "&quot;"})}"' for prefijo, uri in propios.items() if prefijo not in presentes)
+    return ('<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\r\n' + texto[:fin] + faltantes + texto[fin:]).encode('utf-8')
+
+def _ruta_parte(target, origen):
+    """Parte del paquete a la que apunta el Target de una relación de la parte origen ('' = raíz del paquete)."""
+    target = unquote(target)
+    return target.lstrip('/') if target.startswith('/') else posixpath.normpath(posixpath.join(posixpath.dirname(origen), target))
+
+def _parte_rels(parte):
+    """Parte .rels con las relaciones de parte ('xl/workbook.xml' -> 'xl/_rels/workbook.xml.rels')."""
+    carpeta, nombre = posixpath.split(parte)
+    return posixpath.join(carpeta, '_rels', nombre + '.rels')
+
+def _relaciones(datos_rels, origen):
+    """{Id: (Type, parte destino)} de un .rels; se omiten los destinos externos (TargetMode="External")."""
+    return {rel.get('Id'): (rel.get('Type', ''), _ruta_parte(rel.get('Target', ''), origen))
+            for rel in ET.fromstring(datos_rels).iter(_q(NS_REL_PAQUETE, 'Relationship')) if rel.get('TargetMode') != 'External'}
+
+def _partes_alcanzables(leer_rels):
+    """Partes a las que se llega siguiendo relaciones desde la raíz del paquete. leer_rels(parte .rels) -> bytes o None."""
+    alcanzables = set(); pendientes = ['']
+    while pendientes:
+        origen = pendientes.pop(); datos = leer_rels(_parte_rels(origen))
+        if datos is None: continue
+        for _, destino in _relaciones(datos, origen).values():
+            if destino not in alcanzables: alcanzables.add(destino); pendientes.append(destino)
+    return alcanzables
+
+def _hojas_del_paquete(zf):
+    """{nombre de hoja: parte XML} según workbook.xml y sus relaciones."""
+    rels = _relaciones(zf.read('xl/_rels/workbook.xml.rels'), 'xl/workbook.xml'); hojas = {}
+    for hoja in ET.fromstring(zf.read('xl/workbook.xml')).iter(_q(NS_HOJA, 'sheet')):
+        rid = hoja.get(_q(NS_REL_DOC, 'id'))
+        if hoja.get('name') is not None and rid in rels: hojas[hoja.get('name')] = rels[rid][1]
+    if not hojas: raise ValueError("workbook.xml sin hojas reconocibles")
+    return hojas
+
+def _clave_elemento(elemento):
+    """Identidad de un elemento XML para reutilizar estilos: etiqueta, atributos, texto e hijos (sin importar prefijos)."""
+    return elemento.tag, tuple(sorted(elemento.attrib.items())), (elemento.text or '').strip(), tuple(_clave_elemento(hijo) for hijo in elemento)
+
+def _fusionar_estilos(estilos_originales, estilos_nuevos):
+    """
+    Añade al styles.xml original las fuentes, rellenos, bordes, formatos numéricos y cellXfs del libro nuevo,
+    reutilizando los elementos idénticos (guardar varias veces no hace crecer styles.xml).
+    Devuelve (styles.xml fusionado, función que traduce un índice de estilo nuevo al fusionado).
+    """
+    raiz, declaraciones = _leer_xml(estilos_originales); nuevos = ET.fromstring(estilos_nuevos); mapas = {}
+    fmts = raiz.find(_q(NS_HOJA, 'numFmts')); fmts_nuevos = nuevos.find(_q(NS_HOJA, 'numFmts'))
+    codigos = {f.get('formatCode'): f.get('numFmtId') for f in (fmts if fmts is not None else [])}
+    siguiente_fmt = max([163] + [int(i) for i in codigos.values()]) + 1; mapa_fmt = {}
+    for f in (fmts_nuevos if fmts_nuevos is not None else []): # Se identifican por formatCode
+        codigo = f.get('formatCode')
+        if codigo not in codigos:
+            if fmts is None: fmts = ET.Element(_q(NS_HOJA, 'numFmts')); raiz.insert(0, fmts) # numFmts va primero dentro de styleSheet
+            codigos[codigo] = str(siguiente_fmt); siguiente_fmt += 1
+            ET.SubElement(fmts, _q(NS_HOJA, 'numFmt'), numFmtId=codigos[codigo], formatCode=codigo)
+        mapa_fmt[f.get('numFmtId')] = codigos[codigo]
+    if fmts is not None: fmts.set('count', str(len(fmts)))
+    for seccion, atributo in (('fonts', 'fontId'), ('fills', 'fillId'), ('borders', 'borderId'), ('cellXfs', 'xf')):
+        destino = raiz.find(_q(NS_HOJA, seccion)); origen = nuevos.find(_q(NS_HOJA, seccion))
+        if destino is None: raise ValueError(f"styles.xml sin sección '{seccion}'")
+        posiciones = {}
+        for posicion, elemento in enumerate(destino): posiciones.setdefault(_clave_elemento(elemento), posicion)
+        mapa = []
+        for elemento in (origen if origen is not None else []):
+            elemento = copy.deepcopy(elemento)
+            if atributo == 'xf':
+                for clave in ('fontId', 'fillId', 'borderId'):
+                    if clave in elemento.attrib: elemento.set(clave, mapas[clave][int(elemento.get(clave))])
+                if 'numFmtId' in elemento.attrib: elemento.set('numFmtId', mapa_fmt.get(elemento.get('numFmtId'), elemento.get('numFmtId')))
+                if 'xfId' in elemento.attrib: elemento.set('xfId', '0')
+            clave_elemento = _clave_elemento(elemento)
+            if clave_elemento not in posiciones: posiciones[clave_elemento] = len(destino); destino.append(elemento)
+            mapa.append(str(posiciones[clave_elemento]))
+        mapas[atributo] = mapa; destino.set('count', str(len(destino)))
+    return _xml_a_bytes(raiz, declaraciones), lambda indice: mapas['xf'][indice]
+
+def _adaptar_hoja_nueva(hoja_xml, cadenas, traducir_estilo):
+    """Hoja de xlsxwriter lista para el paquete original: cadenas compartidas -> inline y estilos reindexados."""
+    raiz, declaraciones = _leer_xml(hoja_xml)
+    for celda in raiz.iter(_q(NS_HOJA, 'c')):
+        valor = celda.find(_q(NS_HOJA, 'v'))
+        if celda.get('t') == 's' and valor is not None:
+            en_linea = ET.Element(_q(NS_HOJA, 'is')); en_linea.extend(copy.deepcopy(list(cadenas[int(valor.text)])))
+            celda.insert(list(celda).index(valor), en_linea); celda.remove(valor); celda.set('t', 'inlineStr')
+    for etiqueta, atributo in (('c', 's'), ('row', 's'), ('col', 'style')):
+        for elemento in raiz.iter(_q(NS_HOJA, etiqueta)):
+            if atributo in elemento.attrib: elemento.set(atributo, traducir_estilo(int(elemento.get(atributo))))
+    for vista in raiz.iter(_q(NS_HOJA, 'sheetView')): vista.attrib.pop('tabSelected', None)
+    return _xml_a_bytes(raiz, declaraciones)
+
+def guardar_hojas_incremental(filepath, hojas_a_escribir):
+    """
+    Reemplaza en el .xlsx solo las hojas de hojas_a_escribir (las que no existen se añaden al final).
+    Las demás partes del paquete se copian tal cual, con su formato; las tablas, dibujos y comentarios
+    de las hojas reemplazadas (y la cadena de cálculo) se quitan del paquete. Lanza zipfile.BadZipFile/
+    KeyError/ValueError/ET.ParseError si el archivo no tiene la estructura esperada (el llamador hace
+    entonces la reescritura completa).
+    """
+    buffer = io.BytesIO(); _escribir_hojas_excel(buffer, hojas_a_escribir)
+    with zipfile.ZipFile(buffer) as nuevo, zipfile.ZipFile(filepath) as original:
+        hojas_nuevas = _hojas_del_paquete(nuevo); hojas_originales = _hojas_del_paquete(original); nombres = set(original.namelist())
+        cadenas = list(ET.fromstring(nuevo.read('xl/sharedStrings.xml'))) if 'xl/sharedStrings.xml' in nuevo.namelist() else []
+        estilos, traducir_estilo = _fusionar_estilos(original.read('xl/styles.xml'), nuevo.read('xl/styles.xml'))
+        libro, decl_libro = _leer_xml(original.read('xl/workbook.xml')); rels, decl_rels = _leer_xml(original.read('xl/_rels/workbook.xml.rels'))
+        tipos, decl_tipos = _leer_xml(original.read('[Content_Types].xml')); hojas_libro = libro.find(_q(NS_HOJA, 'sheets'))
+        if hojas_libro is None: raise ValueError("workbook.xml sin sección 'sheets'")
+        for rel in list(rels): # Excel rehace la cadena de cálculo
+            if rel.get('Type', '').endswith('/calcChain'): rels.remove(rel)
+        partes = {'xl/styles.xml': estilos}; rels_reemplazadas = set(); ids = {rel.get('Id') for rel in rels}
+        siguiente_parte = max([int(n) for n in re.findall(r'xl/worksheets/sheet(\d+)\.xml', ' '.join(nombres))], default=0) + 1
+        siguiente_id = max([int(hoja.get('sheetId', 0)) for hoja in hojas_libro], default=0) + 1
+        for nombre_hoja in hojas_a_escribir:
+            hoja_xml = _adaptar_hoja_nueva(nuevo.read(hojas_nuevas[nombre_hoja]), cadenas, traducir_estilo)
+            parte = hojas_originales.get(nombre_hoja)
+            if parte is None: # Hoja nueva: se registra en workbook.xml, sus relaciones y [Content_Types].xml
+                parte = f'xl/worksheets/sheet{siguiente_parte}.xml'; rid = f'rIdPos{siguiente_parte}'; siguiente_parte += 1
+                while rid in ids: rid += '_'
+                ids.add(rid); ET.SubElement(rels, _q(NS_REL_PAQUETE, 'Relationship'), Id=rid, Type=TIPO_REL_HOJA, Target='/' + parte)
+                ET.SubElement(hojas_libro, _q(NS_HOJA, 'sheet'), {'name': nombre_hoja, 'sheetId': str(siguiente_id), _q(NS_REL_DOC, 'id'): rid}); siguiente_id += 1
+                ET.SubElement(tipos, _q(NS_TIPOS, 'Override'), PartName='/' + parte, ContentType=TIPO_CONTENIDO_HOJA)
+                print(f"Hoja nueva: '{nombre_hoja}'")
+            else: rels_reemplazadas.add(_parte_rels(parte)) # Sus dibujos/tablas ya no aplican
+            partes[parte] = hoja_xml
+        partes['xl/_rels/workbook.xml.rels'] = _xml_a_bytes(rels, decl_rels)
+        # Partes que solo colgaban de las relaciones quitadas (tablas, dibujos, calcChain...): fuera del paquete
+        leer_antes = lambda parte_rels: original.read(parte_rels) if parte_rels in nombres else None
+        leer_despues = lambda parte_rels: partes.get(parte_rels) or (None if parte_rels in rels_reemplazadas else leer_antes(parte_rels))
+        huerfanas = _partes_alcanzables(leer_antes) - _partes_alcanzables(leer_despues)
+        omitir = rels_reemplazadas | huerfanas | {_parte_rels(parte) for parte in huerfanas}
+        for tipo in tipos.findall(_q(NS_TIPOS, 'Override')):
+            if unquote(tipo.get('PartName', '')).lstrip('/') in omitir: tipos.remove(tipo)
+        partes['xl/workbook.xml'] = _xml_a_bytes(libro, decl_libro); partes['[Content_Types].xml'] = _xml_a_bytes(tipos, decl_tipos)
+        directorio = os.path.dirname(os.path.abspath(filepath))
+        with tempfile.NamedTemporaryFile(dir=directorio, suffix='.xlsx', delete=False) as tmp: ruta_tmp = tmp.name
+        try:
+            with zipfile.ZipFile(ruta_tmp, 'w', zipfile.ZIP_DEFLATED) as destino:
+                escritas = set()
+                for info in original.infolist():
+                    if info.filename in omitir: continue
+                    destino.writestr(info, partes[info.filename] if info.filename in partes else original.read(info.filename), compress_type=zipfile.ZIP_DEFLATED); escritas.add(info.filename)
+                for parte, datos in partes.items():
+                    if parte not in escritas: destino.writestr(parte, datos)
+        except BaseException: os.remove(ruta_tmp); raise
+    try: os.replace(ruta_tmp, filepath)
+    except BaseException: os.remove(ruta_tmp); raise
+    print(f"Guardado incremental: {', '.join(hojas_a_escribir)} reemplazadas; resto del libro intacto.")
+    return True
+
 def guardar_cambios_excel_completo(filepath, df_posibles_actualizado, df_nuevos_eliminados):
     if not filepath: messagebox.showerror("Error", "No hay archivo seleccionado."); return False
     try:
-        df_eliminados_total = None
-        try:
-            df_eliminados_existente = pd.read_excel(filepath, sheet_name=SHEET_ELIMINADOS);
-            if FECHA_COLUMNA in df_eliminados_existente.columns: df_eliminados_existente[FECHA_COLUMNA] = pd.to_datetime(df_eliminados_existente[FECHA_COLUMNA], errors='coerce')
-        except ValueError: df_eliminados_existente = pd.DataFrame()
-        except Exception as e: messagebox.showwarning("Advertencia", f"No se pudo leer '{SHEET_ELIMINADOS}': {e}."); df_eliminados_existente = pd.DataFrame()
-        if df_nuevos_eliminados is None: df_nuevos_eliminados = pd.DataFrame()
-        if not df_nuevos_eliminados.empty:
-            if FECHA_COLUMNA in df_nuevos_eliminados.columns: df_nuevos_eliminados[FECHA_COLUMNA] = pd.to_datetime(df_nuevos_eliminados[FECHA_COLUMNA], errors='coerce')
-            df_eliminados_total = pd.concat([df_eliminados_existente, df_nuevos_eliminados], ignore_index=True)
-        else: df_eliminados_total = df_eliminados_existente
         df_resumen = generar_resumen(df_posibles_actualizado, FECHA_COLUMNA); # Resumen de POSIBLES
         if df_resumen is None: messagebox.showerror("Error", "Fallo Resumen."); return False
-        
-        # --- NUEVO: Generar resumen de eliminados ---
-        df_eliminados_resumen = None
-        if df_eliminados_total is not None and not df_eliminados_total.empty:
-            df_eliminados_resumen = generar_resumen(df_eliminados_total.copy(), "Fecha de Eliminación")  # Resumen de ELIMINADOS
-            if df_eliminados_resumen is None:
-                messagebox.showwarning("Advertencia", "No se pudo generar resumen de eliminados.")
-                df_eliminados_resumen = pd.DataFrame({"Mensaje": ["No se pudo generar resumen de eliminados"]})
-        # --- FIN NUEVO ---
-
         hojas_a_escribir = {}
         if df_posibles_actualizado is not None and not df_posibles_actualizado.empty: hojas_a_escribir[SHEET_POSIBLES] = df_posibles_actualizado
         if df_resumen is not None and not df_resumen.empty and 'Error' not in df_resumen.columns and 'Mensaje' not in df_resumen.columns: hojas_a_escribir[SHEET_RESUMEN] = df_resumen
-        if df_eliminados_total is not None and not df_eliminados_total.empty:
-             if FECHA_COLUMNA in df_eliminados_total.columns: df_eliminados_total[FECHA_COLUMNA] = df_eliminados_total[FECHA_COLUMNA].dt.strftime('%Y/%m/%d')
-             hojas_a_escribir[SHEET_ELIMINADOS] = df_eliminados_total
-        
-        # --- NUEVO: Añadir resumen de eliminados a 'ENVIADOS' ---
-        if df_eliminados_resumen is not None and not df_eliminados_resumen.empty and 'Error' not in df_eliminados_resumen.columns and 'Mensaje' not in df_eliminados_resumen.columns:
-            hojas_a_escribir["ENVIADOS"] = df_eliminados_resumen
-        # --- FIN NUEVO ---
-
-        for nombre_hoja in HOJAS_A_CONSERVAR_BASE:
-            if nombre_hoja not in hojas_a_escribir:
-                try:
-                    df_hoja_conservar = pd.read_excel(filepath, sheet_name=nombre_hoja)
-                    if df_hoja_conservar is not None: hojas_a_escribir[nombre_hoja] = df_hoja_conservar; print(f"Conservando: '{nombre_hoja}'")
-                except ValueError as e:
-                    if "Worksheet" in str(e) and "not found" in str(e): print(f"Nota: Hoja '{nombre_hoja}' no encontrada.")
-                    else: messagebox.showwarning("Advertencia", f"No se pudo leer '{nombre_hoja}': {e}.")
-                except Exception as e: messagebox.showwarning("Advertencia", f"Error leer '{nombre_hoja}': {e}.")
-        if not hojas_a_escribir: messagebox.showerror("Error Guardado", "No hay datos válidos."); return False
-        with pd.ExcelWriter(filepath, engine='xlsxwriter') as writer:
-            for nombre_hoja, df_hoja in hojas_a_escribir.items():
-                write_index = (nombre_hoja == SHEET_RESUMEN or nombre_hoja == "ENVIADOS")  # Modificado para ENVIADOS
-                df_hoja.to_excel(writer, sheet_name=nombre_hoja, index=write_index)
-            if SHEET_RESUMEN in hojas_a_escribir or "ENVIADOS" in hojas_a_escribir:
-                workbook = writer.book
-                for sheet_name in [SHEET_RESUMEN, "ENVIADOS"]:
-                    if sheet_name in hojas_a_escribir:
-                        worksheet = writer.sheets[sheet_name]
-                        money_format = workbook.add_format({'num_format': '$ #,##0'})
-                        start_col = 1
-                        end_col = hojas_a_escribir[sheet_name].shape[1]
-                        worksheet.set_column(start_col, end_col, None, money_format)
-                        print(f"Formato moneda aplicado a '{sheet_name}'.")
+        # ELIMINADOS y ENVIADOS solo cambian al mover filas
+        hay_movidas = df_nuevos_eliminados is not None and not df_nuevos_eliminados.empty
+        if hay_movidas: hojas_a_escribir.update(_hojas_eliminados(filepath, df_nuevos_eliminados))
+        if not hojas_a_escribir: print("Nota: no hay hojas modificadas que guardar."); return True
+        try: return guardar_hojas_incremental(filepath, hojas_a_escribir)
+        except (zipfile.BadZipFile, KeyError, ValueError, ET.ParseError) as e:
+            print(f"Nota: guardado incremental no disponible ({e}). Se reescribe el libro completo.")
+            if not hay_movidas: hojas_a_escribir.update(_hojas_eliminados(filepath, None))
+            return _guardar_libro_completo(filepath, hojas_a_escribir)
     except ImportError: messagebox.showerror("Error Dependencia", "Instala 'xlsxwriter': pip install xlsxwriter"); return False
     except PermissionError: messagebox.showerror("Error Permiso", f"No se pudo guardar '{os.path.basename(filepath)}'.\n¡Archivo abierto?"); return False
     except Exception as e: messagebox.showerror("Error", f"Error al guardar '{os.path.basename(filepath)}': {e}"); return False
-    return True
+
+def formatear_valor_vista(col_name, val):
+    """Texto de una celda de la tabla (valor suelto; la tabla usa formatear_columnas_vista)."""
+    if pd.isna(val): return ""
+    if col_name in COLUMNAS_CON_COMA and isinstance(val, (int, float)):
+        try: return f"{val:.2f}".replace('.', ',')
+        except (ValueError, TypeError): return str(val)
+    if isinstance(val, (datetime, pd.Timestamp)): return val.strftime('%Y/%m/%d')
+    return str(val)
+
+def formatear_columnas_vista(df, columnas):
+    """
+    Textos de la tabla para TODAS las filas de df, columna a columna con operaciones
+    vectorizadas (mismo formato que formatear_valor_vista). Se calcula una vez por carga,
+    importación o movimiento; filtrar y desplazar solo toman filas de este resultado.
+    """
+    textos = {}
+    for col in columnas:
+        serie = df[col]; vacios = serie.isna().to_numpy()
+        if col in COLUMNAS_CON_COMA and pd.api.types.is_numeric_dtype(serie) and not pd.api.types.is_bool_dtype(serie):
+            texto = pd.Series(np.char.mod('%.2f', serie.to_numpy(dtype=float, na_value=np.nan)), index=df.index, dtype=object).str.replace('.', ',', regex=False)
+        elif pd.api.types.is_datetime64_any_dtype(serie): texto = serie.dt.strftime('%Y/%m/%d')
+        elif pd.api.types.is_numeric_dtype(serie) or pd.api.types.infer_dtype(serie, skipna=True) in ('string', 'empty'): texto = serie.astype(str)
+        else: texto = serie.map(lambda val, col=col: formatear_valor_vista(col, val)) # Tipos mezclados: valor a valor
+        textos[col] = texto.astype(object).where(~vacios, "")
+    return pd.DataFrame(textos, index=df.index)
+
+def normalizar_texto_busqueda(texto):
+    """Minúsculas y sin tildes/diéresis ('Ñandú' -> 'nandu') para búsquedas de cliente."""
+    return ''.join(c for c in unicodedata.normalize('NFD', str(texto)) if not unicodedata.combining(c)).lower()
+
+class IndiceClientes:
+    """
+    Índice de autocompletado sobre los clientes distintos (normalizados sin tildes ni mayúsculas):
+      - trie de prefijos: cada nodo guarda el rango [desde, hasta) de nombres ordenados que empiezan así;
+      - trigramas -> ids de nombre, para coincidencias en cualquier parte del nombre.
+    buscar() devuelve primero las coincidencias por prefijo y luego las de subcadena, con límite.
+    """
+    def __init__(self, nombres):
+        pares = sorted((normalizar_texto_busqueda(nombre), nombre) for nombre in nombres)
+        self.normalizados = [normalizado for normalizado, _ in pares]; self.nombres = [nombre for _, nombre in pares]
+        self.trie = {'rango': (0, len(pares))}; self.trigramas = {}
+        for posicion, normalizado in enumerate(self.normalizados):
+            nodo = self.trie
+            for caracter in normalizado: # Los nombres están ordenados: cada prefijo ocupa un rango contiguo
+                nodo = nodo.setdefault(caracter, {'rango': (posicion, posicion)}); nodo['rango'] = (nodo['rango'][0], posicion + 1)
+            for inicio in range(len(normalizado) - 2): self.trigramas.setdefault(normalizado[inicio:inicio + 3], set()).add(posicion)
+
+    def _rango_prefijo(self, clave):
+        nodo = self.trie
+        for caracter in clave:
+            nodo = nodo.get(caracter)
+            if nodo is None: return 0, 0
+        return nodo['rango']
+
+    def _candidatos_subcadena(self, clave):
+        """Ids cuyo nombre contiene clave; con 3+ caracteres solo se verifican los que comparten todos sus trigramas."""
+        if len(clave) < 3: return (posicion for posicion, normalizado in enumerate(self.normalizados) if clave in normalizado)
+        postings = sorted((self.trigramas.get(clave[inicio:inicio + 3], set()) for inicio in range(len(clave) - 2)), key=len)
+        candidatos = set.intersection(*postings) if postings[0] else set()
+        return (posicion for posicion in sorted(candidatos) if clave in self.normalizados[posicion])
+
+    def buscar(self, texto, limite=AUTOCOMPLETAR_MAX_SUGERENCIAS):
+        clave = normalizar_texto_busqueda(texto).strip()
+        if not clave: return []
+        desde, hasta = self._rango_prefijo(clave)
+        resultado = list(range(desde, min(hasta, desde + limite)))
+        if len(resultado) < limite:
+            for posicion in self._candidatos_subcadena(clave):
+                if not desde <= posicion < hasta: resultado.append(posicion)
+                if len(resultado) >= limite: break
+        return [self.nombres[posicion] for posicion in resultado]
+
+class TotalesFilas:
+    """
+    Subtotal y Peso CC de df_original como arrays float alineados por posición de fila (NaN -> 0),
+    preparados una vez por carga; los totales de una selección son una indexación vectorizada.
+    """
+    def __init__(self, df):
+        self.ids = pd.Index(df.index)
+        self.subtotal = self._columna_numerica(df, SUBTOTAL_COLUMNA); self.peso = self._columna_numerica(df, PESO_COLUMNA)
+
+    @staticmethod
+    def _columna_numerica(df, columna):
+        if columna not in df.columns: return np.zeros(len(df))
+        return np.nan_to_num(pd.to_numeric(df[columna], errors='coerce').to_numpy(dtype=float, na_value=np.nan), nan=0.0)
+
+    def totales(self, ids_filas):
+        """(filas, suma Subtotal, suma Peso CC) de los ids dados."""
+        posiciones = self.ids.get_indexer(np.fromiter(ids_filas, dtype=object, count=len(ids_filas)))
+        posiciones = posiciones[posiciones >= 0]
+        return len(posiciones), float(self.subtotal[posiciones].sum()), float(self.peso[posiciones].sum())
+
+class IndiceFiltros:
+    """
+    Índices de df_original para filtrar sin copiar el DataFrame, construidos una vez por
+    carga, importación o movimiento:
+      - fechas válidas ordenadas (un rango de fechas es una búsqueda binaria + un corte);
+      - índice invertido cliente normalizado -> posiciones de fila (la búsqueda de texto
+        recorre los clientes distintos, no las filas).
+    filtrar() devuelve los ids de fila (índice de df_original) en el orden original.
+    """
+    def __init__(self, df):
+        self.ids = df.index.to_numpy(); self.fechas_ordenadas = None; self.posiciones_por_fecha = None; self.posiciones_por_cliente = {}
+        if FECHA_COLUMNA in df.columns and pd.api.types.is_datetime64_any_dtype(df[FECHA_COLUMNA]):
+            fechas = df[FECHA_COLUMNA].to_numpy(); posiciones_validas = np.flatnonzero(~pd.isna(fechas))
+            orden = np.argsort(fechas[posiciones_validas], kind='stable')
+            self.fechas_ordenadas = fechas[posiciones_validas][orden]; self.posiciones_por_fecha = posiciones_validas[orden]
+        if CLIENTE_COLUMNA in df.columns:
+            codigos, clientes_unicos = pd.factorize(df[CLIENTE_COLUMNA]) # Nulos -> -1, quedan fuera del índice
+            orden = np.argsort(codigos, kind='stable'); cortes = np.searchsorted(codigos[orden], np.arange(len(clientes_unicos) + 1))
+            for codigo, cliente in enumerate(clientes_unicos):
+                posiciones = orden[cortes[codigo]:cortes[codigo + 1]]; clave = normalizar_texto_busqueda(cliente)
+                previas = self.posiciones_por_cliente.get(clave) # Varios textos originales pueden normalizar igual
+                self.posiciones_por_cliente[clave] = posiciones if previas is None else np.union1d(previas, posiciones)
+
+    def posiciones_rango_fechas(self, fecha_inicio, fecha_fin):
+        """Posiciones (ordenadas) con fecha_inicio <= fecha <= fecha_fin; None si no hay columna de fechas."""
+        if self.fechas_ordenadas is None: return None
+        desde = np.searchsorted(self.fechas_ordenadas, np.datetime64(fecha_inicio), side='left')
+        hasta = np.searchsorted(self.fechas_ordenadas, np.datetime64(fecha_fin), side='right')
+        return np.sort(self.posiciones_por_fecha[desde:hasta])
+
+    def posiciones_cliente(self, texto):
+        """Posiciones (ordenadas) cuyo cliente contiene texto, sin distinguir mayúsculas ni tildes."""
+        clave_buscar = normalizar_texto_busqueda(texto)
+        coincidencias = [posiciones for clave, posiciones in self.posiciones_por_cliente.items() if clave_buscar in clave]
+        return np.sort(np.concatenate(coincidencias)) if coincidencias else np.array([], dtype=np.int64)
+
+    def filtrar(self, fecha_inicio, fecha_fin, texto_cliente=""):
+        posiciones = self.posiciones_rango_fechas(fecha_inicio, fecha_fin)
+        if texto_cliente:
+            posiciones_cliente = self.posiciones_cliente(texto_cliente)
+            posiciones = posiciones_cliente if posiciones is None else np.intersect1d(posiciones, posiciones_cliente, assume_unique=True)
+        return self.ids if posiciones is None else self.ids[posiciones]
 
 def procesar_y_cargar_csv(csv_filepath, df_principal):
     # (Función sin cambios)
@@ -200,8 +546,12 @@ class App(tk.Tk):
         super().__init__()
         self.title("Gestor de Datos Excel (v1.14 - Layout Tabla)")
         self.geometry("1000x780+50+50")
-        self.selected_excel_file = None; self.df_original = None; self.df_filtrado = None
-        self.original_indices = {}; self.lista_clientes_unicos = []
+        self.selected_excel_file = None; self.df_original = None
+        self.original_indices = {}; self.lista_clientes_unicos = []; self.indice_clientes = IndiceClientes([]); self._autocompletar_after_id = None
+        # Tabla virtual: ids de fila (índice de df_original) de la vista, primera fila mostrada, selección y foco/ancla (posiciones en la vista)
+        self.vista_ids = np.array([], dtype=object); self.vista_offset = 0; self.seleccion_ids = set()
+        self.foco_pos = None; self.ancla_pos = None; self.textos_vista = None; self._textos_origen = None
+        self.indice_filtros = None; self._indice_origen = None; self.totales_filas = None; self._totales_origen = None
         # --- Frames ---
         frame_archivo = ttk.Frame(self, padding="10"); frame_archivo.pack(fill=tk.X, pady=2)
         frame_filtros = ttk.Frame(self, padding="10"); frame_filtros.pack(fill=tk.X, pady=2)
@@ -232,13 +582,22 @@ class App(tk.Tk):
         self.mostrar_todo_button = ttk.Button(frame_filtros, text="Mostrar Todo", command=self.mostrar_todo, state='disabled'); self.mostrar_todo_button.grid(row=2, column=2, columnspan=2, padx=5, pady=5, sticky="ew")
         frame_filtros.grid_columnconfigure(1, weight=1); frame_filtros.grid_columnconfigure(2, weight=1)
 
-        # --- Widget Tabla (MODIFICADO A GRID) ---
+        # --- Widget Tabla (MODIFICADO A GRID; virtual: el Treeview solo contiene las filas visibles) ---
+        ttk.Style(self).configure('Treeview', rowheight=TABLA_ALTO_FILA)
         self.tree = ttk.Treeview(frame_tabla, selectmode='extended');
-        self.tree.bind("<<TreeviewSelect>>", self.update_selection_summary)
-        # Scrollbars
-        scrollbar_y = ttk.Scrollbar(frame_tabla, orient=tk.VERTICAL, command=self.tree.yview)
+        self.tree.bind("<Configure>", lambda event: self.renderizar_ventana())
+        for secuencia, modo in (("<Button-1>", 'simple'), ("<Control-Button-1>", 'alternar'), ("<Shift-Button-1>", 'rango')):
+            self.tree.bind(secuencia, lambda event, modo=modo: self.on_click_tabla(event, modo))
+        self.tree.bind("<MouseWheel>", lambda event: self.desplazar_vista(-TABLA_FILAS_RUEDA if event.delta > 0 else TABLA_FILAS_RUEDA))
+        self.tree.bind("<Button-4>", lambda event: self.desplazar_vista(-TABLA_FILAS_RUEDA))
+        self.tree.bind("<Button-5>", lambda event: self.desplazar_vista(TABLA_FILAS_RUEDA))
+        for tecla, paso in (("Up", -1), ("Down", 1), ("Prior", 'pagina-'), ("Next", 'pagina+'), ("Home", 'inicio'), ("End", 'fin')):
+            self.tree.bind(f"<{tecla}>", lambda event, paso=paso: self.mover_foco(paso, extender=False))
+            self.tree.bind(f"<Shift-{tecla}>", lambda event, paso=paso: self.mover_foco(paso, extender=True))
+        # Scrollbars (la vertical recorre la vista completa, no solo las filas materializadas)
+        self.scrollbar_y = scrollbar_y = ttk.Scrollbar(frame_tabla, orient=tk.VERTICAL, command=self.on_scroll_vista)
         scrollbar_x = ttk.Scrollbar(frame_tabla, orient=tk.HORIZONTAL, command=self.tree.xview)
-        self.tree.configure(yscrollcommand=scrollbar_y.set, xscrollcommand=scrollbar_x.set)
+        self.tree.configure(xscrollcommand=scrollbar_x.set)
         # Configurar Grid para frame_tabla
         frame_tabla.grid_rowconfigure(0, weight=1)
         frame_tabla.grid_columnconfigure(0, weight=1)
@@ -257,29 +616,44 @@ class App(tk.Tk):
 
     # --- Métodos Autocompletar (incluye nuevos handlers focus out) ---
     def on_keyrelease_cliente(self, event=None):
-        value = self.cliente_var.get(); self.cliente_listbox.delete(0, tk.END);
-        listbox_displayed = False
-        if value:
-            data = [item for item in self.lista_clientes_unicos if value.lower() in item.lower()]
-            if data:
-                for item in data: self.cliente_listbox.insert(tk.END, item)
-                self.cliente_entry.update_idletasks(); entry_x = self.cliente_entry.winfo_x(); entry_y = self.cliente_entry.winfo_y()
-                entry_height = self.cliente_entry.winfo_height(); entry_width = self.cliente_entry.winfo_width()
-                self.cliente_listbox.place(in_=self.cliente_entry.master, x=entry_x, y=entry_y + entry_height, width=entry_width); self.cliente_listbox.lift()
-                listbox_displayed = True
-        if not listbox_displayed: self.hide_cliente_listbox()
+        # Con espera: mientras se escribe rápido solo se busca una vez, tras la última tecla
+        if self._autocompletar_after_id: self.after_cancel(self._autocompletar_after_id)
+        self._autocompletar_after_id = self.after(AUTOCOMPLETAR_ESPERA_MS, self.actualizar_sugerencias_cliente)
+
+    def cancelar_autocompletar(self):
+        """Descarta la búsqueda pendiente para que no vuelva a mostrar la lista ya cerrada."""
+        if self._autocompletar_after_id: self.after_cancel(self._autocompletar_after_id); self._autocompletar_after_id = None
+
+    def actualizar_sugerencias_cliente(self):
+        self._autocompletar_after_id = None
+        data = self.indice_clientes.buscar(self.cliente_var.get())
+        if not data: self.hide_cliente_listbox(); return
+        self.cliente_listbox.delete(0, tk.END); self.cliente_listbox.insert(tk.END, *data) # Una sola llamada a Tk
+        if not self.cliente_listbox.winfo_ismapped(): # Se posiciona solo al aparecer
+            self.cliente_entry.update_idletasks(); entry_x = self.cliente_entry.winfo_x(); entry_y = self.cliente_entry.winfo_y()
+            entry_height = self.cliente_entry.winfo_height(); entry_width = self.cliente_entry.winfo_width()
+            self.cliente_listbox.place(in_=self.cliente_entry.master, x=entry_x, y=entry_y + entry_height, width=entry_width); self.cliente_listbox.lift()
+
+    def actualizar_lista_clientes(self):
+        """Clientes distintos de df_original y su índice de autocompletado (una vez por carga, importación o movimiento)."""
+        self.lista_clientes_unicos = []
+        if self.df_original is not None and CLIENTE_COLUMNA in self.df_original.columns:
+            clientes_raw = self.df_original[CLIENTE_COLUMNA].astype(str).unique()
+            self.lista_clientes_unicos = sorted([c for c in clientes_raw if c.lower() != 'nan'])
+        self.indice_clientes = IndiceClientes(self.lista_clientes_unicos)
 
     def on_select_cliente(self, event=None):
         widget = event.widget; selection = widget.curselection()
+        self.cancelar_autocompletar()
         if selection: value = widget.get(selection[0]); self.cliente_var.set(value); self.hide_cliente_listbox(); self.cliente_entry.focus_set(); self.cliente_entry.icursor(tk.END)
 
-    def hide_cliente_listbox(self): self.cliente_listbox.place_forget()
+    def hide_cliente_listbox(self): self.cancelar_autocompletar(); self.cliente_listbox.place_forget()
 
     def on_cliente_entry_focus_out(self, event=None):
-        self.after(150, self._check_focus_and_hide_listbox)
+        self.cancelar_autocompletar(); self.after(150, self._check_focus_and_hide_listbox)
 
     def on_cliente_listbox_focus_out(self, event=None):
-        self.after(150, self._check_focus_and_hide_listbox)
+        self.cancelar_autocompletar(); self.after(150, self._check_focus_and_hide_listbox)
 
     def _check_focus_and_hide_listbox(self):
         try:
@@ -295,18 +669,16 @@ class App(tk.Tk):
             self.selected_excel_file = filepath; filename = os.path.basename(filepath)
             self.selected_file_label.config(text=filename, foreground="black")
             self.df_original = cargar_datos_excel(self.selected_excel_file, SHEET_POSIBLES)
-            self.limpiar_treeview(); self.lista_clientes_unicos = []; self.cliente_var.set("")
+            self.limpiar_treeview(); self.lista_clientes_unicos = []; self.indice_clientes = IndiceClientes([]); self.cliente_var.set("")
             self.fecha_inicio_entry.config(state='disabled'); self.fecha_fin_entry.config(state='disabled')
             self.cliente_entry.config(state='disabled'); self.filtrar_button.config(state='disabled')
             self.mostrar_todo_button.config(state='disabled'); self.mover_button.config(state='disabled')
             self.import_button.config(state='disabled'); self.hide_cliente_listbox(); self.guardar_button.config(state='disabled')
             if self.df_original is None: messagebox.showerror("Error Carga", f"No se pudo cargar '{SHEET_POSIBLES}'."); return
             messagebox.showinfo("Carga Completa", f"Cargados {len(self.df_original)} registros de '{filename}'.")
-            if CLIENTE_COLUMNA in self.df_original.columns:
-                clientes_raw = self.df_original[CLIENTE_COLUMNA].astype(str).unique()
-                self.lista_clientes_unicos = sorted([c for c in clientes_raw if c.lower() != 'nan'])
-            else: messagebox.showwarning("Advertencia", f"Columna '{CLIENTE_COLUMNA}' no encontrada.")
-            self.df_filtrado = self.df_original.copy(); self.mostrar_en_treeview()
+            self.actualizar_lista_clientes()
+            if CLIENTE_COLUMNA not in self.df_original.columns: messagebox.showwarning("Advertencia", f"Columna '{CLIENTE_COLUMNA}' no encontrada.")
+            self.mostrar_en_treeview()
             self.fecha_inicio_entry.config(state='normal'); self.fecha_fin_entry.config(state='normal')
             self.fecha_fin_entry.set_date(datetime.now()); self.cliente_entry.config(state='normal')
             self.filtrar_button.config(state='normal'); self.mostrar_todo_button.config(state='normal');
@@ -354,9 +726,7 @@ class App(tk.Tk):
                     print(f"Mapeo completado. '{COMERCIAL_COLUMNA}' actualizados: {num_actualizados}.")
                     if num_actualizados > 0: messagebox.showinfo("Mapeo Comercial", f"'{COMERCIAL_COLUMNA}' actualizado para {num_actualizados} registros.")
                 except Exception as e: messagebox.showerror("Error Mapeo", f"Error al actualizar 'Comercial': {e}")
-            if CLIENTE_COLUMNA in self.df_original.columns:
-                clientes_raw = self.df_original[CLIENTE_COLUMNA].astype(str).unique()
-                self.lista_clientes_unicos = sorted([c for c in clientes_raw if c.lower() != 'nan'])
+            self.actualizar_lista_clientes()
             self.mostrar_todo()
         else: pass
 
@@ -364,71 +734,126 @@ class App(tk.Tk):
         if self.df_original is None: messagebox.showwarning("Datos no Cargados", "Selecciona un archivo."); return
         try: fecha_inicio = pd.to_datetime(self.fecha_inicio_entry.get_date()); fecha_fin = pd.to_datetime(self.fecha_fin_entry.get_date())
         except ValueError: messagebox.showerror("Error", "Formato de fecha inválido."); return
-        cliente_buscar = self.cliente_var.get().strip().lower()
-        df_filtrado_temp = self.df_original.copy()
-        if FECHA_COLUMNA in df_filtrado_temp.columns and pd.api.types.is_datetime64_any_dtype(df_filtrado_temp[FECHA_COLUMNA]):
-             mask_fecha = (df_filtrado_temp[FECHA_COLUMNA].notna()) & (df_filtrado_temp[FECHA_COLUMNA] >= fecha_inicio) & (df_filtrado_temp[FECHA_COLUMNA] <= fecha_fin)
-             df_filtrado_temp = df_filtrado_temp[mask_fecha]
-        if cliente_buscar and CLIENTE_COLUMNA in df_filtrado_temp.columns:
-              mask_cliente = df_filtrado_temp[CLIENTE_COLUMNA].notna() & df_filtrado_temp[CLIENTE_COLUMNA].astype(str).str.lower().str.contains(cliente_buscar, na=False)
-              df_filtrado_temp = df_filtrado_temp[mask_cliente]
-        self.df_filtrado = df_filtrado_temp; self.mostrar_en_treeview()
-        messagebox.showinfo("Filtro Aplicado", f"Vista actualizada. Mostrando {len(self.df_filtrado)} registros.")
+        cliente_buscar = self.cliente_var.get().strip()
+        # Solo ids de fila: el DataFrame no se copia ni se recorre completo
+        vista_ids = self.obtener_indice_filtros().filtrar(fecha_inicio, fecha_fin, cliente_buscar)
+        self.mostrar_en_treeview(vista_ids)
+        messagebox.showinfo("Filtro Aplicado", f"Vista actualizada. Mostrando {len(vista_ids)} registros.")
 
     def mostrar_todo(self):
         if self.df_original is None: messagebox.showwarning("Datos no Cargados", "Selecciona un archivo."); return
-        self.df_filtrado = self.df_original.copy(); self.mostrar_en_treeview()
+        self.mostrar_en_treeview()
         self.cliente_var.set(""); self.hide_cliente_listbox()
-        messagebox.showinfo("Vista Restaurada", f"Mostrando los {len(self.df_filtrado)} registros originales.")
+        messagebox.showinfo("Vista Restaurada", f"Mostrando los {len(self.vista_ids)} registros originales.")
+
+    def obtener_indice_filtros(self):
+        """Índice de filtros de df_original; se reconstruye solo si df_original cambió."""
+        if self._indice_origen is not self.df_original: self.indice_filtros = IndiceFiltros(self.df_original); self._indice_origen = self.df_original
+        return self.indice_filtros
+
+    def obtener_totales_filas(self):
+        """Arrays de Subtotal/Peso CC de df_original; se reconstruyen solo si df_original cambió."""
+        if self._totales_origen is not self.df_original: self.totales_filas = TotalesFilas(self.df_original); self._totales_origen = self.df_original
+        return self.totales_filas
 
     def limpiar_treeview(self):
         for item in self.tree.get_children(): self.tree.delete(item)
         self.tree["columns"] = []; self.tree["show"] = "headings"
+        self.original_indices.clear(); self.vista_ids = np.array([], dtype=object); self.vista_offset = 0
+        self.seleccion_ids = set(); self.foco_pos = None; self.ancla_pos = None; self.scrollbar_y.set(0.0, 1.0)
         if hasattr(self, 'summary_label'):
              self.summary_label.config(text="Selección: 0 filas | Suma Subtotal: 0,00 | Suma Peso CC: 0,00")
 
-    def mostrar_en_treeview(self):
+    def mostrar_en_treeview(self, vista_ids=None):
+         """Muestra las filas de df_original con esos ids (todas si vista_ids es None)."""
          self.limpiar_treeview()
-         if self.df_filtrado is None or self.df_filtrado.empty: return
-         columnas_con_coma = {SUBTOTAL_COLUMNA, PESO_COLUMNA, 'Vlr Unit'}
-         columnas_mostrar = COLUMNAS_POSIBLES_ESPERADAS if COLUMNAS_POSIBLES_ESPERADAS else list(self.df_filtrado.columns)
-         columnas_mostrar_existentes = [col for col in columnas_mostrar if col in self.df_filtrado.columns]
+         if self.df_original is None or self.df_original.empty: return
+         if vista_ids is None: vista_ids = self.df_original.index.to_numpy()
+         if not len(vista_ids): return
+         columnas_mostrar = COLUMNAS_POSIBLES_ESPERADAS if COLUMNAS_POSIBLES_ESPERADAS else list(self.df_original.columns)
+         columnas_mostrar_existentes = [col for col in columnas_mostrar if col in self.df_original.columns]
          self.tree["columns"] = columnas_mostrar_existentes; self.tree["show"] = "headings"
          for col in columnas_mostrar_existentes:
              self.tree.heading(col, text=col); col_width = max(len(col)*10, 100)
              self.tree.column(col, anchor=tk.W, width=col_width, stretch=tk.NO)
-         self.original_indices.clear()
-         for index_filtrado, row in self.df_filtrado.iterrows():
-             valores_formateados = []
-             for col_name in columnas_mostrar_existentes:
-                 val = row[col_name]
-                 if pd.isna(val): valores_formateados.append("")
-                 elif col_name in columnas_con_coma and isinstance(val, (int, float)):
-                     decimals = 2
-                     if col_name == PESO_COLUMNA: decimals = 2
-                     try: formatted_val = f"{val:.{decimals}f}".replace('.', ',')
-                     except (ValueError, TypeError): formatted_val = str(val)
-                     valores_formateados.append(formatted_val)
-                 elif isinstance(val, (datetime, pd.Timestamp)): valores_formateados.append(val.strftime('%Y/%m/%d'))
-                 else: valores_formateados.append(str(val))
-             item_id = self.tree.insert("", tk.END, values=valores_formateados)
-             self.original_indices[item_id] = index_filtrado
+         # Textos preformateados de df_original completo; se recalculan solo si cambió el DataFrame o sus columnas
+         if self._textos_origen is not self.df_original or list(self.textos_vista.columns) != columnas_mostrar_existentes:
+             self.textos_vista = formatear_columnas_vista(self.df_original, columnas_mostrar_existentes); self._textos_origen = self.df_original
+         self.vista_ids = vista_ids
+         self.renderizar_ventana()
          self.update_selection_summary()
 
+    # --- Tabla virtual ---
+    def filas_visibles(self):
+        """Filas que caben en el alto actual del Treeview (descontando el encabezado)."""
+        alto_tabla = self.tree.winfo_height()
+        if alto_tabla <= 1: return 25 # Aún sin dibujar
+        return max(1, (alto_tabla - TABLA_ALTO_FILA - 4) // TABLA_ALTO_FILA)
+
+    def renderizar_ventana(self):
+        """
+        Materializa en el Treeview solo las filas visibles a partir de vista_offset, reutilizando
+        los ítems existentes. La selección vive en seleccion_ids (toda la vista), no en el Treeview.
+        """
+        total = len(self.vista_ids); visibles = min(self.filas_visibles(), total)
+        self.vista_offset = max(0, min(self.vista_offset, total - visibles))
+        ids_ventana = self.vista_ids[self.vista_offset:self.vista_offset + visibles]
+        valores = self.textos_vista.loc[ids_ventana].values.tolist() if visibles else []
+        items = list(self.tree.get_children())
+        for item in items[visibles:]: self.tree.delete(item)
+        for hueco in range(len(items), visibles): items.append(self.tree.insert("", tk.END, iid=str(hueco)))
+        self.original_indices.clear()
+        for item, id_fila, valores_fila in zip(items, ids_ventana, valores):
+            self.tree.item(item, values=valores_fila); self.original_indices[item] = id_fila
+        self.tree.selection_set([item for item, id_fila in self.original_indices.items() if id_fila in self.seleccion_ids])
+        if self.foco_pos is not None and self.vista_offset <= self.foco_pos < self.vista_offset + visibles: self.tree.focus(items[self.foco_pos - self.vista_offset])
+        self.scrollbar_y.set(*((self.vista_offset / total, (self.vista_offset + visibles) / total) if total else (0.0, 1.0)))
+
+    def desplazar_vista(self, filas):
+        self.vista_offset += filas; self.renderizar_ventana(); return "break"
+
+    def on_scroll_vista(self, accion, cantidad, unidad=None):
+        if accion == 'moveto': self.vista_offset = int(float(cantidad) * len(self.vista_ids))
+        elif accion == 'scroll': self.vista_offset += int(cantidad) * (self.filas_visibles() if unidad == 'pages' else 1)
+        self.renderizar_ventana()
+
+    def seleccionar_posiciones(self, posicion, modo):
+        """Actualiza la selección (ids de fila de toda la vista) como lo haría un Treeview completo."""
+        id_fila = self.vista_ids[posicion]
+        if modo == 'rango' and self.ancla_pos is not None:
+            inicio, fin = sorted((self.ancla_pos, posicion)); self.seleccion_ids = set(self.vista_ids[inicio:fin + 1])
+        elif modo == 'alternar': self.seleccion_ids ^= {id_fila}; self.ancla_pos = posicion
+        else: self.seleccion_ids = {id_fila}; self.ancla_pos = posicion
+        self.foco_pos = posicion
+
+    def on_click_tabla(self, event, modo):
+        if self.tree.identify_region(event.x, event.y) in ('heading', 'separator'): return None # Ordenar/redimensionar columnas: comportamiento normal
+        item = self.tree.identify_row(event.y)
+        if not item or item not in self.original_indices: return "break"
+        self.seleccionar_posiciones(self.vista_offset + self.tree.index(item), modo)
+        self.tree.focus_set(); self.renderizar_ventana(); self.update_selection_summary(); return "break"
+
+    def mover_foco(self, paso, extender):
+        total = len(self.vista_ids)
+        if not total: return "break"
+        actual = self.foco_pos if self.foco_pos is not None else self.vista_offset
+        saltos = {'pagina-': -self.filas_visibles(), 'pagina+': self.filas_visibles(), 'inicio': -total, 'fin': total}
+        nueva = max(0, min(total - 1, actual + saltos.get(paso, paso)))
+        self.seleccionar_posiciones(nueva, 'rango' if extender else 'simple')
+        visibles = self.filas_visibles() # Desplazar lo justo para que el foco quede visible
+        if nueva < self.vista_offset: self.vista_offset = nueva
+        elif nueva >= self.vista_offset + visibles: self.vista_offset = nueva - visibles + 1
+        self.renderizar_ventana(); self.update_selection_summary(); return "break"
+
+    def indices_seleccionados(self):
+        """Ids de fila (índice de df_original) seleccionados, en el orden de la vista."""
+        if not self.seleccion_ids: return []
+        return [id_fila for id_fila in self.vista_ids if id_fila in self.seleccion_ids]
+
     def update_selection_summary(self, event=None):
         count = 0; total_subtotal = 0.0; total_peso = 0.0
-        selected_ids = self.tree.selection()
-        if selected_ids and self.df_original is not None:
-            original_indices_seleccionados = [self.original_indices[item_id] for item_id in selected_ids if item_id in self.original_indices]
-            if original_indices_seleccionados:
-                selected_rows = self.df_original.loc[original_indices_seleccionados]
-                count = len(selected_rows)
-                if SUBTOTAL_COLUMNA in selected_rows.columns:
-                    subtotal_numeric = pd.to_numeric(selected_rows[SUBTOTAL_COLUMNA], errors='coerce')
-                    total_subtotal = subtotal_numeric.sum(skipna=True)
-                if PESO_COLUMNA in selected_rows.columns:
-                    peso_numeric = pd.to_numeric(selected_rows[PESO_COLUMNA], errors='coerce')
-                    total_peso = peso_numeric.sum(skipna=True)
+        if self.seleccion_ids and self.df_original is not None:
+            count, total_subtotal, total_peso = self.obtener_totales_filas().totales(self.seleccion_ids)
         try: subtotal_str = f"{total_subtotal:.2f}".replace('.', ',')
         except: subtotal_str = "Error"
         try: peso_str = f"{total_peso:.2f}".replace('.', ',')
@@ -447,12 +872,11 @@ class App(tk.Tk):
 
     def mover_seleccionados(self):
             if not self.selected_excel_file: messagebox.showerror("Error", "No hay archivo seleccionado."); return
-            selected_item_ids = self.tree.selection()
-            if not selected_item_ids: messagebox.showwarning("Advertencia", "No hay filas seleccionadas."); return
+            if not self.seleccion_ids: messagebox.showwarning("Advertencia", "No hay filas seleccionadas."); return
             if self.df_original is None: messagebox.showerror("Error", "No hay datos originales cargados."); return
-            confirm = messagebox.askyesno("Confirmar Acción", f"Modificar:\n'{os.path.basename(self.selected_excel_file)}'?\n(Mover {len(selected_item_ids)} filas, etc.)\n¡CERRAR ARCHIVO ANTES!")
+            confirm = messagebox.askyesno("Confirmar Acción", f"Modificar:\n'{os.path.basename(self.selected_excel_file)}'?\n(Mover {len(self.seleccion_ids)} filas, etc.)\n¡CERRAR ARCHIVO ANTES!")
             if not confirm: return
-            indices_a_mover = [self.original_indices[item_id] for item_id in selected_item_ids if item_id in self.original_indices]
+            indices_a_mover = self.indices_seleccionados()
             if not indices_a_mover: messagebox.showerror("Error", "No se identificaron filas."); return
             columnas_para_elim_existentes = [col for col in COLUMNAS_ELIMINADOS if col in self.df_original.columns]
             df_a_mover = self.df_original.loc[indices_a_mover, columnas_para_elim_existentes].copy()
@@ -463,11 +887,7 @@ class App(tk.Tk):
             if guardar_cambios_excel_completo(self.selected_excel_file, df_posibles_actualizado, df_a_mover):
                 messagebox.showinfo("Éxito", f"Proceso completado en:\n'{os.path.basename(self.selected_excel_file)}'.")
                 self.df_original = df_posibles_actualizado.copy()
-                if CLIENTE_COLUMNA in self.df_original.columns:
-                    clientes_raw = self.df_original[CLIENTE_COLUMNA].astype(str).unique()
-                    self.lista_clientes_unicos = sorted([c for c in clientes_raw if c.lower() != 'nan'])
-                else:
-                    self.lista_clientes_unicos = []
+                self.actualizar_lista_clientes()
                 self.mostrar_todo()
             else:
                 messagebox.showwarning("Advertencia Guardado", "Error al guardar.")
@@ -0,0 +1,230 @@
+# -*- coding: utf-8 -*-
+"""
+Banco de pruebas de rendimiento para Movilidad.py con libros sintéticos.
+
+Genera libros con la misma estructura que espera el script (WEB2.0, 'Clientes y
+sucursales', CSAP2 con 1 fila de título, CodigoSAP con 2 filas de título y
+'Plantilla de Cargue 2' con las dos columnas '1'), ejecuta el proceso sin GUI en un
+proceso aparte por tamaño y reporta tiempo total, memoria pico y costo por fase.
+
+Uso:
+    python benchmark_movilidad.py                      # 1.000, 10.000 y 100.000 filas
+    python benchmark_movilidad.py --filas 1000 5000 --reporte bench.json
+"""
+
+import argparse
+import contextlib
+import io
+import json
+import multiprocessing
+import os
+import random
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+from typing import List, Dict, Tuple, Any, Optional
+
+import numpy as np
+import openpyxl
+
+import Movilidad as M
+
+# ==============================================================================
+# --- Configuración ---
+# ==============================================================================
+DEFAULT_ROW_COUNTS = [1_000, 10_000, 100_000]
+DEFAULT_SEED = 20250409
+CLIENTS_PER_ROWS = 20            # Un cliente distinto por cada N filas (mínimo MIN_CLIENTS)
+MIN_CLIENTS = 50
+CLIENT_WITH_SEDE_RATIO = 0.35    # Clientes escritos como 'CLIENTE - SEDE' (usan la parte 2 del nombre)
+CLIENT_EQ_SUCURSAL_RATIO = 0.5   # Sucursales cuyo nombre es igual al cliente (Prioridad 2)
+RESIDUO_VOCABULARY_SIZE = 400
+TYPO_RATE = 0.08                 # Probabilidad de error de digitación en Cliente/Residuo
+UNKNOWN_RESIDUO_RATE = 0.03      # Residuos que no existen en ninguna lista SAP
+STALE_TEMPLATE_ROWS_RATIO = 1.3  # Filas del mes anterior en la plantilla (para la limpieza)
+
+CLIENT_WORDS = ["HOSPITAL", "CLINICA", "LABORATORIO", "DROGUERIA", "INVERSIONES", "MEDICAS", "SAN", "SANTA", "MARIA",
+                "PABLO", "TOBON", "URIBE", "ANTIOQUIA", "CENTRO", "ODONTOLOGICO", "VETERINARIA", "ESTETICA", "IPS",
+                "FUNDACION", "COMERCIALIZADORA", "INDUSTRIAS", "QUIMICOS", "DEL", "NORTE", "SUR", "ORIENTE", "VALLE",
+                "BELLO", "ENVIGADO", "ITAGUI", "RIONEGRO", "SALUD", "VIDA", "AMERICAS", "SOMA", "LEON", "XIII"]
+CLIENT_SUFFIXES = ["", "", "", " S.A.S", " SAS", " S.A", " LTDA", " E.S.E"]
+SEDE_WORDS = ["SEDE", "PRINCIPAL", "NORTE", "SUR", "CENTRO", "POBLADO", "LAURELES", "BELEN", "CALASANZ", "URGENCIAS", "BLOQUE"]
+RESIDUO_WORDS = ["ANATOMOPATOLOGICOS", "BIOSANITARIOS", "CORTOPUNZANTES", "FARMACOS", "CITOTOXICOS", "ACEITE", "USADO",
+                 "LUMINARIAS", "BATERIAS", "PLOMO", "ACIDO", "SOLVENTES", "REACTIVOS", "LABORATORIO", "CAL", "SODADA",
+                 "ENVASES", "CONTAMINADOS", "FILTROS", "TONER", "RAEE", "AMALGAMAS", "REVELADOR", "FIJADOR", "QUIMICOS",
+                 "LODOS", "TRAPOS", "ABSORBENTES", "MEDICAMENTOS", "VENCIDOS", "SOLIDOS", "LIQUIDOS", "COVID", "PATOLOGICOS"]
+CORRIENTES = ["Y1", "Y1.2", "Y1.3", "Y3", "Y8", "Y9", "A1160", "A1180", "A4090", "A4140", "Y31"]
+
+WEB_HEADERS = ['Cliente', 'Placa', 'Residuo', 'Peso Recogido', 'Unidad', 'Embalaje', 'Cant. / Caja Nro.', 'Auxiliar',
+               'CC No.', 'Fecha CC', 'Disposición Final', 'Tipología', 'Estado ']
+SUCURSAL_HEADERS = ['Sociedad', 'Regional', 'Oficina de Ventas', 'Nit', 'Cliente', 'Sucursal', 'nueva sede', 'Codigo Deudor', 'Estado']
+TEMPLATE_HEADERS = ['CLIENTE', 'SUCURSAL', 'DEUDOR DE SUCURSAL', 'FECHA DE SERVICIO', 1, 'NOMBRE DE QUIEN ENTREGA',
+                    'CÉDULA DE QUIEN ENTREGA', 'CARGO DE QUIEN ENTREGA', 'CÉDULA DE CONDUCTOR', 'CÉDULA DE AUXILIAR',
+                    'PLACA DEL VEHÍCULO', 'CÓDIGO SAP DEL MATERIAL', 'CANTIDAD (PESO)', 1]
+
+# ==============================================================================
+# --- Generación de Datos Sintéticos ---
+# ==============================================================================
+def _typo(text: str, rng: random.Random) -> str:
+    """Un error de digitación: omitir, duplicar, intercambiar o reemplazar un carácter."""
+    if len(text) < 4: return text
+    pos = rng.randrange(1, len(text) - 1); kind = rng.randrange(4)
+    if kind == 0: return text[:pos] + text[pos + 1:]
+    if kind == 1: return text[:pos] + text[pos] + text[pos:]
+    if kind == 2: return text[:pos - 1] + text[pos] + text[pos - 1] + text[pos + 1:]
+    return text[:pos] + rng.choice("AEIOURSTLN") + text[pos + 1:]
+
+def _zipf_choices(n_items: int, n_draws: int, np_rng: np.random.Generator, exponent: float = 1.1) -> np.ndarray:
+    """Índices con repetición tipo Zipf (pocos valores muy frecuentes, cola larga)."""
+    weights = 1.0 / np.arange(1, n_items + 1) ** exponent
+    return np_rng.choice(n_items, size=n_draws, p=weights / weights.sum())
+
+def _unique_names(count: int, words: List[str], n_words: Tuple[int, int], rng: random.Random) -> List[str]:
+    names: List[str] = []; seen = set()
+    while len(names) < count:
+        name = " ".join(rng.sample(words, rng.randint(*n_words)))
+        if name not in seen: seen.add(name); names.append(name)
+    return names
+
+def build_synthetic_workbook(n_rows: int, output_path: str, seed: int = DEFAULT_SEED) -> Dict[str, int]:
+    """
+    Escribe un libro sintético de n_rows filas en WEB2.0 con el formato que espera Movilidad.py.
+
+    Returns:
+        Tamaños generados (filas, clientes, sucursales, materiales SAP).
+    """
+    rng = random.Random(seed + n_rows); np_rng = np.random.default_rng(seed + n_rows)
+
+    # --- Clientes, sedes y sucursales ---
+    n_clients = max(MIN_CLIENTS, n_rows // CLIENTS_PER_ROWS)
+    base_clients = _unique_names(n_clients, CLIENT_WORDS, (2, 4), rng)
+    client_display: List[str] = []; sucursal_rows: List[Tuple[str, str, int]] = []; deudor = 80_000_000
+    for base in base_clients:
+        legal_name = base + rng.choice(CLIENT_SUFFIXES)
+        if rng.random() < CLIENT_WITH_SEDE_RATIO:
+            sede = " ".join(rng.sample(SEDE_WORDS, 2))
+            client_display.append(f"{legal_name} - {sede}")
+            deudor += 1; sucursal_rows.append((legal_name, f"{base} {sede}", deudor))
+        else:
+            client_display.append(legal_name)
+            deudor += 1; sucursal_rows.append((legal_name, base if rng.random() < CLIENT_EQ_SUCURSAL_RATIO else f"{base} PRINCIPAL", deudor))
+
+    # --- Materiales SAP (CSAP2 y CodigoSAP) ---
+    residuo_names = _unique_names(RESIDUO_VOCABULARY_SIZE, RESIDUO_WORDS, (1, 3), rng)
+    csap1_rows: List[Tuple[str, str, str, int, str, str]] = []; csap2_rows: List[Tuple[int, str, str, str, str, str]] = []
+    for pos, name in enumerate(residuo_names):
+        code = 900_000 + pos; corriente = rng.choice(CORRIENTES)
+        if pos % 2 == 0: csap1_rows.append((f"{name} {500 + pos}", f"H{pos:03d}", corriente, code, name, corriente))
+        else: csap2_rows.append((code, corriente, f"{name} {corriente}", str(code), name, corriente))
+
+    # --- Filas de WEB2.0 ---
+    client_idx = _zipf_choices(len(client_display), n_rows, np_rng)
+    residuo_idx = _zipf_choices(len(residuo_names), n_rows, np_rng)
+    start_date = datetime(2025, 4, 1); placas = [f"{rng.choice('GHNST')}{rng.choice('DLVX')}{rng.choice('KYZ')}{rng.randint(100, 999)}" for _ in range(40)]
+
+    workbook = openpyxl.Workbook(write_only=True)
+    ws = workbook.create_sheet(M.SOURCE_SHEET_NAME); ws.append(WEB_HEADERS)
+    for row_pos in range(n_rows):
+        cliente = client_display[client_idx[row_pos]]
+        if rng.random() < TYPO_RATE: cliente = _typo(cliente, rng)
+        residuo = residuo_names[residuo_idx[row_pos]]
+        if rng.random() < UNKNOWN_RESIDUO_RATE: residuo = f"MATERIAL NO REGISTRADO {rng.randint(1, 60)}"
+        elif rng.random() < TYPO_RATE: residuo = _typo(residuo, rng)
+        ws.append([cliente, rng.choice(placas), residuo, round(rng.uniform(0.1, 250.0), 2), 'KILO GRAMOS', 'BOLSA', 1, 'AUXILIAR',
+                   850_000 + row_pos, start_date + timedelta(days=rng.randrange(30)), 'INCINERACIÓN', 'INCINERACION', 'Pendiente '])
+
+    ws = workbook.create_sheet(M.LOOKUP_SUCURSAL_SHEET_NAME); ws.append(SUCURSAL_HEADERS)
+    for pos, (cliente, sucursal, codigo) in enumerate(sucursal_rows):
+        ws.append(['ECOLOGISTICA S.A.S. E.S.P.', 'Medellín', 2011, 8_000_000 + pos, cliente, sucursal, sucursal.lower().replace(" ", ""), codigo, 'Activo'])
+
+    ws = workbook.create_sheet(M.LOOKUP_CSAP1_SHEET_NAME)
+    ws.append(['REFERENCIAS DE MATERIALES ECOLOGISTICA', None, None, 'SUGERENCIA HOMOLOGACIÓN', None, None])
+    ws.append(['Item', 'Referencia', 'Corriente ', M.LKP_CSAP1_CODIGO, 'NOMBRE MATERIAL', 'CORRIENTE '])
+    for row in csap1_rows: ws.append(list(row))
+
+    ws = workbook.create_sheet(M.LOOKUP_CSAP2_SHEET_NAME)
+    ws.append(['DENOMINACIÓN ANTERIOR', None, None, 'SUGERENCIA NUEVA DENOMINACIÓN', None, None])
+    ws.append(['MOVILIDAD 2.0', None, None, 'NUEVA PLATAFORMA MOVILIDAD ATICA', None, None])
+    ws.append(['Código SAP de Material', M.LKP_CSAP2_CORRIENTE, M.LKP_CSAP2_NOMBRE, M.LKP_CSAP2_CODIGO, 'Nombre del Material2', 'Corriente2'])
+    for row in csap2_rows: ws.append(list(row))
+
+    ws = workbook.create_sheet(M.TARGET_SHEET_NAME); ws.append(TEMPLATE_HEADERS)
+    for row_pos in range(int(n_rows * STALE_TEMPLATE_ROWS_RATIO)): # Datos del mes anterior que deben limpiarse
+        ws.append(['CLIENTE ANTERIOR', 'SUCURSAL ANTERIOR', 80_000_000, '2025-03-01', 1, M.FIXED_STRING_SIN_DESCRIPCION, None,
+                   M.FIXED_STRING_SIN_DESCRIPCION, '70328232', '1037670403', 'ABC123', 900_001, '1.0', 1])
+    workbook.save(output_path)
+    return {'rows': n_rows, 'clients': len(client_display), 'sucursales': len(sucursal_rows),
+            'sap_materials': len(csap1_rows) + len(csap2_rows)}
+
+# ==============================================================================
+# --- Ejecución y Medición ---
+# ==============================================================================
+def _peak_memory_mb() -> Tuple[float, str]:
+    """Memoria pico del proceso actual: RSS máximo donde existe 'resource', si no el pico de tracemalloc."""
+    try:
+        import resource
+        max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return (max_rss / 1024 ** 2 if sys.platform == 'darwin' else max_rss / 1024), 'max_rss'
+    except ImportError:
+        import tracemalloc
+        return tracemalloc.get_traced_memory()[1] / 1024 ** 2, 'tracemalloc'
+
+def _run_pipeline_once(workbook_path: str, output_dir: str, streaming: bool = False, output_format: str = M.OUTPUT_FORMAT) -> Dict[str, Any]:
+    """Se ejecuta en un proceso nuevo por tamaño: proceso sin GUI, sin cachés ni decisiones persistentes."""
+    if sys.platform == 'win32':
+        import tracemalloc; tracemalloc.start()
+    M.USE_LOOKUP_CACHE = False; M.USE_SAP_DECISION_STORE = False; M.WRITE_RUN_REPORT = False
+    captured = io.StringIO(); t_start = time.perf_counter()
+    with contextlib.redirect_stdout(captured): # El registro del proceso no forma parte de la medición
+        result = M.process_workbook_headless(workbook_path, output_dir, streaming=streaming, output_format=output_format)
+    wall_seconds = time.perf_counter() - t_start
+    peak_mb, peak_source = _peak_memory_mb()
+    return {'wall_seconds': round(wall_seconds, 3), 'peak_memory_mb': round(peak_mb, 1), 'peak_memory_source': peak_source,
+            'rows': result['rows'], 'pending_sap': result['pending_sap'], **result['stats']}
+
+def run_benchmark(row_counts: List[int], work_dir: str, seed: int = DEFAULT_SEED, streaming: bool = False,
+                  output_format: str = M.OUTPUT_FORMAT) -> List[Dict[str, Any]]:
+    results: List[Dict[str, Any]] = []
+    spawn_ctx = multiprocessing.get_context('spawn') # Proceso limpio por tamaño: la memoria pico no se mezcla
+    for n_rows in row_counts:
+        workbook_path = os.path.join(work_dir, f"sintetico_{n_rows}.xlsx")
+        t_start = time.perf_counter(); sizes = build_synthetic_workbook(n_rows, workbook_path, seed)
+        print(f"Libro sintético de {n_rows} filas generado en {time.perf_counter() - t_start:.1f}s "
+              f"({sizes['clients']} clientes, {sizes['sap_materials']} materiales SAP).")
+        with spawn_ctx.Pool(1) as pool: result = pool.apply(_run_pipeline_once, (workbook_path, work_dir, streaming, output_format))
+        results.append({'size': n_rows, **sizes, **result})
+        print(f"  -> {result['wall_seconds']:.2f}s, memoria pico {result['peak_memory_mb']:.0f} MB")
+    return results
+
+def print_results_table(results: List[Dict[str, Any]]):
+    phases: List[str] = []
+    for result in results: phases += [p for p in result['phases_seconds'] if p not in phases]
+    header = f"{'fase':<16}" + "".join(f"{r['size']:>12,}" for r in results)
+    print("\n" + header); print("-" * len(header))
+    for phase in phases: print(f"{phase:<16}" + "".join(f"{r['phases_seconds'].get(phase, 0.0):>11.2f}s" for r in results))
+    print("-" * len(header))
+    print(f"{'total (pared)':<16}" + "".join(f"{r['wall_seconds']:>11.2f}s" for r in results))
+    print(f"{'memoria pico':<16}" + "".join(f"{r['peak_memory_mb']:>9.0f} MB" for r in results))
+    print(f"{'filas/s':<16}" + "".join(f"{r['rows'] / r['wall_seconds'] if r['wall_seconds'] else 0:>12,.0f}" for r in results))
+
+def parse_args(argv: Optional[List[str]] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Benchmark de Movilidad.py con libros sintéticos.")
+    parser.add_argument('--filas', type=int, nargs='+', default=DEFAULT_ROW_COUNTS, help="Tamaños a medir (filas de WEB2.0).")
+    parser.add_argument('--semilla', type=int, default=DEFAULT_SEED, help="Semilla de los datos sintéticos.")
+    parser.add_argument('--directorio', default=None, help="Directorio de trabajo (por defecto, uno temporal que se borra).")
+    parser.add_argument('--por-bloques', action='store_true', help="Mide el modo de lectura por bloques de WEB2.0.")
+    parser.add_argument('-f', '--formato', choices=list(M.OUTPUT_FORMAT_EXTENSIONS), default=M.OUTPUT_FORMAT, help="Formato del archivo final medido.")
+    parser.add_argument('--reporte', default=None, help="Ruta de un JSON con los resultados.")
+    return parser.parse_args(argv)
+
+if __name__ == "__main__":
+    args = parse_args()
+    with contextlib.ExitStack() as stack:
+        work_dir = args.directorio or stack.enter_context(tempfile.TemporaryDirectory(prefix="bench_movilidad_"))
+        os.makedirs(work_dir, exist_ok=True)
+        bench_results = run_benchmark(args.filas, work_dir, args.semilla, args.por_bloques, args.formato)
+    print_results_table(bench_results)
+    if args.reporte:
+        with open(args.reporte, 'w', encoding='utf-8') as f: json.dump(bench_results, f, ensure_ascii=False, indent=2)
+        print(f"\nResultados guardados en '{args.reporte}'.")
@@ -0,0 +1,50 @@
+# -*- coding: utf-8 -*-
+"""
+Paridad entre la lectura por bloques de WEB2.0 (iter_source_chunks) y pd.read_excel:
+mismas columnas, nulos y tipos inferidos al unir los bloques.
+"""
+import os
+import sys
+from datetime import datetime
+
+import openpyxl
+import pandas as pd
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import Movilidad as M
+
+# Texto numérico, booleanos, fechas, nulos de texto ('NA', 'null'), columnas mixtas, sin nombre y repetidas
+ENCABEZADO = ["Cliente", "Placa", "Fecha CC", "Activo", "Residuo", "Peso Recogido", "Mixta", "Vacía", None, "Cliente", "Espacios"]
+FILAS = [
+    ["Clínica Ñandú S.A.S - Sede", "0123", datetime(2024, 1, 2), True, "NA", 1.5, "x", None, None, 3, "  "],
+    ["Acme", "45", datetime(2024, 1, 3, 7, 30), False, "Cartón", 2, "", None, None, 4, "z"],
+    [None] * len(ENCABEZADO), # Fila en blanco intermedia
+    ["Hospital", "7", None, True, "null", None, 5, None, None, 5, "q"],
+    ["Hospital", "ABC-12", datetime(2024, 2, 1), None, "Plástico", 3, 6.5, None, None, None, "w"],
+]
+
+def _crear_libro(ruta, filas_en_blanco_al_final=0):
+    wb = openpyxl.Workbook(); ws = wb.active; ws.title = M.SOURCE_SHEET_NAME
+    ws.append(ENCABEZADO)
+    for fila in FILAS * 3: ws.append(fila)
+    for _ in range(filas_en_blanco_al_final): ws.append([None] * len(ENCABEZADO)); ws.cell(row=ws.max_row, column=1).number_format = '0.00'
+    wb.save(ruta)
+
+def _leer_por_bloques(ruta, filas_por_bloque):
+    return pd.concat(list(M.iter_source_chunks(ruta, filas_por_bloque)), ignore_index=True)
+
+def test_un_bloque_igual_a_read_excel(tmp_path):
+    ruta = str(tmp_path / "fuente.xlsx"); _crear_libro(ruta)
+    pd.testing.assert_frame_equal(_leer_por_bloques(ruta, 1000), pd.read_excel(ruta, sheet_name=M.SOURCE_SHEET_NAME))
+
+def test_bloques_pequenos_igual_a_read_excel(tmp_path):
+    """Bloques con la misma mezcla de valores que la hoja completa: mismos tipos y mismas huellas."""
+    ruta = str(tmp_path / "fuente.xlsx"); _crear_libro(ruta)
+    esperado = pd.read_excel(ruta, sheet_name=M.SOURCE_SHEET_NAME)
+    por_bloques = _leer_por_bloques(ruta, len(FILAS))
+    pd.testing.assert_frame_equal(por_bloques, esperado)
+    assert M.fingerprint_source_rows(por_bloques) == M.fingerprint_source_rows(esperado)
+
+def test_filas_en_blanco_al_final_no_cuentan(tmp_path):
+    ruta = str(tmp_path / "fuente.xlsx"); _crear_libro(ruta, filas_en_blanco_al_final=3)
+    pd.testing.assert_frame_equal(_leer_por_bloques(ruta, 1000), pd.read_excel(ruta, sheet_name=M.SOURCE_SHEET_NAME))
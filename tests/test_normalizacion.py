@@ -0,0 +1,80 @@
+# -*- coding: utf-8 -*-
+"""
+Paridad entre la normalización vectorizada de Movilidad.py (normalize_*_series /
+_map_unique) y las funciones originales fila a fila (clean_*).
+"""
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import Movilidad as M
+
+# Nulos, 3 vs 3.0, tildes/ñ/diéresis, sufijos societarios, guiones y espacios sobrantes
+VALORES_CLIENTE = [
+    None, np.nan, pd.NaT, "", "   ", 3, 3.0, "3", 3.5, True,
+    "Clínica Ñandú S.A.S.", "CLINICA ÑANDU SAS", "clínica ñandú sas - Sede Norte",
+    "Hospital San José LTDA-Urgencias", "Hospital San José Ltda - urgencias ",
+    "Pingüino E.S.P. - Planta Güemes", "Acme S A", "Acme SA-", "Acme - SA - Bodega 2",
+    "-Solo sucursal", "Empresa LIMITADA", "Empresas SASA", "  Ágil  S.A.  -  Café  ",
+    "Multi-guion-cliente - sucursal - extra",
+]
+VALORES_RESIDUO = [
+    None, np.nan, "", " ", 3, 3.0, "3", "Cartón", "CARTON", " cartón ", "Plástico PET",
+    "Aceite usado  ", "Residuos peligrosos - Lámparas", "Pilas/Baterías", "ÁÉÍÓÚ äëïöü Ññ",
+]
+
+def _original_part1(values): return values.apply(lambda x: M.clean_client_name_part(str(x).split('-', maxsplit=1)[0]))
+
+def _original_part2(values):
+    def get_cleaned_part_after_hyphen(name): parts = str(name).split('-', 1); return M.clean_text_for_comparison(parts[1].strip()) if len(parts) > 1 else ""
+    return values.apply(get_cleaned_part_after_hyphen)
+
+def _original_residuo(values): return values.apply(M.clean_text_for_comparison)
+
+def _serie(valores, repeticiones=3):
+    """Valores repetidos y desordenados para ejercitar la difusión de categorías a filas."""
+    filas = list(valores) * repeticiones
+    orden = np.random.default_rng(0).permutation(len(filas))
+    return pd.Series([filas[i] for i in orden], dtype=object)
+
+CASOS = [
+    ("parte1", VALORES_CLIENTE, M.normalize_client_part1_series, _original_part1),
+    ("parte2", VALORES_CLIENTE, M.normalize_client_part2_series, _original_part2),
+    ("residuo", VALORES_RESIDUO, M.normalize_text_series, _original_residuo),
+]
+
+@pytest.mark.parametrize("nombre,valores,vectorizada,original", CASOS, ids=[c[0] for c in CASOS])
+def test_paridad_normalizacion(nombre, valores, vectorizada, original):
+    serie = _serie(valores)
+    assert vectorizada(serie).astype(object).tolist() == original(serie).tolist()
+
+@pytest.mark.parametrize("nombre,valores,vectorizada,original", CASOS, ids=[c[0] for c in CASOS])
+def test_paridad_normalizacion_categorica(nombre, valores, vectorizada, original):
+    """
+    Con la columna ya categórica (solo texto, como la deja compact_low_cardinality_columns) y nulos.
+    Una categórica no distingue None de NaN; el nulo es NaN, que es lo que entrega pd.read_excel.
+    """
+    textos = [v for v in valores if isinstance(v, str)] + [np.nan]
+    serie = _serie(textos)
+    assert vectorizada(serie.astype('category')).astype(object).tolist() == original(serie).tolist()
+
+def test_tres_y_tres_punto_cero_se_distinguen():
+    """str(3) != str(3.0): las claves deben diferir como en la versión fila a fila."""
+    claves = M.normalize_text_series(pd.Series([3, 3.0, 3], dtype=object)).astype(object).tolist()
+    assert claves == ["3", "3.0", "3"]
+
+def test_paridad_nombre_material_sap():
+    df = pd.DataFrame({
+        'nombre': ["Cartón Corrugado", "Cartón corrugado - ORDINARIO", "Plástico PET Aprovechable", None, "Vidrio", "Aceite (Peligroso)", 7, "Lámparas  peligroso."],
+        'corriente': ["Aprovechable", "Ordinario", "aprovechable", "Peligroso", None, "Peligroso", None, "PELIGROSO"],
+    })
+    original = df.apply(lambda row: M.clean_sap_material_name(row, 'nombre', 'corriente'), axis=1).tolist()
+    assert M.normalize_sap_material_frame(df, 'nombre', 'corriente').astype(object).tolist() == original
+
+def test_serie_vacia():
+    for vectorizada in (M.normalize_text_series, M.normalize_client_part1_series, M.normalize_client_part2_series):
+        assert vectorizada(pd.Series([], dtype=object)).tolist() == []
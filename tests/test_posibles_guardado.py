@@ -0,0 +1,54 @@
+# -*- coding: utf-8 -*-
+"""
+Guardado incremental de POSIBLES.py: hojas reemplazadas sin dejar tablas/dibujos huérfanos,
+workbook.xml con prefijos ('x:sheet') y resto del libro (formato, fórmulas, gráficos) intacto.
+"""
+import os
+import re
+import sys
+import zipfile
+
+import openpyxl
+import pandas as pd
+import pytest
+from openpyxl.chart import BarChart, Reference
+from openpyxl.worksheet.table import Table
+
+pytest.importorskip("tkcalendar")
+pytest.importorskip("xlsxwriter")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import POSIBLES as P
+
+def _crear_libro(ruta):
+    wb = openpyxl.Workbook(); ws = wb.active; ws.title = P.SHEET_POSIBLES
+    ws.append([P.FECHA_COLUMNA, P.CLIENTE_COLUMNA, P.COMERCIAL_COLUMNA, P.SUBTOTAL_COLUMNA, P.PESO_COLUMNA])
+    for i in range(40): ws.append([pd.Timestamp("2024-01-01") + pd.Timedelta(days=i % 9), f"Cliente Ñandú {i % 5}", f"Com {i % 3}", float(i), i / 10])
+    ws.add_table(Table(displayName="TablaPosibles", ref="A1:E41"))
+    metas = wb.create_sheet("METAS"); metas.append(["NIT", "Meta"]); metas.append(["900", 3]); metas["C1"] = "=SUM(B2:B2)"
+    metas["A1"].font = openpyxl.styles.Font(bold=True)
+    grafico = BarChart(); grafico.add_data(Reference(metas, min_col=2, min_row=1, max_row=2)); metas.add_chart(grafico, "E2")
+    wb.save(ruta)
+
+def _prefijar_workbook(ruta):
+    """Reescribe workbook.xml con el espacio de nombres principal prefijado ('x:workbook', 'x:sheet')."""
+    with zipfile.ZipFile(ruta) as zf: infos = zf.infolist(); datos = {info.filename: zf.read(info.filename) for info in infos}
+    xml = datos['xl/workbook.xml'].decode('utf-8')
+    xml = re.sub(r'<(/?)(?![?])(\w+)(?=[\s/>])', r'<\1x:\2', xml).replace('xmlns="', 'xmlns:x="', 1)
+    datos['xl/workbook.xml'] = xml.encode('utf-8')
+    with zipfile.ZipFile(ruta, 'w', zipfile.ZIP_DEFLATED) as zf:
+        for info in infos: zf.writestr(info, datos[info.filename])
+
+def test_guardado_incremental_quita_partes_huerfanas(tmp_path):
+    ruta = str(tmp_path / "posibles.xlsx"); _crear_libro(ruta); _prefijar_workbook(ruta)
+    with zipfile.ZipFile(ruta) as zf: antes = set(zf.namelist())
+    df = P.cargar_datos_excel(ruta, P.SHEET_POSIBLES)
+    for _ in range(2): assert P.guardar_hojas_incremental(ruta, {P.SHEET_POSIBLES: df.iloc[10:]})
+    with zipfile.ZipFile(ruta) as zf:
+        assert zf.testzip() is None; despues = set(zf.namelist()); tipos = zf.read('[Content_Types].xml').decode('utf-8')
+        assert b'<x:sheet ' in zf.read('xl/workbook.xml')
+    quitadas = antes - despues
+    assert 'xl/tables/table1.xml' in quitadas and 'xl/worksheets/_rels/sheet1.xml.rels' in quitadas and 'table1.xml' not in tipos
+    assert not any(parte.startswith(('xl/charts/', 'xl/drawings/')) for parte in quitadas) # El gráfico de METAS sigue
+    libro = openpyxl.load_workbook(ruta)
+    assert libro.sheetnames == [P.SHEET_POSIBLES, "METAS"] and libro["METAS"]["A1"].font.b and libro["METAS"]["C1"].value == "=SUM(B2:B2)"
+    pd.testing.assert_frame_equal(P.cargar_datos_excel(ruta, P.SHEET_POSIBLES), df.iloc[10:].reset_index(drop=True))
@@ -0,0 +1,77 @@
+# -*- coding: utf-8 -*-
+"""
+Prueba de humo de la tabla virtual de POSIBLES.py con Tk real: carga de un libro,
+clic, Shift-clic, rueda del ratón y 'Mover Seleccionados y Guardar'.
+Se omite si no hay pantalla (p. ej. CI sin servidor X).
+"""
+import os
+import sys
+import tkinter as tk
+
+import numpy as np
+import openpyxl
+import pandas as pd
+import pytest
+
+pytest.importorskip("tkcalendar")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import POSIBLES as P
+
+N_FILAS = 500
+
+def _crear_libro(ruta):
+    rng = np.random.default_rng(0)
+    wb = openpyxl.Workbook(); ws = wb.active; ws.title = P.SHEET_POSIBLES
+    ws.append([P.FECHA_COLUMNA, P.CLIENTE_COLUMNA, "Residuo", P.COMERCIAL_COLUMNA, P.SUBTOTAL_COLUMNA, P.PESO_COLUMNA, "Nit Cliente"])
+    for i in range(N_FILAS):
+        ws.append([pd.Timestamp("2024-01-01") + pd.Timedelta(days=i % 200), f"Cliente Ñandú {i % 37}", "Cartón",
+                   f"Com {i % 4}", float(rng.random() * 1000), float(rng.random() * 10), str(900000 + i % 37)])
+    for nombre in ("METAS", P.SHEET_MATRIZ):
+        otra = wb.create_sheet(nombre); otra.append([P.MATRIZ_NIT_COL, P.MATRIZ_COMERCIAL_COL])
+        for i in range(10): otra.append([str(900000 + i), f"Com {i % 4}"])
+    wb.save(ruta)
+
+@pytest.fixture
+def app(tmp_path, monkeypatch):
+    try: app = P.App()
+    except tk.TclError as e: pytest.skip(f"Sin pantalla para Tk: {e}")
+    ruta = str(tmp_path / "posibles.xlsx"); _crear_libro(ruta)
+    monkeypatch.setattr(P.filedialog, "askopenfilename", lambda **kwargs: ruta)
+    monkeypatch.setattr(P.messagebox, "askyesno", lambda *args, **kwargs: True)
+    for nombre in ("showinfo", "showwarning", "showerror"): monkeypatch.setattr(P.messagebox, nombre, lambda *args, **kwargs: None)
+    app.geometry("1000x780+0+0"); app.update()
+    app.select_button.invoke(); app.update()
+    yield app
+    app.destroy()
+
+def _clic(app, posicion_visible, modificador=""):
+    """Clic real sobre la fila visible indicada (posición dentro de la ventana materializada)."""
+    item = app.tree.get_children()[posicion_visible]
+    x, y, _, alto = app.tree.bbox(item)
+    app.tree.event_generate(f"<{modificador}Button-1>", x=x + 5, y=y + alto // 2); app.update()
+
+def _rueda_abajo(app):
+    if app.tk.call("tk", "windowingsystem") == "x11": app.tree.event_generate("<Button-5>", x=10, y=40)
+    else: app.tree.event_generate("<MouseWheel>", delta=-120, x=10, y=40)
+    app.update()
+
+def test_tabla_virtual_carga_solo_filas_visibles(app):
+    assert len(app.vista_ids) == N_FILAS
+    assert 0 < len(app.tree.get_children()) < N_FILAS
+
+def test_clic_shift_clic_rueda_y_mover(app):
+    _clic(app, 1)
+    assert app.seleccion_ids == {app.vista_ids[1]}
+    _rueda_abajo(app)
+    assert app.vista_offset == P.TABLA_FILAS_RUEDA
+    _clic(app, 2, "Shift-") # Rango desde el ancla (fila 1), que ya no está materializada
+    esperados = set(app.vista_ids[1:P.TABLA_FILAS_RUEDA + 3])
+    assert app.seleccion_ids == esperados
+    assert set(app.tree.selection()) == {item for item, id_fila in app.original_indices.items() if id_fila in esperados}
+    assert app.summary_label.cget("text").startswith(f"Selección: {len(esperados)} filas")
+
+    app.mover_button.invoke(); app.update()
+    assert len(app.vista_ids) == N_FILAS - len(esperados) and not app.seleccion_ids
+    libro = pd.read_excel(app.selected_excel_file, sheet_name=None)
+    assert len(libro[P.SHEET_POSIBLES]) == N_FILAS - len(esperados)
+    assert len(libro[P.SHEET_ELIMINADOS]) == len(esperados)
@@ -0,0 +1,82 @@
+# -*- coding: utf-8 -*-
+"""
+Lógica de la tabla virtual de POSIBLES.py sin pantalla: ventana materializada, selección por ids
+(clic, Ctrl-clic, Shift-clic) y movimiento del foco con teclado, sobre un Treeview y una barra falsos.
+"""
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+import pytest
+
+pytest.importorskip("tkcalendar")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import POSIBLES as P
+
+N_FILAS = 100; ALTO = P.TABLA_ALTO_FILA * 11 + 4 # Encabezado + 10 filas visibles
+VISIBLES = 10
+
+class TreeFalso:
+    """Lo mínimo de ttk.Treeview que usa la tabla virtual."""
+    def __init__(self): self.items = {}; self.seleccion = []; self.foco = None
+    def winfo_height(self): return ALTO
+    def get_children(self): return tuple(self.items)
+    def delete(self, item): del self.items[item]
+    def insert(self, padre, indice, iid): self.items[iid] = (); return iid
+    def item(self, item, values): self.items[item] = tuple(values)
+    def selection_set(self, items): self.seleccion = list(items)
+    def focus(self, item): self.foco = item
+
+class BarraFalsa:
+    def set(self, inicio, fin): self.posicion = (inicio, fin)
+
+class EtiquetaFalsa:
+    def config(self, text): self.texto = text
+
+@pytest.fixture
+def app():
+    df = pd.DataFrame({P.CLIENTE_COLUMNA: [f"Cliente {i}" for i in range(N_FILAS)], P.SUBTOTAL_COLUMNA: np.arange(N_FILAS, dtype=float),
+                       P.PESO_COLUMNA: np.ones(N_FILAS)}, index=np.arange(1000, 1000 + N_FILAS))
+    app = P.App.__new__(P.App) # Sin Tk: solo el estado que usa la tabla virtual
+    app.tree = TreeFalso(); app.scrollbar_y = BarraFalsa(); app.summary_label = EtiquetaFalsa()
+    app.df_original = df; app.totales_filas = None; app._totales_origen = None
+    app.textos_vista = P.formatear_columnas_vista(df, list(df.columns)); app.original_indices = {}
+    app.vista_ids = df.index.to_numpy()[::-1] # Vista en otro orden que el índice
+    app.vista_offset = 0; app.seleccion_ids = set(); app.foco_pos = None; app.ancla_pos = None
+    app.renderizar_ventana()
+    return app
+
+def _ids_ventana(app):
+    return [app.original_indices[item] for item in app.tree.get_children()]
+
+def test_renderiza_solo_la_ventana_visible(app):
+    assert app.filas_visibles() == VISIBLES and len(app.tree.get_children()) == VISIBLES
+    assert _ids_ventana(app) == list(app.vista_ids[:VISIBLES])
+    assert app.tree.items["0"][0] == f"Cliente {app.vista_ids[0] - 1000}"
+    app.desplazar_vista(95) # Se limita al final de la vista
+    assert app.vista_offset == N_FILAS - VISIBLES and _ids_ventana(app) == list(app.vista_ids[-VISIBLES:])
+    assert app.scrollbar_y.posicion == ((N_FILAS - VISIBLES) / N_FILAS, 1.0)
+    app.on_scroll_vista('moveto', '0.5')
+    assert app.vista_offset == N_FILAS // 2 and len(app.tree.get_children()) == VISIBLES
+
+def test_seleccion_por_ids_sobrevive_al_desplazamiento(app):
+    app.seleccionar_posiciones(2, 'simple'); app.seleccionar_posiciones(5, 'alternar'); app.renderizar_ventana()
+    assert app.seleccion_ids == {app.vista_ids[2], app.vista_ids[5]} and app.tree.seleccion == ["2", "5"]
+    app.desplazar_vista(30)
+    assert app.tree.seleccion == [] # Fuera de la ventana, pero siguen seleccionadas
+    app.seleccionar_posiciones(35, 'rango') # Rango desde el ancla (posición 5)
+    assert app.seleccion_ids == set(app.vista_ids[5:36])
+    assert app.indices_seleccionados() == list(app.vista_ids[5:36])
+
+def test_mover_foco_con_teclado(app):
+    app.mover_foco(1, False)
+    assert app.foco_pos == 1 and app.seleccion_ids == {app.vista_ids[1]} and app.tree.foco == "1"
+    app.mover_foco('pagina+', True) # Shift+AvPág: extiende desde el ancla y desplaza lo justo
+    assert app.foco_pos == 1 + VISIBLES and app.seleccion_ids == set(app.vista_ids[1:VISIBLES + 2])
+    assert app.vista_offset == 2 and app.tree.foco == str(VISIBLES - 1)
+    app.mover_foco('fin', False)
+    assert app.foco_pos == N_FILAS - 1 and app.vista_offset == N_FILAS - VISIBLES and app.seleccion_ids == {app.vista_ids[-1]}
+    app.mover_foco('inicio', True)
+    assert app.vista_offset == 0 and app.seleccion_ids == set(app.vista_ids)
+    assert app.summary_label.texto == "Selección: 100 filas | Suma Subtotal: 4950,00 | Suma Peso CC: 100,00"